@@ -1,36 +1,197 @@
+import hmac
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Blueprint, Flask, render_template, request, flash, redirect, session, g,
+    make_response, current_app, abort, jsonify)
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
-import pdb
-
-from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import Likes, db, connect_db, User, Message
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from availability import Availability, check_available
+from compression import Compression
+from config import PROFILES
+from export import FORMATS as EXPORT_FORMATS, export_response
+from feed import hydrate
+from followgraph import FollowGraph
+from hashtags import index_messages, link_hashtags
+from ingest import BATCH_SIZE as INGEST_BATCH_SIZE, ingest_batch
+from jobs import enqueue, queue_stats
+from microcache import MicroCache, microcache
+from partitions import maintain_partitions
+from forms import (
+    UserAddForm, LoginForm, MessageForm, UserEditForm, FollowImportForm)
+from models import (
+    Likes, db, connect_db, User, Message, ArchivedMessage, Follows,
+    MessageTag, Mention, Notification)
+from profiling import init_profiling
+from readmodels import CARD_COLUMNS, load_profile, user_cards
+from snowflake import next_message_id
+from template_profiling import init_template_profiling
+from threads import add_reply, position, replies_page
+from throttle import LoginThrottle, retry_after_header
+from thumbnails import ThumbnailCache
 
 CURR_USER_KEY = "curr_user"
+MESSAGES_PER_PAGE = 100
+FOLLOWS_PER_PAGE = 60
+FOLLOW_IMPORT_MAX = 50000
+
+# A warble's page shows this many levels of replies under it, this many
+# replies at a time.
+THREAD_DEPTH = 3
+REPLIES_PER_PAGE = 50
+
+bp = Blueprint('warbler', __name__)
+
+
+def create_app(config=None):
+    """Build a Warbler app.
+
+    `config` is a profile name from config.PROFILES or a config object;
+    by default the WARBLER_CONFIG environment variable picks the profile
+    (falling back to 'dev').
+    """
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'dev')
+
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    # Get DB_URI and SECRET_KEY from environ variables (useful for
+    # production/testing) or, if not set there, use the profile's.
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL', app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SECRET_KEY'] = os.environ.get(
+        'SECRET_KEY', app.config['SECRET_KEY'])
+    app.config['INGEST_TOKEN'] = os.environ.get(
+        'INGEST_TOKEN', app.config['INGEST_TOKEN'])
+    app.config['STATS_TOKEN'] = os.environ.get(
+        'STATS_TOKEN', app.config['STATS_TOKEN'])
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("SECRET_KEY must be set for this profile")
+
+    hops = app.config['PROXY_HOPS']
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    # first, so its after_request runs last, on the finished body
+    Compression(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        # only dev pays for importing the toolbar
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    cache_dir = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    if app.config['PROFILE_TEMPLATES']:
+        init_template_profiling(app)
+
+    if app.config['PROFILE_REQUESTS']:
+        init_profiling(app)
+
+    app.jinja_env.globals['MESSAGES_PER_PAGE'] = MESSAGES_PER_PAGE
+    app.jinja_env.globals['FOLLOWS_PER_PAGE'] = FOLLOWS_PER_PAGE
+    app.jinja_env.globals['THREAD_DEPTH'] = THREAD_DEPTH
+    app.jinja_env.filters['hashtags'] = link_hashtags
+
+    app.register_blueprint(bp)
+    connect_db(app)
+
+    if app.config['LEASE_WORKER_IDS']:
+        next_message_id.lease_from(db.get_engine(app))
+
+    LoginThrottle(app)
+    ThumbnailCache(app)
+    MicroCache(app)
+    FollowGraph(app)
+    Availability(app)
+
+    if app.config['WARMUP']:
+        warmup(app)
+
+    return app
+
 
-app = Flask(__name__)
+def warmup(app):
+    """Do the first-request work up front.
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+    Meant to run once in a pre-forking server's master (gunicorn
+    --preload; see gunicorn.conf.py) so every worker inherits it:
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    - compiles every template into the Jinja cache
+    - configures the SQLAlchemy mappers
+    - opens a database connection to check the server is reachable, and
+      creates any missing monthly message partitions (see partitions.py)
+
+    The connection is dropped again afterwards: a socket shared across a
+    fork would be used by several workers at once. Workers open their own
+    pool after forking (gunicorn.conf.py's post_fork does it eagerly).
+    """
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    db.configure_mappers()
+
+    with app.app_context():
+        with db.engine.begin() as conn:
+            maintain_partitions(conn)
+
+        db.engine.dispose()
+
+
+def open_pool(app, connections=None):
+    """Open `connections` pooled database connections now.
+
+    Defaults to the engine's pool size.
+    """
+
+    with app.app_context():
+        if connections is None:
+            connections = db.engine.pool.size()
+
+        conns = [db.engine.connect() for _ in range(connections)]
+
+        for conn in conns:
+            conn.close()
 
-connect_db(app)
+
+_default_app = None
+
+
+def __getattr__(name):
+    """Build the default app the first time `app.app` is asked for.
+
+    Keeps `from app import app` and `gunicorn app:app` working without
+    building an app just because the module was imported.
+    """
+
+    global _default_app
+
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -54,7 +215,17 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def throttled(template, form, retry_after):
+    """Turn away an over-limit auth attempt, before it costs a bcrypt hash."""
+
+    flash("Too many attempts. Please wait a moment and try again.", 'danger')
+
+    resp = make_response(render_template(template, form=form), 429)
+    resp.headers['Retry-After'] = retry_after_header(retry_after)
+    return resp
+
+
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -69,6 +240,15 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        login_throttle = current_app.extensions['login_throttle']
+        retry_after = login_throttle.check(request.remote_addr)
+        if retry_after:
+            return throttled('users/signup.html', form, retry_after)
+
+        # before User.signup hashes the password
+        if not check_available(form):
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -76,12 +256,16 @@ def signup():
                 email=form.email.data,
                 image_url=form.image_url.data or User.image_url.default.arg,
             )
+            db.session.flush()
+            enqueue(db.session, 'warm_thumbnails', {'user_id': user.id})
             db.session.commit()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        current_app.extensions['availability'].add(
+            username=user.username, email=user.email)
         do_login(user)
 
         return redirect("/")
@@ -90,13 +274,19 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
+        login_throttle = current_app.extensions['login_throttle']
+        retry_after = login_throttle.check(request.remote_addr,
+                                           form.username.data)
+        if retry_after:
+            return throttled('users/login.html', form, retry_after)
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
@@ -110,7 +300,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -120,10 +310,112 @@ def logout():
     return redirect("/login")
 
 
+def paginate_message_ids(*criteria, model=Message, limit=MESSAGES_PER_PAGE,
+                         before=None, id_column=None):
+    """Ids of one page of `model` rows matching `criteria`, newest first.
+
+    Message ids are time-sortable, so we page on the id alone: pass
+    ?before=<id of the last message seen> to get the next page. Turn the
+    ids into something to render with feed.hydrate. For an index table
+    (tags, mentions), pass its message id column as `id_column`.
+    """
+
+    if before is None:
+        before = request.args.get('before', type=int)
+
+    if id_column is None:
+        id_column = model.id
+
+    query = db.session.query(id_column).filter(*criteria)
+
+    if before:
+        query = query.filter(id_column < before)
+
+    return [id for id, in (query
+                           .order_by(id_column.desc())
+                           .limit(limit))]
+
+
+def paginate_follows(user_id, owner_column, other_column):
+    """One page of the users on the other end of `user_id`'s follows.
+
+    `owner_column` is the Follows column holding `user_id`, `other_column`
+    the one holding the users to list. Returns UserCards ordered by id;
+    pass ?after=<id of the last card seen> for the next page.
+    """
+
+    after = request.args.get('after', type=int)
+
+    query = (db.select(CARD_COLUMNS)
+             .select_from(User.__table__.join(Follows.__table__,
+                                              other_column == User.id))
+             .where(owner_column == user_id))
+
+    if after:
+        query = query.where(other_column > after)
+
+    return user_cards(query.order_by(other_column).limit(FOLLOWS_PER_PAGE))
+
+
+def paginate_likes(user_id, limit=MESSAGES_PER_PAGE):
+    """Ids of one page of the warbles `user_id` liked, latest like first.
+
+    Reads only ix_likes_user_id_created_at, in index order, so a page
+    costs the same however many likes the user has. Pass ?before=<the
+    cursor this returns> for the next page. Returns (ids, cursor), the
+    cursor being None on the last page.
+    """
+
+    query = (db.session
+             .query(Likes.message_id, Likes.created_at)
+             .filter(Likes.user_id == user_id))
+
+    cursor = parse_like_cursor(request.args.get('before'))
+    if cursor:
+        liked_at, message_id = cursor
+        # likes made at the same instant are in message id order
+        query = query.filter(
+            Likes.created_at <= liked_at,
+            db.or_(Likes.created_at < liked_at,
+                   Likes.message_id > message_id))
+
+    rows = (query
+            .order_by(Likes.created_at.desc(), Likes.message_id)
+            .limit(limit)
+            .all())
+
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = f"{last.created_at.isoformat()},{last.message_id}"
+
+    return [row.message_id for row in rows], next_cursor
+
+
+def parse_like_cursor(cursor):
+    """(like time, message id) from a paginate_likes cursor, or None."""
+
+    try:
+        liked_at, message_id = cursor.split(',')
+        return datetime.fromisoformat(liked_at), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def follow_badges(user_ids):
+    """(ids g.user follows, ids following g.user) among `user_ids`."""
+
+    if not g.user:
+        return set(), set()
+
+    return current_app.extensions['follow_graph'].relationships(
+        g.user.id, user_ids)
+
+
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -131,44 +423,48 @@ def list_users():
     """
 
     search = request.args.get('q')
+    query = db.select(CARD_COLUMNS)
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    if search:
+        query = query.where(User.username.like(f"%{search}%"))
+
+    cards = user_cards(query)
+    following_ids, follower_ids = follow_badges([card.id for card in cards])
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=cards,
+                           following_ids=following_ids)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
+@microcache
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = load_profile(user_id)
+    if user is None:
+        abort(404)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    viewer_id = g.user.id if g.user else None
 
-    #         # build list of liked warbles to properly generate html
-    # likes = (Likes
-    #          .query
-    #          .filter(Likes.user_id == g.user.id)
-    #          .all())
+    message_ids = paginate_message_ids(Message.user_id == user_id)
+    messages = hydrate(message_ids, viewer_id)
 
-    # liked_msg_ids = [l.message_id for l in likes]
+    # The live table ran out: anything older may be in the archive tier.
+    if len(messages) < MESSAGES_PER_PAGE:
+        archived_ids = paginate_message_ids(
+            ArchivedMessage.user_id == user_id,
+            model=ArchivedMessage,
+            limit=MESSAGES_PER_PAGE - len(messages),
+            before=message_ids[-1] if message_ids else None)
+        messages += hydrate(archived_ids, viewer_id, archived=True)
 
-    # # pdb.set_trace()
+    following_ids, follower_ids = follow_badges([user.id])
 
-    return render_template('users/show.html', user=user, messages=messages)
+    return render_template('users/show.html', user=user, messages=messages,
+                           following_ids=following_ids)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -176,11 +472,21 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = load_profile(user_id)
+    if user is None:
+        abort(404)
+
+    follows = paginate_follows(user_id, Follows.user_following_id,
+                               Follows.user_being_followed_id)
+    following_ids, follower_ids = follow_badges(
+        [user.id] + [f.id for f in follows])
 
+    return render_template('users/following.html', user=user,
+                           follows=follows, following_ids=following_ids,
+                           follower_ids=follower_ids)
 
-@app.route('/users/<int:user_id>/followers')
+
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -188,11 +494,21 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = load_profile(user_id)
+    if user is None:
+        abort(404)
+
+    follows = paginate_follows(user_id, Follows.user_being_followed_id,
+                               Follows.user_following_id)
+    following_ids, follower_ids = follow_badges(
+        [user.id] + [f.id for f in follows])
+
+    return render_template('users/followers.html', user=user,
+                           follows=follows, following_ids=following_ids,
+                           follower_ids=follower_ids)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -200,14 +516,20 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    try:
+        Follows.add(g.user.id, follow_id)
+        db.session.commit()
+    except IntegrityError:
+        # no such user
+        db.session.rollback()
+        abort(404)
+
+    current_app.extensions['follow_graph'].expire()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -215,14 +537,46 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.remove(g.user.id, follow_id)
     db.session.commit()
+    current_app.extensions['follow_graph'].expire()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/following/import', methods=['GET', 'POST'])
+def import_following():
+    """Follow everyone in a list of usernames, e.g. from another site.
+
+    Names can be separated by spaces, commas or new lines, with or
+    without their @.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = FollowImportForm()
+
+    if form.validate_on_submit():
+        usernames = {name.lstrip('@') for name
+                     in form.usernames.data.replace(',', ' ').split()}
+
+        if len(usernames) > FOLLOW_IMPORT_MAX:
+            flash(f"At most {FOLLOW_IMPORT_MAX} usernames at a time.",
+                  "danger")
+        else:
+            added = Follows.add_by_username(g.user.id, usernames)
+            db.session.commit()
+            current_app.extensions['follow_graph'].expire()
+
+            flash(f"Followed {added} more users.", "success")
+            return redirect(f"/users/{g.user.id}/following")
+
+    return render_template('users/import-following.html', form=form)
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -233,6 +587,10 @@ def profile():
     form = UserEditForm()
 
     if form.validate_on_submit():
+        # before User.authenticate checks the password
+        if not check_available(form, g.user):
+            return render_template('users/edit.html', form=form)
+
         user = User.authenticate(g.user.username, form.password.data)
         if user:
             user.username = form.username.data
@@ -240,6 +598,7 @@ def profile():
             user.image_url = form.image_url.data
             user.header_image_url = form.header_image_url.data
             user.bio = form.bio.data
+            enqueue(db.session, 'warm_thumbnails', {'user_id': user.id})
 
             try:
                 db.session.commit()
@@ -249,6 +608,9 @@ def profile():
                 flash("That username is already taken.", 'danger')
                 return render_template('users/edit.html', form=form)
 
+            current_app.extensions['availability'].add(
+                username=user.username, email=user.email)
+
             flash("Successfully updated user information.", "success")
             return redirect(f"/users/{user.id}")
         else:
@@ -259,7 +621,27 @@ def profile():
 
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/available')
+def check_availability():
+    """Is ?username= free? JSON like {"username": true}.
+
+    For the signup and profile forms; when logged in, your own username
+    counts as free. E-mail addresses are only checked when a form is
+    submitted: answering here would tell anyone, unthrottled, whether an
+    address has an account.
+    """
+
+    availability = current_app.extensions['availability']
+    username = request.args.get('username')
+
+    if not username:
+        return jsonify({})
+
+    return jsonify(
+        username=availability.is_available('username', username, g.user))
+
+
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -277,7 +659,7 @@ def delete_user():
 
 ##############################################################################
 # Likes routes:
-@app.route('/users/add_like/<int:msg_id>', methods=["POST"])
+@bp.route('/users/add_like/<int:msg_id>', methods=["POST"])
 def add_like(msg_id):
     """Add warble to likes"""
 
@@ -285,14 +667,17 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    new_like = Likes(user_id=g.user.id, message_id=msg_id)
-
-    db.session.add(new_like)
-    db.session.commit()
+    try:
+        Likes.add(g.user.id, msg_id)
+        db.session.commit()
+    except IntegrityError:
+        # no such warble, or it's been archived
+        db.session.rollback()
+        abort(404)
 
     return redirect('/')
 
-@app.route('/users/remove_like/<int:msg_id>', methods=["POST"])
+@bp.route('/users/remove_like/<int:msg_id>', methods=["POST"])
 def remove_like(msg_id):
     """Remove warble from likes"""
 
@@ -300,46 +685,95 @@ def remove_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    like = Likes.query.filter(Likes.message_id == msg_id).first()
-
-    db.session.delete(like)
+    Likes.query.filter_by(user_id=g.user.id, message_id=msg_id).delete()
     db.session.commit()
 
     return redirect('/')
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
-    """Show specified user's likes"""
+    """Show specified user's likes, most recently liked first."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # build list of liked warbles to properly generate html
-    likes = (Likes
-                .query
-                .filter(Likes.user_id == g.user.id)
-                .all())
+    user = load_profile(user_id)
+    if user is None:
+        abort(404)
+
+    message_ids, next_cursor = paginate_likes(user_id)
+
+    messages = hydrate(message_ids, g.user.id)
+    following_ids, follower_ids = follow_badges(
+        {message.user_id for message in messages})
+
+    return render_template('messages/likes.html', user=user,
+                           messages=messages, next_cursor=next_cursor,
+                           following_ids=following_ids)
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show warbles mentioning a user, newest first."""
+
+    username = (db.session.query(User.username)
+                .filter(User.id == user_id)
+                .scalar())
+    if username is None:
+        abort(404)
 
-    liked_msg_ids = [l.message_id for l in likes]
+    message_ids = paginate_message_ids(Mention.user_id == user_id,
+                                       id_column=Mention.message_id)
 
-    messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(liked_msg_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+    return render_message_list(f"Mentioning @{username}", message_ids,
+                               f"/users/{user_id}/mentions")
+
+
+@bp.route('/notifications')
+def show_notifications():
+    """Show the logged-in user's notifications, newest warble first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    return render_template('messages/likes.html', messages=messages)
+    message_ids = paginate_message_ids(Notification.user_id == g.user.id,
+                                       Notification.kind == 'mention',
+                                       id_column=Notification.message_id)
+
+    return render_message_list("Mentions of you", message_ids,
+                               "/notifications")
+
+
+@bp.route('/users/<int:user_id>/export')
+def export_user(user_id):
+    """Download all of the logged-in user's warbles, follows and likes.
+
+    ?format=ndjson (the default) or ?format=csv; see export.py.
+    """
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.args.get('format', 'ndjson')
+
+    if format not in EXPORT_FORMATS:
+        abort(400)
+
+    return export_response(user_id, format)
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
     Show form if GET. If valid, update message and redirect to user page.
+    With ?reply_to=<message id>, the message is a reply to that warble,
+    and we go back to it instead.
     """
 
     if not g.user:
@@ -348,25 +782,142 @@ def messages_add():
 
     form = MessageForm()
 
+    reply_to = request.args.get('reply_to', type=int)
+    parent = None
+    if reply_to is not None:
+        # live warbles only: the archive tier's aren't in conversations
+        parent = hydrate([reply_to], g.user.id)
+        if not parent:
+            abort(404)
+        parent = parent[0]
+
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+
+        if parent:
+            add_reply(db.session, msg.id, parent.id)
+
+        mentioning = index_messages(db.session, [(msg.id, msg.text)])
+        if mentioning:
+            # delivered by a jobs.py worker, not while the poster waits
+            enqueue(db.session, 'deliver_mentions',
+                    {'message_ids': mentioning})
+
         db.session.commit()
 
+        if parent:
+            return redirect(f"/messages/{parent.id}")
+
         return redirect(f"/users/{g.user.id}")
 
-    return render_template('messages/new.html', form=form)
+    return render_template('messages/new.html', form=form, parent=parent)
+
+
+def bearer_token_ok(token):
+    """Does the request carry `Authorization: Bearer <token>`?
+
+    Never, if `token` isn't set.
+    """
+
+    auth = request.headers.get('Authorization', '')
+
+    return bool(token) and hmac.compare_digest(auth.encode(),
+                                               f"Bearer {token}".encode())
+
+
+@bp.route('/api/messages/bulk', methods=["POST"])
+def messages_bulk():
+    """Insert a batch of warbles sent as NDJSON; see ingest.py.
+
+    Needs `Authorization: Bearer <INGEST_TOKEN>`. Responds with the
+    batch's report: how many were inserted, and which lines weren't.
+    """
+
+    if not bearer_token_ok(current_app.config['INGEST_TOKEN']):
+        return jsonify(error="Access unauthorized."), 401
+
+    lines = request.get_data(as_text=True).splitlines()
+
+    if len(lines) > INGEST_BATCH_SIZE:
+        return jsonify(
+            error=f"At most {INGEST_BATCH_SIZE} lines per batch."), 413
+
+    report = ingest_batch(db.session.connection(), lines)
+    db.session.commit()
+
+    return jsonify(report)
+
+
+@bp.route('/tags/<tag>')
+def show_tag(tag):
+    """Show warbles with a #hashtag, newest first."""
+
+    tag = tag.lower()
+    message_ids = paginate_message_ids(MessageTag.tag == tag,
+                                       id_column=MessageTag.message_id)
+
+    return render_message_list(f"#{tag}", message_ids, f"/tags/{tag}")
+
 
+def render_message_list(title, message_ids, url):
+    """A page of warbles from an index (tag, mentions), with an older link."""
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+    viewer_id = g.user.id if g.user else None
+    messages = hydrate(message_ids, viewer_id)
+    following_ids, follower_ids = follow_badges(
+        {message.user_id for message in messages})
+
+    older_url = None
+    if len(message_ids) == MESSAGES_PER_PAGE:
+        older_url = f"{url}?before={message_ids[-1]}"
+
+    return render_template('messages/list.html', title=title,
+                           messages=messages, following_ids=following_ids,
+                           older_url=older_url)
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
+@microcache
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message in its conversation (see threads.py).
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    Above it, the warbles it replies to; below, a page of the replies
+    under it, THREAD_DEPTH levels deep. ?after=<reply id> pages on.
+    """
+
+    viewer_id = g.user.id if g.user else None
+
+    root_id, path = position(db.session, message_id)
+    page = replies_page(db.session, root_id, path,
+                        after=request.args.get('after', type=int),
+                        depth=THREAD_DEPTH, limit=REPLIES_PER_PAGE)
+
+    # the warble, what it replies to and its replies, in one go
+    found = {msg.id: msg for msg in hydrate(
+        path + [id for id, depth in page], viewer_id)}
+
+    missing = [id for id in path if id not in found]
+    if missing:
+        found.update((msg.id, msg) for msg in hydrate(
+            missing, viewer_id, archived=True))
+
+    if message_id not in found:
+        abort(404)
+
+    msg = found[message_id]
+    following_ids, follower_ids = follow_badges([msg.user_id])
 
+    return render_template(
+        'messages/show.html', message=msg,
+        ancestors=[found[id] for id in path[:-1] if id in found],
+        replies=[(found[id], depth) for id, depth in page if id in found],
+        more_after=page[-1][0] if len(page) == REPLIES_PER_PAGE else None,
+        following_ids=following_ids)
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -388,7 +939,8 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
+@microcache
 def homepage():
     """Show homepage:
 
@@ -398,31 +950,33 @@ def homepage():
     # pdb.set_trace()
     if g.user:
         # build list of ids first, then query. Creating messages first from the user and then appending following user's messages changes ids to the user's id
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        # build list of liked warbles to properly generate html
-        likes = (Likes
-                 .query
-                 .filter(Likes.user_id == g.user.id)
-                 .all())
+        following_ids = current_app.extensions['follow_graph'].following(
+            g.user.id)
 
-        liked_msg_ids = [l.message_id for l in likes]
+        messages = hydrate(
+            paginate_message_ids(
+                Message.user_id.in_(list(following_ids | {g.user.id}))),
+            g.user.id)
 
-        # pdb.set_trace()
-       
-        return render_template('home.html', user=g.user, messages=messages, likes=liked_msg_ids)
+        return render_template('home.html', user=g.user, messages=messages)
 
     else:
         return render_template('home-anon.html')
 
 
+@bp.route('/_debug/jobs')
+def job_stats():
+    """Background job queue depth and lag (see jobs.py).
+
+    Needs `Authorization: Bearer <STATS_TOKEN>`.
+    """
+
+    if not bearer_token_ok(current_app.config['STATS_TOKEN']):
+        return jsonify(error="Access unauthorized."), 401
+
+    return jsonify(jobs=queue_stats(db.session))
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -430,9 +984,15 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Except responses the view marked immutable (thumbnails).
+    """
+
+    if 'immutable' in req.headers.get('Cache-Control', ''):
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
@@ -0,0 +1,431 @@
+"""ASGI entry point: async hot read routes in front of the Flask app.
+
+The read-heavy pages -- the home timeline, profiles, single warbles and
+user search -- are served here by async handlers on an asyncpg connection
+pool, so a request waiting on Postgres parks a coroutine instead of
+holding a worker thread. Everything else (forms, writes, bcrypt, static
+files) falls through to the Flask app, mounted underneath.
+
+Both sides run the same queries (the Core selects in feed.py,
+readmodels.py and threads.py, compiled once here for asyncpg) and share
+the Flask app's templates, config and session cookie, so a user logged in
+through Flask is logged in here too. Run with:
+
+    uvicorn asgi:app --workers 4
+
+Needs the packages in requirements-async.txt. bench_concurrency.py
+compares this against the plain WSGI app.
+"""
+
+import os
+import re
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy.dialects import postgresql
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import HTMLResponse
+from starlette.routing import Mount, Route
+
+from app import (
+    app as flask_app, CURR_USER_KEY, MESSAGES_PER_PAGE, REPLIES_PER_PAGE,
+    THREAD_DEPTH)
+from feed import Author, FeedMessage, feed_select
+from models import db, User, Message, ArchivedMessage, Follows
+from readmodels import CARD_COLUMNS, PROFILE_COLUMNS, Profile, UserCard
+from threads import MAX_ID, POSITION, replies_query
+
+POOL_MIN_SIZE = int(os.environ.get('ASYNC_POOL_MIN_SIZE', 5))
+POOL_MAX_SIZE = int(os.environ.get('ASYNC_POOL_MAX_SIZE', 20))
+
+# Postgres' SQL, with parameters numbered the way asyncpg takes them.
+ASYNCPG_DIALECT = postgresql.dialect(paramstyle='numeric')
+NUMBERED_PARAM_RE = re.compile(r'(?<![:\w]):(\d+)')
+
+
+class Statement:
+    """A SQLAlchemy Core query, compiled once for asyncpg.
+
+    The queries are the ones the Flask views run (feed.py, readmodels.py,
+    threads.py), with their parameters bound by name on each call.
+    """
+
+    def __init__(self, query):
+        compiled = query.compile(dialect=ASYNCPG_DIALECT)
+        self.sql = NUMBERED_PARAM_RE.sub(r'$\1', compiled.string)
+        self.names = compiled.positiontup
+
+    def args(self, values):
+        return [values[name] for name in self.names]
+
+    async def fetch(self, conn, **values):
+        return await conn.fetch(self.sql, *self.args(values))
+
+    async def fetchrow(self, conn, **values):
+        return await conn.fetchrow(self.sql, *self.args(values))
+
+
+users = User.__table__
+
+PROFILE = Statement(
+    db.select(PROFILE_COLUMNS).where(users.c.id == db.bindparam('user_id')))
+
+FOLLOWING = Statement(
+    db.select([Follows.user_being_followed_id])
+    .where(Follows.user_following_id == db.bindparam('user_id')))
+
+USERS = Statement(db.select(CARD_COLUMNS))
+
+USERS_MATCHING = Statement(
+    db.select(CARD_COLUMNS)
+    .where(users.c.username.like(db.bindparam('pattern'))))
+
+
+def feed_statements(archived):
+    """(page by authors, by ids) for the live or archived messages."""
+
+    messages = (ArchivedMessage if archived else Message).__table__
+    rows = feed_select(db.bindparam('viewer_id'), archived)
+
+    by_authors = (rows
+                  .where(messages.c.user_id == db.any_(db.cast(
+                      db.bindparam('author_ids'), postgresql.ARRAY(db.Integer))))
+                  .where(messages.c.id < db.bindparam('before'))
+                  .order_by(messages.c.id.desc())
+                  .limit(db.bindparam('limit')))
+    by_ids = rows.where(messages.c.id == db.any_(db.cast(
+        db.bindparam('ids'), postgresql.ARRAY(db.BigInteger))))
+
+    return Statement(by_authors), Statement(by_ids)
+
+
+FEED_PAGE, FEED_MESSAGES = {}, {}
+for table, archived in (('messages', False), ('messages_archive', True)):
+    FEED_PAGE[table], FEED_MESSAGES[table] = feed_statements(archived)
+
+REPLY_POSITION = Statement(POSITION)
+REPLIES_PAGE = Statement(replies_query(None, None, depth=THREAD_DEPTH))
+
+
+##############################################################################
+# Read models handed to the templates
+
+
+def message_from_row(row):
+    """Build a template-ready message (with .user) from a feed_select row.
+
+    Same fields as feed.FeedMessage.
+    """
+
+    return FeedMessage(
+        id=row['id'],
+        text=row['text'],
+        timestamp=row['timestamp'],
+        user_id=row['user_id'],
+        user=Author(row['user_id'], row['username'], row['image_url']),
+        like_count=row['like_count'],
+        liked=row['liked'],
+        reply_count=row['reply_count'],
+    )
+
+
+class CurrentUser(SimpleNamespace):
+    """The logged-in user, with the ids of the users they follow."""
+
+
+##############################################################################
+# Session and template plumbing shared with the Flask app
+
+session_serializer = flask_app.session_interface.get_signing_serializer(
+    flask_app)
+SESSION_COOKIE_NAME = flask_app.config['SESSION_COOKIE_NAME']
+url_adapter = flask_app.url_map.bind('')
+
+
+def url_for(endpoint, **values):
+    return url_adapter.build(endpoint, values)
+
+
+class RequestState:
+    """Per-request stand-in for Flask's session, g and flashing."""
+
+    def __init__(self, request):
+        self.request = request
+        self.session = self._load_session()
+        self.session_modified = False
+        self.flashes = None
+        self.user = None
+
+    def _load_session(self):
+        cookie = self.request.cookies.get(SESSION_COOKIE_NAME)
+
+        if not cookie:
+            return {}
+
+        max_age = flask_app.permanent_session_lifetime.total_seconds()
+
+        try:
+            return session_serializer.loads(cookie, max_age=int(max_age))
+        except BadSignature:
+            return {}
+
+    def get_flashed_messages(self, with_categories=False, category_filter=()):
+        """Same contract as flask.get_flashed_messages."""
+
+        if self.flashes is None:
+            self.flashes = self.session.pop('_flashes', [])
+            self.session_modified = self.session_modified or bool(self.flashes)
+
+        flashes = self.flashes
+
+        if category_filter:
+            flashes = [f for f in flashes if f[0] in category_filter]
+
+        if not with_categories:
+            return [msg for category, msg in flashes]
+
+        return flashes
+
+    def render(self, template, **context):
+        """Render a shared Flask template and save the session if needed."""
+
+        html = flask_app.jinja_env.get_template(template).render(
+            g=SimpleNamespace(user=self.user),
+            request=SimpleNamespace(
+                endpoint=self.request.scope['endpoint'].__name__),
+            session=self.session,
+            config=flask_app.config,
+            get_flashed_messages=self.get_flashed_messages,
+            url_for=url_for,
+            **context)
+
+        body, encoding = flask_app.extensions['compression'].compress_body(
+            html.encode(), 'text/html',
+            self.request.headers.get('accept-encoding'))
+
+        response = HTMLResponse(body, headers={'Vary': 'Accept-Encoding'})
+
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+        if self.session_modified:
+            self.save_session(response)
+
+        return response
+
+    def save_session(self, response):
+        """Set (or delete) the session cookie, with Flask's flags."""
+
+        interface = flask_app.session_interface
+        domain = interface.get_cookie_domain(flask_app)
+        path = interface.get_cookie_path(flask_app)
+
+        if not self.session:
+            response.delete_cookie(SESSION_COOKIE_NAME, path=path,
+                                   domain=domain)
+            return
+
+        max_age = None
+        if self.session.get('_permanent'):
+            max_age = int(
+                flask_app.permanent_session_lifetime.total_seconds())
+
+        response.set_cookie(
+            SESSION_COOKIE_NAME,
+            session_serializer.dumps(dict(self.session)),
+            max_age=max_age,
+            path=path,
+            domain=domain,
+            secure=interface.get_cookie_secure(flask_app),
+            httponly=interface.get_cookie_httponly(flask_app),
+            samesite=interface.get_cookie_samesite(flask_app))
+
+
+async def load_current_user(conn, state):
+    """Async twin of app.add_user_to_g."""
+
+    user_id = state.session.get(CURR_USER_KEY)
+
+    if user_id is None:
+        return None
+
+    row = await PROFILE.fetchrow(conn, user_id=user_id)
+
+    if row is None:
+        return None
+
+    user = CurrentUser(**Profile(*row)._asdict())
+    user.following_ids = {r['user_being_followed_id'] for r in
+                          await FOLLOWING.fetch(conn, user_id=user.id)}
+
+    return user
+
+
+async def fetch_feed(conn, table, viewer_id, author_ids, before, limit):
+    """One page of `table` by `author_ids`, newest first, hydrated."""
+
+    rows = await FEED_PAGE[table].fetch(
+        conn, viewer_id=viewer_id, author_ids=list(author_ids),
+        before=before or MAX_ID, limit=limit)
+
+    return [message_from_row(row) for row in rows]
+
+
+def id_param(request, name):
+    try:
+        return int(request.query_params.get(name) or 0) or None
+    except ValueError:
+        return None
+
+
+##############################################################################
+# Routes
+
+
+async def homepage(request):
+    """Async twin of app.homepage."""
+
+    state = RequestState(request)
+
+    async with request.app.state.pool.acquire() as conn:
+        state.user = user = await load_current_user(conn, state)
+
+        if not user:
+            return state.render('home-anon.html')
+
+        messages = await fetch_feed(
+            conn, 'messages', user.id, user.following_ids | {user.id},
+            id_param(request, 'before'), MESSAGES_PER_PAGE)
+
+    return state.render('home.html', user=user, messages=messages)
+
+
+async def users_show(request):
+    """Async twin of app.users_show."""
+
+    state = RequestState(request)
+    user_id = request.path_params['user_id']
+    before = id_param(request, 'before')
+
+    async with request.app.state.pool.acquire() as conn:
+        state.user = await load_current_user(conn, state)
+
+        row = await PROFILE.fetchrow(conn, user_id=user_id)
+
+        if row is None:
+            raise HTTPException(status_code=404)
+
+        viewer_id = state.user.id if state.user else None
+
+        messages = await fetch_feed(
+            conn, 'messages', viewer_id, [user_id], before, MESSAGES_PER_PAGE)
+
+        # The live table ran out: anything older may be in the archive tier.
+        if len(messages) < MESSAGES_PER_PAGE:
+            messages += await fetch_feed(
+                conn, 'messages_archive', viewer_id, [user_id],
+                messages[-1].id if messages else before,
+                MESSAGES_PER_PAGE - len(messages))
+
+    following_ids = state.user.following_ids if state.user else set()
+
+    return state.render('users/show.html', user=Profile(*row),
+                        messages=messages, following_ids=following_ids)
+
+
+async def messages_show(request):
+    """Async twin of app.messages_show."""
+
+    state = RequestState(request)
+    message_id = request.path_params['message_id']
+
+    async with request.app.state.pool.acquire() as conn:
+        state.user = await load_current_user(conn, state)
+
+        viewer_id = state.user.id if state.user else None
+
+        row = await REPLY_POSITION.fetchrow(conn, id=message_id)
+        root_id, path = ((row['root_id'], list(row['path'])) if row
+                         else (message_id, [message_id]))
+
+        page = await REPLIES_PAGE.fetch(
+            conn, root_id=root_id, path=path,
+            after=id_param(request, 'after'), max_id=MAX_ID,
+            depth=THREAD_DEPTH, limit=REPLIES_PER_PAGE)
+
+        found = {}
+        wanted = path + [reply['message_id'] for reply in page]
+
+        # replies are live; the warble and its ancestors may be archived
+        for table in ('messages', 'messages_archive'):
+            rows = await FEED_MESSAGES[table].fetch(
+                conn, viewer_id=viewer_id, ids=wanted)
+            found.update((row['id'], message_from_row(row)) for row in rows)
+
+            wanted = [id for id in path if id not in found]
+            if not wanted:
+                break
+
+    if message_id not in found:
+        raise HTTPException(status_code=404)
+
+    following_ids = state.user.following_ids if state.user else set()
+
+    return state.render(
+        'messages/show.html', message=found[message_id],
+        ancestors=[found[id] for id in path[:-1] if id in found],
+        replies=[(found[reply['message_id']], reply['depth'])
+                 for reply in page if reply['message_id'] in found],
+        more_after=(page[-1]['message_id']
+                    if len(page) == REPLIES_PER_PAGE else None),
+        following_ids=following_ids)
+
+
+async def list_users(request):
+    """Async twin of app.list_users."""
+
+    state = RequestState(request)
+    search = request.query_params.get('q')
+
+    async with request.app.state.pool.acquire() as conn:
+        state.user = await load_current_user(conn, state)
+
+        if not search:
+            rows = await USERS.fetch(conn)
+        else:
+            rows = await USERS_MATCHING.fetch(conn, pattern=f"%{search}%")
+
+    cards = [UserCard(*row) for row in rows]
+    following_ids = state.user.following_ids if state.user else set()
+
+    return state.render('users/index.html', users=cards,
+                        following_ids=following_ids)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.pool = await asyncpg.create_pool(
+        flask_app.config['SQLALCHEMY_DATABASE_URI'],
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE)
+
+    try:
+        yield
+    finally:
+        await app.state.pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/', homepage, methods=['GET']),
+        Route('/users', list_users, methods=['GET']),
+        Route('/users/{user_id:int}', users_show, methods=['GET']),
+        Route('/messages/{message_id:int}', messages_show, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,223 @@
+"""Is a username or e-mail address free? Asked as people type them.
+
+The signup and profile forms ask /users/available as the username changes,
+and both views check the username and e-mail again before they spend a
+bcrypt hash on an insert or update that's bound to fail. (E-mails aren't
+answered live: that would say who has an account to anyone who asks.) Most names asked about are free, so each
+worker keeps a Bloom filter of every username and e-mail address: a name
+that isn't in it is free without a query. Only possible hits (the taken
+names, and about AVAILABILITY_ERROR_RATE of the free ones) are confirmed
+with an exact lookup on the unique index.
+
+A Bloom filter can only say "maybe" wrongly, never "no", as long as it
+holds every name taken, so:
+
+- names this worker saves (signups, profile edits) go in straight away
+- other workers' signups are read in, by user id, at most every
+  AVAILABILITY_REFRESH_INTERVAL seconds. Ids are handed out before
+  their transactions commit, so not always in order of commit: each
+  refresh reads again from the highest id seen
+  AVAILABILITY_REFRESH_LOOKBACK seconds ago, catching a signup that
+  committed up to that long after a higher id was read (except around a
+  worker's first build, which has no earlier read to go back to: a
+  signup committing late then waits for the next rebuild)
+- every AVAILABILITY_REBUILD_INTERVAL seconds, or when it's filled past
+  its capacity, the filter is rebuilt from the whole table, picking up
+  renames and forgetting names given up since
+
+So a name taken in another worker moments ago can still look free; the
+unique constraints stay the last word, and the views still handle
+IntegrityError.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+from models import db, User
+
+# Keys per user (a username and an e-mail), and how much room a rebuilt
+# filter leaves for signups before it's rebuilt again.
+KEYS_PER_USER = 2
+HEADROOM = 2
+MIN_CAPACITY = 1024
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of strings."""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # two hashes from one digest, combined into as many as needed
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+
+        # read again (or a false positive): no room taken
+        if all(self.bits[position >> 3] & (1 << (position & 7))
+               for position in positions):
+            return
+
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+class Availability:
+    """Username and e-mail availability, from a Bloom filter per worker."""
+
+    FIELDS = {
+        'username': User.username,
+        'email': User.email,
+    }
+
+    def __init__(self, app=None):
+        self.filter = None
+        self._max_id = 0
+        # (when, highest user id read by then), oldest first
+        self._marks = deque()
+        self._built_at = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.queries = 0
+        self.false_positives = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.error_rate = app.config['AVAILABILITY_ERROR_RATE']
+        self.refresh_interval = app.config['AVAILABILITY_REFRESH_INTERVAL']
+        self.rebuild_interval = app.config['AVAILABILITY_REBUILD_INTERVAL']
+        self.refresh_lookback = app.config['AVAILABILITY_REFRESH_LOOKBACK']
+        app.extensions['availability'] = self
+
+    @staticmethod
+    def key(field, value):
+        return f"{field}\0{value}"
+
+    def add(self, **values):
+        """Note that the names in `values` (field=value) are taken now."""
+
+        with self._lock:
+            if self.filter is not None:
+                for field, value in values.items():
+                    self.filter.add(self.key(field, value))
+
+    def _read(self, bloom, query):
+        """Add the users of `query` to `bloom`; the highest id seen."""
+
+        max_id = 0
+
+        for id, username, email in db.session.execute(
+                query.execution_options(stream_results=True)):
+            bloom.add(self.key('username', username))
+            bloom.add(self.key('email', email))
+            max_id = max(max_id, id)
+
+        return max_id
+
+    def _query(self):
+        return db.select([User.id, User.username, User.email])
+
+    def _current(self):
+        """Rebuild or refresh the filter, if it's time; hold the lock."""
+
+        now = time.monotonic()
+
+        if (self.filter is None
+                or now - self._built_at >= self.rebuild_interval
+                or self.filter.count > self.filter.capacity):
+            users = db.session.query(db.func.count(User.id)).scalar()
+            bloom = BloomFilter(
+                max(MIN_CAPACITY, users * KEYS_PER_USER * HEADROOM),
+                self.error_rate)
+
+            self._max_id = self._read(bloom, self._query())
+            self.filter = bloom
+            self._built_at = self._refreshed_at = now
+
+        elif now - self._refreshed_at >= self.refresh_interval:
+            # the highest id read by `refresh_lookback` seconds ago
+            while (len(self._marks) > 1
+                   and now - self._marks[1][0] >= self.refresh_lookback):
+                self._marks.popleft()
+
+            since = self._marks[0][1] if self._marks else self._max_id
+            self._max_id = max(self._max_id, self._read(
+                self.filter, self._query().where(User.id > since)))
+            self._refreshed_at = now
+
+        else:
+            return
+
+        self._marks.append((now, self._max_id))
+
+    def is_available(self, field, value, user=None):
+        """Is `value` free for `field` ('username' or 'email')?
+
+        `user`'s own username and e-mail count as free to them.
+        """
+
+        if user is not None and getattr(user, field) == value:
+            return True
+
+        with self._lock:
+            self._current()
+            self.checks += 1
+            maybe_taken = self.key(field, value) in self.filter
+
+        if not maybe_taken:
+            return True
+
+        self.queries += 1
+        column = self.FIELDS[field]
+        taken = db.session.query(
+            db.exists().where(column == value)).scalar()
+
+        if not taken:
+            self.false_positives += 1
+
+        return not taken
+
+
+def check_available(form, user=None):
+    """Put an error on `form`'s username and e-mail fields if they're taken.
+
+    Returns whether both are free. `user` is who's editing their profile,
+    if anyone.
+    """
+
+    availability = current_app.extensions['availability']
+    available = True
+
+    for field in Availability.FIELDS:
+        form_field = getattr(form, field)
+
+        if not availability.is_available(field, form_field.data, user):
+            form_field.errors.append("Already taken.")
+            available = False
+
+    return available
@@ -0,0 +1,103 @@
+"""Move an existing database onto snowflake message ids.
+
+Databases created before messages had time-sortable ids have an integer
+`messages.id` fed by a sequence, and every row written by one process may
+share the same (import-time) timestamp. This script, run once:
+
+- widens messages.id and likes.message_id to BIGINT
+- re-keys every message to a snowflake id derived from its timestamp
+  (ties broken by the old id, so insertion order is kept)
+- points likes at the new ids
+- switches messages.timestamp to a database-side default
+- adds the (user_id, id) feed index
+
+This is the offline way to do it: it runs in a single transaction, so it
+either all happens or none does, but it rewrites both tables under an
+exclusive lock, so stop the site first. Migration 0001 (migrations.py)
+does the same re-key in batches while the site is up, and is what to use
+normally. After running this script, record that 0001 is done:
+
+    python backfill_message_ids.py
+    python migrations.py stamp 0001_snowflake_message_ids
+"""
+
+from app import create_app
+from models import db
+from snowflake import WARBLER_EPOCH_MS, TIMESTAMP_SHIFT
+
+STATEMENTS = [
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey",
+    "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT",
+    "DROP SEQUENCE IF EXISTS messages_id_seq",
+    "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT",
+    "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT",
+
+    # The low 22 bits (worker + sequence) number the rows within each
+    # millisecond; old rows all predate any live worker, so they can
+    # use the whole space.
+    f"""
+    CREATE TEMP TABLE message_id_map ON COMMIT DROP AS
+    SELECT id AS old_id,
+           ((floor(extract(epoch FROM timestamp) * 1000)::bigint
+             - {WARBLER_EPOCH_MS}) << {TIMESTAMP_SHIFT})
+           | ((row_number() OVER (
+                 PARTITION BY date_trunc('milliseconds', timestamp)
+                 ORDER BY id) - 1) % {1 << TIMESTAMP_SHIFT}) AS new_id
+    FROM messages
+    """,
+    "CREATE INDEX ON message_id_map (old_id)",
+
+    """
+    UPDATE messages SET id = m.new_id
+    FROM message_id_map m WHERE messages.id = m.old_id
+    """,
+    """
+    UPDATE likes SET message_id = m.new_id
+    FROM message_id_map m WHERE likes.message_id = m.old_id
+    """,
+
+    """
+    ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey
+    FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE
+    """,
+    """
+    ALTER TABLE messages ALTER COLUMN timestamp
+    SET DEFAULT timezone('utc', now())
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_messages_user_id_id
+    ON messages (user_id, id)
+    """,
+]
+
+
+# The same id for one row `t`, numbered among its millisecond's rows by
+# counting the older ones rather than with a window over the table, so
+# migrations.py can fill it in a batch at a time.
+ROW_SNOWFLAKE_ID = f"""
+    ((floor(extract(epoch FROM t.timestamp) * 1000)::bigint
+      - {WARBLER_EPOCH_MS}) << {TIMESTAMP_SHIFT})
+    | ((SELECT count(*) FROM messages m
+        WHERE m.timestamp >= date_trunc('milliseconds', t.timestamp)
+          AND m.timestamp < date_trunc('milliseconds', t.timestamp)
+                            + interval '1 millisecond'
+          AND m.id < t.id) % {1 << TIMESTAMP_SHIFT})
+"""
+
+
+def backfill_message_ids(engine):
+    """Run the backfill against `engine` in one transaction."""
+
+    with engine.begin() as conn:
+        for statement in STATEMENTS:
+            conn.execute(db.text(statement))
+
+        count = conn.execute(db.text("SELECT count(*) FROM messages")).scalar()
+
+    return count
+
+
+if __name__ == '__main__':
+    create_app()
+    count = backfill_message_ids(db.engine)
+    print(f"Re-keyed {count} messages.")
@@ -0,0 +1,117 @@
+"""Compare how the WSGI and ASGI entry points hold up under concurrency.
+
+Start both against the same database with the same number of workers:
+
+    gunicorn --workers 4 --bind :8000 app:app
+    uvicorn asgi:app --workers 4 --port 8001
+
+then point this at them:
+
+    python bench_concurrency.py http://localhost:8000 http://localhost:8001 \\
+        --path /users/1 --concurrency 1,8,32,128 --duration 10
+
+For every server and concurrency level it prints throughput, latency
+percentiles and errors. A sync worker serves one request at a time, so
+WSGI throughput flattens once concurrency passes the worker count and the
+extra requests just queue; the ASGI server keeps scaling until the
+connection pool or the CPU runs out.
+
+Pass --cookie with a session cookie (copied from a browser) to bench the
+logged-in timeline. Uses only the standard library.
+"""
+
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(host, port, path, cookie):
+    """GET `path` over a fresh connection; return the status code."""
+
+    reader, writer = await asyncio.open_connection(host, port)
+
+    headers = [f"GET {path} HTTP/1.1", f"Host: {host}", "Connection: close"]
+    if cookie:
+        headers.append(f"Cookie: session={cookie}")
+
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+    await writer.drain()
+
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+
+    return int(status_line.split()[1])
+
+
+async def run_level(base_url, path, concurrency, duration, cookie):
+    """Keep `concurrency` requests in flight for `duration` seconds."""
+
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+
+            try:
+                status = await fetch(host, port, path, cookie)
+            except OSError:
+                status = None
+
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    return latencies, errors
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float('nan')
+
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('servers', nargs='+',
+                        help="base URLs, e.g. http://localhost:8000")
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--concurrency', default='1,8,32,128',
+                        help="comma-separated concurrency levels")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds per level")
+    parser.add_argument('--cookie', help="Flask session cookie value")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    print(f"{'server':<28} {'conc':>5} {'req/s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+
+    for server in args.servers:
+        for concurrency in levels:
+            latencies, errors = asyncio.run(run_level(
+                server, args.path, concurrency, args.duration, args.cookie))
+            latencies.sort()
+
+            print(f"{server:<28} {concurrency:>5} "
+                  f"{len(latencies) / args.duration:>9.1f} "
+                  f"{percentile(latencies, 50) * 1000:>8.1f} "
+                  f"{percentile(latencies, 99) * 1000:>8.1f} "
+                  f"{errors:>7}")
+
+
+if __name__ == '__main__':
+    main()
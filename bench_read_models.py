@@ -0,0 +1,171 @@
+"""Compare the read models with loading ORM instances, in CPU and memory.
+
+    python bench_read_models.py [--repeat 20]
+
+Runs against the database of the WARBLER_CONFIG profile, in a transaction
+it rolls back at the end: it makes a user with FOLLOWERS followers and
+TIMELINE warbles, then loads two pages both ways, reading the fields the
+templates read:
+
+    timeline    the warbles with their authors: Message instances with
+                joinedload(Message.user), against feed.hydrate
+    followers   a card for every follower: User.followers, against
+                readmodels.user_cards
+
+For each it prints the median CPU time of a load, the peak Python memory
+while loading and what's still held once the page's data is loaded
+(tracemalloc; the ORM side includes the session's identity map). hydrate
+also counts likes, which the ORM side doesn't, so the timeline numbers
+flatter the ORM.
+"""
+
+import argparse
+import statistics
+import time
+import tracemalloc
+
+from app import create_app
+from feed import hydrate
+from models import db, User, Message, Follows
+from readmodels import CARD_COLUMNS, user_cards
+from snowflake import next_message_id
+
+TIMELINE = 100
+FOLLOWERS = 10000
+
+# What a bcrypt hash looks like, so ORM users are as big as real ones.
+PASSWORD = "$2b$12$" + "x" * 53
+
+
+def make_data():
+    """Add the user, their followers and warbles; return (user id, ids)."""
+
+    user = User(username="bench-user", email="bench-user@test.com",
+                password=PASSWORD)
+    db.session.add(user)
+    db.session.flush()
+
+    db.session.execute(
+        db.text("""
+        INSERT INTO users (username, email, password, bio, location)
+        SELECT 'bench-' || n, 'bench-' || n || '@test.com', :password,
+               'Followed by nobody, following bench-user.', 'Nowhere'
+        FROM generate_series(1, :n) AS n
+        """),
+        {'password': PASSWORD, 'n': FOLLOWERS})
+
+    db.session.execute(
+        db.text("""
+        INSERT INTO follows (user_being_followed_id, user_following_id)
+        SELECT :id, id FROM users WHERE username LIKE 'bench-%' AND id != :id
+        """),
+        {'id': user.id})
+
+    message_ids = [next_message_id() for i in range(TIMELINE)]
+    db.session.execute(
+        Message.__table__.insert(),
+        [{'id': id, 'text': f"warble {i} " * 10, 'user_id': user.id}
+         for i, id in enumerate(message_ids)])
+
+    return user.id, message_ids[::-1]
+
+
+def timeline_orm(message_ids):
+    messages = (Message.query
+                .options(db.joinedload(Message.user))
+                .filter(Message.id.in_(message_ids))
+                .order_by(Message.id.desc())
+                .all())
+
+    for msg in messages:
+        (msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+         msg.user.image_url)
+
+    return messages
+
+
+def timeline_read_model(message_ids):
+    messages = hydrate(message_ids)
+
+    for msg in messages:
+        (msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+         msg.user.image_url, msg.like_count)
+
+    return messages
+
+
+def followers_orm(user_id):
+    followers = User.query.get(user_id).followers
+
+    for user in followers:
+        (user.id, user.username, user.image_url, user.header_image_url,
+         user.bio)
+
+    return followers
+
+
+def followers_read_model(user_id):
+    followers = user_cards(
+        db.select(CARD_COLUMNS)
+        .select_from(User.__table__.join(
+            Follows.__table__, Follows.user_following_id == User.id))
+        .where(Follows.user_being_followed_id == user_id)
+        .order_by(Follows.user_following_id))
+
+    for user in followers:
+        (user.id, user.username, user.image_url, user.header_image_url,
+         user.bio)
+
+    return followers
+
+
+def measure(load, arg, repeat):
+    """(median CPU seconds, peak bytes, held bytes) of load(arg)."""
+
+    times = []
+    for i in range(repeat):
+        db.session.expunge_all()
+        start = time.process_time()
+        load(arg)
+        times.append(time.process_time() - start)
+
+    db.session.expunge_all()
+    tracemalloc.start()
+    page = load(arg)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del page
+
+    return statistics.median(times), peak, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        try:
+            user_id, message_ids = make_data()
+
+            benches = [
+                (f"timeline ({TIMELINE})", message_ids,
+                 timeline_orm, timeline_read_model),
+                (f"followers ({FOLLOWERS})", user_id,
+                 followers_orm, followers_read_model),
+            ]
+
+            print(f"{'page':<18}{'loader':<12}{'cpu ms':>10}"
+                  f"{'peak KiB':>12}{'held KiB':>12}")
+
+            for name, arg, orm, read_model in benches:
+                for label, load in (("orm", orm), ("read model", read_model)):
+                    cpu, peak, held = measure(load, arg, args.repeat)
+                    print(f"{name:<18}{label:<12}{cpu * 1000:>10.2f}"
+                          f"{peak / 1024:>12.0f}{held / 1024:>12.0f}")
+        finally:
+            db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
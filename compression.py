@@ -0,0 +1,199 @@
+"""gzip and brotli for responses, negotiated on Accept-Encoding.
+
+Dynamic responses (a timeline is a hundred near-identical <li>s, which
+compress about tenfold) are compressed per request when they're at least
+COMPRESS_MIN_BYTES of one of COMPRESS_MIMETYPES, at COMPRESS_GZIP_LEVEL
+or COMPRESS_BROTLI_QUALITY; low settings, since this is paid on every
+response. Streamed responses (exports) and files are left alone.
+
+Static text assets are compressed once, at build time, at the highest
+settings:
+
+    python compression.py build
+
+writes a .gz and a .br next to each STATIC_SUFFIXES file under static/
+that's worth it, and the static view serves those siblings as they are
+to clients that accept them. Without a build the originals are served
+uncompressed. Images (jpg, png) are compressed formats already and are
+served as-is.
+
+brotli is optional: without the Brotli package only gzip is offered.
+"""
+
+import gzip
+import importlib.util
+import mimetypes
+import os
+import sys
+
+from flask import request, send_from_directory
+from werkzeug.http import parse_accept_header
+from werkzeug.security import safe_join
+
+# Found without importing it; it's only loaded to compress something.
+HAVE_BROTLI = importlib.util.find_spec('brotli') is not None
+
+# Best first.
+ENCODINGS = ('br', 'gzip') if HAVE_BROTLI else ('gzip',)
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+STATIC_SUFFIXES = ('.css', '.js', '.svg', '.json', '.txt', '.ico')
+
+
+def choose_encoding(accept_encoding, encodings=ENCODINGS):
+    """The best of `encodings` an Accept-Encoding header allows, or None."""
+
+    accept = parse_accept_header(accept_encoding)
+
+    for encoding in encodings:
+        if accept.quality(encoding) > 0:
+            return encoding
+
+    return None
+
+
+def compress(data, encoding, gzip_level=9, brotli_quality=11):
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data, quality=brotli_quality)
+
+    # mtime=0: the same input always gives the same bytes
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+class Compression:
+    """Compresses dynamic responses and serves pre-compressed static files."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['COMPRESS']
+        self.min_bytes = app.config['COMPRESS_MIN_BYTES']
+        self.gzip_level = app.config['COMPRESS_GZIP_LEVEL']
+        self.brotli_quality = app.config['COMPRESS_BROTLI_QUALITY']
+        self.mimetypes = set(app.config['COMPRESS_MIMETYPES'])
+        self.app = app
+        app.extensions['compression'] = self
+
+        if self.enabled:
+            app.after_request(self.compress_response)
+            app.view_functions['static'] = self.send_static_file
+
+    def compress_body(self, body, mimetype, accept_encoding):
+        """(body, Content-Encoding or None) for a dynamic response body."""
+
+        if (not self.enabled or mimetype not in self.mimetypes
+                or len(body) < self.min_bytes):
+            return body, None
+
+        encoding = choose_encoding(accept_encoding)
+
+        if encoding is None:
+            return body, None
+
+        return compress(body, encoding, self.gzip_level,
+                        self.brotli_quality), encoding
+
+    def compress_response(self, resp):
+        if (resp.direct_passthrough or resp.is_streamed
+                or resp.status_code < 200 or resp.status_code in (204, 304)
+                or 'Content-Encoding' in resp.headers
+                or resp.mimetype not in self.mimetypes):
+            return resp
+
+        resp.vary.add('Accept-Encoding')
+
+        body, encoding = self.compress_body(
+            resp.get_data(), resp.mimetype,
+            request.headers.get('Accept-Encoding'))
+
+        if encoding:
+            resp.set_data(body)
+            resp.headers['Content-Encoding'] = encoding
+
+        return resp
+
+    def send_static_file(self, filename):
+        """Flask's static view, but sending a .br/.gz sibling if there's one.
+
+        Siblings older than their original are stale and ignored.
+        """
+
+        folder = self.app.static_folder
+        path = safe_join(folder, filename)
+        encodings = []
+
+        if path is not None and os.path.isfile(path):
+            mtime = os.path.getmtime(path)
+            encodings = [
+                encoding for encoding in ENCODINGS
+                if os.path.isfile(path + SUFFIXES[encoding])
+                and os.path.getmtime(path + SUFFIXES[encoding]) >= mtime]
+
+        encoding = encodings and choose_encoding(
+            request.headers.get('Accept-Encoding'), encodings)
+
+        if not encoding:
+            return self.app.send_static_file(filename)
+
+        resp = send_from_directory(
+            folder, filename + SUFFIXES[encoding],
+            mimetype=mimetypes.guess_type(filename)[0],
+            cache_timeout=self.app.get_send_file_max_age(filename))
+        resp.headers['Content-Encoding'] = encoding
+        resp.vary.add('Accept-Encoding')
+
+        return resp
+
+
+def build_static(folder):
+    """Write .gz/.br siblings for the text assets under `folder`.
+
+    Skips siblings that are up to date, and doesn't write one that's no
+    smaller than its original. Returns the paths written.
+    """
+
+    written = []
+
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            if not filename.endswith(STATIC_SUFFIXES):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            mtime = os.path.getmtime(path)
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            for encoding in ENCODINGS:
+                target = path + SUFFIXES[encoding]
+
+                if (os.path.exists(target)
+                        and os.path.getmtime(target) >= mtime):
+                    continue
+
+                compressed = compress(data, encoding)
+
+                if len(compressed) >= len(data):
+                    continue
+
+                with open(target + '.tmp', 'wb') as f:
+                    f.write(compressed)
+
+                os.replace(target + '.tmp', target)
+                written.append(target)
+
+    return written
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['build']:
+        sys.exit(__doc__)
+
+    static = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+    for path in build_static(static):
+        print(path)
@@ -0,0 +1,190 @@
+"""Configuration profiles for Warbler.
+
+Pick one by name with create_app('prod'), or through the WARBLER_CONFIG
+environment variable. DATABASE_URL and SECRET_KEY, when set in the
+environment, override whatever the profile says.
+"""
+
+import os
+import tempfile
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgres:///warbler'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    SECRET_KEY = "it's a secret"
+
+    # Install flask_debugtoolbar at all? (It then still only shows up when
+    # app.debug is on.)
+    DEBUG_TOOLBAR = False
+
+    # Compile templates, configure mappers and check the database in
+    # create_app, so pre-forking servers do it once in the master.
+    WARMUP = False
+
+    # Where Jinja keeps compiled templates on disk, shared by every worker
+    # on the host; None keeps them in memory only.
+    TEMPLATE_BYTECODE_CACHE_DIR = None
+
+    # Time every template and block render (see template_profiling.py).
+    PROFILE_TEMPLATES = False
+
+    # gzip/brotli (see compression.py): HTML/CSS/JSON responses of at
+    # least COMPRESS_MIN_BYTES are compressed per request, cheaply;
+    # static files are served from the .gz/.br siblings written by
+    # `python compression.py build`.
+    COMPRESS = True
+    COMPRESS_MIN_BYTES = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    COMPRESS_MIMETYPES = (
+        'text/html', 'text/css', 'text/plain', 'text/javascript',
+        'application/javascript', 'application/json', 'image/svg+xml')
+
+    # Seconds anonymous visitors are served the same rendered homepage,
+    # profile or warble (see microcache.py); 0 turns it off.
+    MICROCACHE_TTL = 2
+    MICROCACHE_MAX_ENTRIES = 1000
+
+    # Sample individual requests' stacks into flamegraph files (see
+    # profiling.py): requests sending a signed X-Profile header, and a
+    # random PROFILE_SAMPLE_RATE of the rest. The newest PROFILE_KEEP
+    # profiles are kept in PROFILE_DIR.
+    PROFILE_REQUESTS = False
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_INTERVAL = 0.005
+    PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'warbler-profiles')
+    PROFILE_KEEP = 200
+    PROFILE_TOKEN_MAX_AGE = 3600
+
+    # How many proxies in front of the app add to X-Forwarded-For and
+    # X-Forwarded-Proto. The client address (which the login throttle
+    # counts attempts by) is taken from that many hops back; 0 trusts
+    # neither header, and the client is whoever connected.
+    PROXY_HOPS = 0
+
+    # Login/signup attempt limits (see throttle.py), as
+    # (burst capacity, tokens refilled per second).
+    LOGIN_THROTTLE = True
+    LOGIN_THROTTLE_STORE = 'memory'
+    LOGIN_THROTTLE_PER_IP = (20, 20 / 60)
+    LOGIN_THROTTLE_PER_USERNAME = (5, 1 / 60)
+
+    # Avatar/header thumbnails (see thumbnails.py): where they're cached,
+    # how big the cache may grow, and limits on fetching source images.
+    THUMBNAIL_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), 'warbler-thumbnails')
+    THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+    THUMBNAIL_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+    THUMBNAIL_FETCH_TIMEOUT = 5
+
+    # The follow graph snapshot workers map (see followgraph.py), written
+    # by `python followgraph.py build`; None looks follows up in the
+    # database. Workers read newer follows at most every
+    # FOLLOW_GRAPH_SYNC_INTERVAL seconds.
+    FOLLOW_GRAPH_PATH = os.path.join(
+        tempfile.gettempdir(), 'warbler-follow-graph')
+    FOLLOW_GRAPH_SYNC_INTERVAL = 1.0
+
+    # Username/e-mail availability checks (see availability.py): the
+    # share of free names the Bloom filter calls maybe-taken (each costs
+    # a query), and how often, in seconds, it reads in other workers'
+    # signups and is rebuilt from scratch.
+    AVAILABILITY_ERROR_RATE = 0.01
+    AVAILABILITY_REFRESH_INTERVAL = 5
+    AVAILABILITY_REBUILD_INTERVAL = 3600
+
+    # How far back, in seconds, each refresh looks again for signups
+    # that committed after a higher user id had already been read.
+    AVAILABILITY_REFRESH_LOOKBACK = 60
+
+    # Lease each process's snowflake worker id from the database (see
+    # snowflake.py) when WARBLER_WORKER_ID doesn't set one, rather than
+    # deriving it from the pid, which two hosts can share.
+    LEASE_WORKER_IDS = False
+
+    # Bearer token for POST /api/messages/bulk (see ingest.py); None
+    # turns the endpoint off. INGEST_TOKEN in the environment overrides.
+    INGEST_TOKEN = None
+
+    # Bearer token for GET /_debug/jobs (see jobs.py); None turns the
+    # endpoint off. STATS_TOKEN in the environment overrides.
+    STATS_TOKEN = None
+
+
+class DevConfig(Config):
+    """Local development: debug toolbar on, templates reloaded on change."""
+
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+    TEMPLATES_AUTO_RELOAD = True
+
+    PROFILE_TEMPLATES = True
+
+
+class TestConfig(Config):
+    """The test suite."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler-test'
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+
+    # view tests check the status code of error pages
+    PROPAGATE_EXCEPTIONS = False
+
+    # cheap hashes for the many signups in test setUps
+    BCRYPT_LOG_ROUNDS = 4
+
+    # every test logs in from 127.0.0.1
+    LOGIN_THROTTLE = False
+
+    # view tests change data and look again straight away
+    MICROCACHE_TTL = 0
+
+    THUMBNAIL_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), 'warbler-test-thumbnails')
+
+    PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'warbler-test-profiles')
+
+    # view tests roll their follows back, so the log never sees them
+    FOLLOW_GRAPH_PATH = None
+
+    # rolled-back tests leave names in the filter and reuse user ids
+    AVAILABILITY_REBUILD_INTERVAL = 0
+
+
+class ProdConfig(Config):
+    """Production: no toolbar, a real SECRET_KEY, warm before forking."""
+
+    # must come from the environment
+    SECRET_KEY = None
+
+    # the session cookie only goes over HTTPS, and not on cross-site posts
+    SESSION_COOKIE_SECURE = True
+    SESSION_COOKIE_SAMESITE = 'Lax'
+
+    WARMUP = True
+
+    TEMPLATE_BYTECODE_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), 'warbler-jinja-cache')
+
+    # behind the load balancer
+    PROXY_HOPS = 1
+
+    LOGIN_THROTTLE_STORE = 'database'
+
+    LEASE_WORKER_IDS = True
+
+    # only for requests with a signed X-Profile header
+    PROFILE_REQUESTS = True
+
+
+PROFILES = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
@@ -0,0 +1,138 @@
+"""Streaming a user's data out as NDJSON or CSV.
+
+An account's history can be far bigger than anything a page shows, so
+the export never holds more than one batch of it. Each table is read
+through a server-side cursor (psycopg2 named cursor), FETCH_SIZE rows at
+a time, and every batch is written to the response as soon as it's
+fetched: memory stays flat however big the account is, and the first
+bytes go out before the last rows are read.
+
+Every record has the same fields:
+
+    type        message | following | follower | like
+    id          the message's id (messages and likes)
+    user_id     the author, or the other side of a follow
+    text        the message's text
+    created_at  when it was posted or liked
+"""
+
+import csv
+import io
+import json
+
+from flask import Response, stream_with_context
+
+from models import (
+    db, Message, ArchivedMessage, Follows, Likes, ArchivedLike)
+
+FETCH_SIZE = 1000
+
+FIELDS = ('type', 'id', 'user_id', 'text', 'created_at')
+
+
+def record_queries(user_id):
+    """(type, SELECT id, user_id, text, created_at) for each kind of record."""
+
+    queries = []
+
+    for model in (Message, ArchivedMessage):
+        messages = model.__table__
+        queries.append(('message', db.select([
+            messages.c.id, messages.c.user_id, messages.c.text,
+            messages.c.timestamp,
+        ]).where(messages.c.user_id == user_id)))
+
+    follows = Follows.__table__
+    queries.append(('following', db.select([
+        db.null(), follows.c.user_being_followed_id, db.null(), db.null(),
+    ]).where(follows.c.user_following_id == user_id)))
+    queries.append(('follower', db.select([
+        db.null(), follows.c.user_following_id, db.null(), db.null(),
+    ]).where(follows.c.user_being_followed_id == user_id)))
+
+    for model in (Likes, ArchivedLike):
+        likes = model.__table__
+        queries.append(('like', db.select([
+            likes.c.message_id, db.null(), db.null(), likes.c.created_at,
+        ]).where(likes.c.user_id == user_id)))
+
+    return queries
+
+
+def record_batches(user_id):
+    """Yield (type, rows) batches of at most FETCH_SIZE records."""
+
+    conn = db.session.connection().execution_options(stream_results=True)
+
+    for type, query in record_queries(user_id):
+        result = conn.execute(query)
+
+        try:
+            while True:
+                rows = result.fetchmany(FETCH_SIZE)
+
+                if not rows:
+                    break
+
+                yield type, rows
+        finally:
+            result.close()
+
+
+def values(type, row):
+    """A record's FIELDS, as strings and numbers."""
+
+    id, user_id, text, created_at = row
+
+    return (type, id, user_id, text,
+            created_at.isoformat() if created_at else None)
+
+
+def ndjson_chunks(batches):
+    """One JSON object per line; fields with no value are left out."""
+
+    for type, rows in batches:
+        yield "".join(
+            json.dumps({field: value
+                        for field, value in zip(FIELDS, values(type, row))
+                        if value is not None}) + "\n"
+            for row in rows)
+
+
+def csv_chunks(batches):
+    """A header row, then a row per record."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    writer.writerow(FIELDS)
+    yield flush()
+
+    for type, rows in batches:
+        writer.writerows(values(type, row) for row in rows)
+        yield flush()
+
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_chunks),
+    'csv': ('text/csv', csv_chunks),
+}
+
+
+def export_response(user_id, format='ndjson'):
+    """A streamed download of everything `user_id` has posted, followed
+    and liked, in one of FORMATS."""
+
+    mimetype, chunks = FORMATS[format]
+
+    return Response(
+        stream_with_context(chunks(record_batches(user_id))),
+        mimetype=mimetype,
+        headers={'Content-Disposition':
+                 f'attachment; filename=warbler-{user_id}.{format}'})
@@ -0,0 +1,97 @@
+"""Turning a page of message ids into rows the templates can render.
+
+Every page that lists warbles -- home, profiles, likes and a single
+warble -- first works out which message ids to show, then hands them to
+hydrate(). That fetches, in one query, each message with its author's
+display fields, its like count and whether the viewer liked it, as plain
+named tuples: no ORM identity map, no lazy loads while rendering.
+"""
+
+from collections import namedtuple
+
+from models import db, User, Message, ArchivedMessage, Likes, ArchivedLike
+
+# What a feed shows of a warble's author; enough for thumbnail_url.
+Author = namedtuple('Author', 'id username image_url')
+
+FeedMessage = namedtuple(
+    'FeedMessage', 'id text timestamp user_id user like_count liked '
+    'reply_count')
+
+
+def feed_select(viewer_id=None, archived=False):
+    """Feed rows of every warble, unordered; narrow it down with where().
+
+    `viewer_id` may be a bindparam (asgi.py binds its own).
+    """
+
+    messages = (ArchivedMessage if archived else Message).__table__
+    likes = (ArchivedLike if archived else Likes).__table__
+    users = User.__table__
+
+    like_count = (db.select([db.func.count()])
+                  .where(likes.c.message_id == messages.c.id)
+                  .as_scalar())
+
+    if viewer_id is None:
+        liked = db.false()
+    else:
+        liked = db.exists().where(db.and_(
+            likes.c.message_id == messages.c.id,
+            likes.c.user_id == viewer_id))
+
+    return (db.select([
+                messages.c.id,
+                messages.c.text,
+                messages.c.timestamp,
+                messages.c.user_id,
+                users.c.username,
+                users.c.image_url,
+                like_count.label('like_count'),
+                liked.label('liked'),
+                messages.c.reply_count,
+            ])
+            .select_from(messages.join(users,
+                                       users.c.id == messages.c.user_id)))
+
+
+def hydration_query(message_ids, viewer_id=None, archived=False):
+    """The SELECT behind hydrate(); unordered."""
+
+    messages = (ArchivedMessage if archived else Message).__table__
+
+    return (feed_select(viewer_id, archived)
+            .where(messages.c.id.in_(message_ids)))
+
+
+def hydrate(message_ids, viewer_id=None, archived=False):
+    """FeedMessages for `message_ids`, in the order given.
+
+    `liked` is whether `viewer_id` liked each one (always False with no
+    viewer). Pass archived=True for ids from the archive tier. Ids that
+    don't exist are skipped.
+    """
+
+    message_ids = list(message_ids)
+
+    if not message_ids:
+        return []
+
+    rows = db.session.execute(
+        hydration_query(message_ids, viewer_id, archived))
+
+    by_id = {
+        row.id: FeedMessage(
+            id=row.id,
+            text=row.text,
+            timestamp=row.timestamp,
+            user_id=row.user_id,
+            user=Author(row.user_id, row.username, row.image_url),
+            like_count=row.like_count,
+            liked=row.liked,
+            reply_count=row.reply_count,
+        )
+        for row in rows
+    }
+
+    return [by_id[id] for id in message_ids if id in by_id]
@@ -0,0 +1,297 @@
+"""Who follows whom, from a file every worker on the host maps.
+
+The home feed starts from the set of users the viewer follows, and every
+follow button asks whether the viewer follows someone. Rather than each
+worker asking Postgres for those on every request, the follow graph is
+kept in a snapshot file that workers map read-only (mmap): the OS holds
+one copy in the page cache however many workers use it, and a lookup is
+a slice of it. The file is the follows in CSR form, by follower id:
+
+    header     MAGIC, array lengths, the transaction snapshot it was read at
+    offsets    int64 * (max user id + 2); user u follows
+               targets[offsets[u]:offsets[u + 1]]
+    targets    int32, the followed ids, sorted for each follower
+
+so "does u follow v" is a binary search in u's slice.
+
+Follows made and undone since the snapshot come from `follow_changes`,
+logged by a trigger on `follows` (models.FOLLOW_CHANGES_DDL). At most
+every FOLLOW_GRAPH_SYNC_INTERVAL seconds a worker reads the changes it
+hasn't seen into a small overlay of per-user additions and removals.
+What's been seen is tracked by transaction snapshot, not by change id,
+so a change whose transaction commits late isn't skipped. A worker sees
+its own follows on its next lookup (the views call expire()), other
+workers' within FOLLOW_GRAPH_SYNC_INTERVAL.
+
+Rebuild the snapshot from cron every few minutes (on each web host):
+
+    python followgraph.py build
+
+The new file replaces the old with a rename, and workers map it at their
+next sync. Building also prunes the changes the previous snapshot had
+seen. Until there's a snapshot (or with FOLLOW_GRAPH_PATH unset),
+lookups go to the database.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import accumulate
+
+from sqlalchemy import text
+
+from models import db, Follows
+
+MAGIC = b'WFGRAPH1'
+
+# magic, len(offsets), len(targets), length of the txid snapshot text
+HEADER = struct.Struct('=8sqqq')
+
+FOLLOWS = text("""
+SELECT user_following_id, array_agg(user_being_followed_id
+                                    ORDER BY user_being_followed_id)
+FROM follows
+GROUP BY user_following_id
+ORDER BY user_following_id
+""")
+
+# The changes a worker hasn't seen, with the snapshot they're read at
+# (to not see them again); evaluated together, so nothing committing in
+# between is missed.
+CHANGES = text("""
+SELECT txid_current_snapshot()::text AS seen,
+       c.user_following_id, c.user_being_followed_id, c.followed
+FROM (SELECT 1) AS one
+LEFT JOIN follow_changes AS c
+  ON c.xid >= txid_snapshot_xmin(CAST(:seen AS txid_snapshot))
+ AND NOT txid_visible_in_snapshot(c.xid, CAST(:seen AS txid_snapshot))
+ORDER BY c.id
+""")
+
+PRUNE = text("""
+DELETE FROM follow_changes
+WHERE xid < txid_snapshot_xmax(CAST(:seen AS txid_snapshot))
+  AND txid_visible_in_snapshot(xid, CAST(:seen AS txid_snapshot))
+""")
+
+
+def _aligned(offset):
+    return offset + -offset % 8
+
+
+def build_snapshot(engine, path):
+    """Write the follow graph to `path`. Returns (follows, changes pruned)."""
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='REPEATABLE READ')
+
+        with conn.begin():
+            seen = conn.execute(
+                text("SELECT txid_current_snapshot()::text")).scalar()
+            max_id = conn.execute(
+                text("SELECT coalesce(max(id), 0) FROM users")).scalar()
+
+            counts = array('q', bytes(8 * (max_id + 2)))
+            targets = array('i')
+
+            for follower_id, followed_ids in conn.execute(FOLLOWS):
+                counts[follower_id + 1] = len(followed_ids)
+                targets.extend(followed_ids)
+
+    offsets = array('q', accumulate(counts))
+    seen_bytes = seen.encode()
+
+    try:
+        previous = Snapshot(path).seen
+    except (OSError, ValueError):
+        previous = seen
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(offsets), len(targets),
+                            len(seen_bytes)))
+        f.write(seen_bytes)
+        f.write(bytes(_aligned(f.tell()) - f.tell()))
+        f.write(offsets.tobytes())
+        f.write(targets.tobytes())
+    os.replace(tmp, path)
+
+    # workers still on the previous snapshot need what it hadn't seen
+    with engine.begin() as conn:
+        pruned = conn.execute(PRUNE, seen=previous).rowcount
+
+    return len(targets), pruned
+
+
+class Snapshot:
+    """A snapshot file, mapped read-only."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # which file this is, to notice when it's been replaced
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+
+        magic, n_offsets, n_targets, seen_length = HEADER.unpack_from(
+            self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a follow graph snapshot")
+
+        start = HEADER.size
+        self.seen = self._map[start:start + seen_length].decode()
+
+        view = memoryview(self._map)
+        start = _aligned(start + seen_length)
+        self.offsets = view[start:start + 8 * n_offsets].cast('q')
+        start += 8 * n_offsets
+        self.targets = view[start:start + 4 * n_targets].cast('i')
+
+    def following(self, user_id):
+        """The sorted ids `user_id` follows, as a slice of the file."""
+
+        if user_id + 1 >= len(self.offsets):
+            return self.targets[0:0]
+
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    def is_following(self, follower_id, followed_id):
+        following = self.following(follower_id)
+        i = bisect_left(following, followed_id)
+        return i < len(following) and following[i] == followed_id
+
+
+class FollowGraph:
+    """Follow lookups off the shared snapshot, kept current per worker."""
+
+    def __init__(self, app=None):
+        self.snapshot = None
+        self._added = defaultdict(set)
+        self._removed = defaultdict(set)
+        self._seen = None
+        self._synced_at = None
+        self._lock = threading.RLock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['FOLLOW_GRAPH_PATH']
+        self.sync_interval = app.config['FOLLOW_GRAPH_SYNC_INTERVAL']
+        app.extensions['follow_graph'] = self
+
+    def expire(self):
+        """Have the next lookup read changes, like this request's."""
+
+        self._synced_at = None
+
+    def sync(self):
+        """Map a new snapshot if there is one, then read changes.
+
+        Only every sync_interval seconds, unless expired. Returns whether
+        there's a snapshot to look things up in.
+        """
+
+        if not self.path:
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            if (self._synced_at is not None
+                    and now - self._synced_at < self.sync_interval):
+                return self.snapshot is not None
+
+            self._synced_at = now
+
+            try:
+                identity = os.stat(self.path)
+            except FileNotFoundError:
+                self.snapshot = None
+                return False
+
+            identity = (identity.st_ino, identity.st_mtime_ns)
+            if self.snapshot is None or self.snapshot.identity != identity:
+                self.snapshot = Snapshot(self.path)
+                self._seen = self.snapshot.seen
+                self._added.clear()
+                self._removed.clear()
+
+            with db.engine.connect() as conn:
+                rows = conn.execute(CHANGES, seen=self._seen).fetchall()
+
+            self._seen = rows[0].seen
+
+            for row in rows:
+                if row.followed is None:
+                    continue
+
+                follower_id = row.user_following_id
+                followed_id = row.user_being_followed_id
+
+                if row.followed:
+                    self._removed[follower_id].discard(followed_id)
+                    self._added[follower_id].add(followed_id)
+                else:
+                    self._added[follower_id].discard(followed_id)
+                    self._removed[follower_id].add(followed_id)
+
+            return True
+
+    def following(self, user_id):
+        """The set of ids `user_id` follows."""
+
+        if not self.sync():
+            return {id for id, in (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))}
+
+        with self._lock:
+            ids = set(self.snapshot.following(user_id))
+            ids -= self._removed.get(user_id, set())
+            ids |= self._added.get(user_id, set())
+            return ids
+
+    def _is_following(self, follower_id, followed_id):
+        if followed_id in self._added.get(follower_id, ()):
+            return True
+        if followed_id in self._removed.get(follower_id, ()):
+            return False
+        return self.snapshot.is_following(follower_id, followed_id)
+
+    def relationships(self, viewer_id, user_ids):
+        """Like Follows.relationships: (followed by the viewer, following
+        the viewer) among `user_ids`."""
+
+        if not self.sync():
+            return Follows.relationships(viewer_id, user_ids)
+
+        with self._lock:
+            user_ids = set(user_ids)
+            following = {id for id in user_ids
+                         if self._is_following(viewer_id, id)}
+            followers = {id for id in user_ids
+                         if self._is_following(id, viewer_id)}
+            return following, followers
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    app = create_app()
+    path = app.config['FOLLOW_GRAPH_PATH']
+
+    if sys.argv[1:] != ['build'] or not path:
+        sys.exit(__doc__)
+
+    with app.app_context():
+        follows, pruned = build_snapshot(db.engine, path)
+
+    print(f"{path}: {follows} follows; {pruned} changes pruned")
@@ -9,6 +9,12 @@ class MessageForm(FlaskForm):
     text = TextAreaField('text', validators=[DataRequired()])
 
 
+class FollowImportForm(FlaskForm):
+    """Form for following many users at once."""
+
+    usernames = TextAreaField('Usernames', validators=[DataRequired()])
+
+
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
@@ -0,0 +1,27 @@
+"""gunicorn settings for production.
+
+    gunicorn -c gunicorn.conf.py
+
+The app is built (and warmed up, see app.warmup) once in the master
+before the workers fork, so each worker starts with compiled templates
+and configured mappers instead of paying for them on its first request.
+"""
+
+import os
+
+os.environ.setdefault('WARBLER_CONFIG', 'prod')
+
+wsgi_app = 'app:app'
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+
+
+def post_fork(server, worker):
+    """Give each new worker its own warm database pool and worker id."""
+
+    from app import app, open_pool
+    from snowflake import next_message_id
+
+    open_pool(app)
+    next_message_id.claim()
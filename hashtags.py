@@ -0,0 +1,113 @@
+"""#hashtags and @mentions, indexed when a warble is written.
+
+Finding every warble with a tag, or every one mentioning a user, by
+searching messages.text would scan the whole table. Instead each write
+path (messages_add, ingest.py) calls index_messages(), which pulls the
+tags and mentions out of the new warbles' text once and records them in
+two small tables:
+
+    message_tags  (tag, message_id)       tags lower-cased
+    mentions      (user_id, message_id)   only users who exist
+
+Both are keyed on (key, message_id). Message ids are time-sortable, so a
+tag page or mention feed is one range read on the primary key, newest
+first, and pages on ?before=<message id> like every other feed. Rows go
+away with their message (ON DELETE CASCADE). Like the home feed, these
+pages cover the live tier: partitions.archive_partitions drops the index
+rows of the months it archives.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy.dialects import postgresql
+
+from models import db, User, Message, MessageTag, Mention
+
+HASHTAG_RE = re.compile(r'(?<!\w)#(\w+)')
+MENTION_RE = re.compile(r'(?<!\w)@(\w+)')
+
+
+def extract(text):
+    """The (tags, usernames) a warble's text mentions, as sets."""
+
+    tags = {tag.lower() for tag in HASHTAG_RE.findall(text)}
+    usernames = set(MENTION_RE.findall(text))
+
+    return tags, usernames
+
+
+def index_messages(connection, messages):
+    """Record the tags and mentions of new warbles.
+
+    `messages` are (id, text) pairs; `connection` is a Connection or
+    db.session. One statement per table however many warbles there are.
+    Returns the ids of the warbles that mention someone. Doesn't commit.
+    """
+
+    tag_rows = []
+    mentioned = []
+
+    for id, text in messages:
+        tags, usernames = extract(text)
+        tag_rows.extend({'tag': tag, 'message_id': id} for tag in tags)
+        mentioned.extend((username, id) for username in usernames)
+
+    if tag_rows:
+        connection.execute(postgresql.insert(MessageTag.__table__)
+                           .values(tag_rows)
+                           .on_conflict_do_nothing())
+
+    if mentioned:
+        users = User.__table__
+        user_ids = {username: id for username, id in connection.execute(
+            db.select([users.c.username, users.c.id])
+            .where(users.c.username.in_({name for name, id in mentioned})))}
+
+        mention_rows = [{'user_id': user_ids[name], 'message_id': id}
+                        for name, id in mentioned if name in user_ids]
+
+        if mention_rows:
+            connection.execute(postgresql.insert(Mention.__table__)
+                               .values(mention_rows)
+                               .on_conflict_do_nothing())
+
+        return sorted({row['message_id'] for row in mention_rows})
+
+    return []
+
+
+def index_all_messages(connection, batch_size=1000):
+    """Index every live warble; for a database that predates the index."""
+
+    messages = Message.__table__
+    result = (connection.execution_options(stream_results=True)
+              .execute(db.select([messages.c.id, messages.c.text])))
+
+    try:
+        while True:
+            batch = result.fetchmany(batch_size)
+
+            if not batch:
+                break
+
+            index_messages(connection, batch)
+    finally:
+        result.close()
+
+
+def link_hashtags(text):
+    """Jinja filter: `text`, escaped, with each #tag linked to its page."""
+
+    html = []
+    end = 0
+
+    for match in HASHTAG_RE.finditer(text):
+        html.append(escape(text[end:match.start()]))
+        html.append(Markup('<a href="/tags/%s">%s</a>')
+                    % (match.group(1).lower(), match.group(0)))
+        end = match.end()
+
+    html.append(escape(text[end:]))
+
+    return Markup('').join(html)
@@ -0,0 +1,351 @@
+"""Bulk message ingestion, for partner imports and migration jobs.
+
+Input is NDJSON, one warble per line:
+
+    {"user_id": 12, "text": "hello", "timestamp": "2016-03-01T12:00:00Z",
+     "id": "partner-post-4411"}
+
+`timestamp` is optional (default: now), and so is `id`, the client's own
+id for the post. Lines are taken a batch at a time, and each batch is
+written in one transaction:
+
+1. every line is parsed and checked (text 1-140 characters, a past
+   timestamp in a month that still has a live partition) in one pass,
+   with no per-line queries
+2. the good rows are COPY'd into a temp staging table
+3. rows whose author doesn't exist, and posts ingested before, are found
+   with one anti-join each and dropped
+4. the rest are given ids and go into `messages` with a single
+   INSERT ... SELECT, and their hashtags and mentions are indexed (see
+   hashtags.py). Imported history doesn't notify the people it mentions.
+
+Bad lines don't stop a batch: each batch's report lists them by line
+number, and everything else in it is inserted.
+
+Every post has an idempotency key: a hash of its author and `id`, or,
+without an `id`, of its author, timestamp (if sent) and text. The keys
+of ingested posts are kept in `ingest_keys`, so a post sent again, in
+any batch, in any order, is reported as already ingested rather than
+inserted twice. Posts without an `id` that are really different need a
+different text or timestamp; send an `id` to tell them apart otherwise.
+
+Ids are snowflakes minted from each post's timestamp (see snowflake.py),
+so imported history sorts into feeds where it belongs. They use the
+worker id snowflake.py keeps back for ingestion, INGEST_WORKER_ID, and
+continue from the highest such id already in each millisecond. Batches
+take that worker id's lease for their transaction, so they run one at a
+time and never mint the same id twice.
+
+Over HTTP, POST a batch to /api/messages/bulk with the INGEST_TOKEN as a
+bearer token. From the command line, with batches of BATCH_SIZE lines:
+
+    python ingest.py posts.ndjson      # or - for stdin
+"""
+
+import csv
+import hashlib
+import io
+import json
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+
+from hashtags import index_messages
+from models import Message
+from partitions import LIVE_TABLE, list_partitions
+from snowflake import (
+    INGEST_WORKER_ID, LEASE_LOCK_SPACE, MAX_SEQUENCE, MAX_WORKER_ID,
+    SEQUENCE_BITS, TIMESTAMP_SHIFT, WARBLER_EPOCH_MS,
+    snowflake_from_datetime)
+
+BATCH_SIZE = 5000
+
+MAX_TEXT_LENGTH = Message.__table__.c.text.type.length
+MAX_POST_ID_LENGTH = 200
+
+
+class IngestError(Exception):
+    """A line that can't be ingested; the message says why."""
+
+
+def parse_timestamp(value, now):
+    """A naive UTC datetime from an ISO 8601 string."""
+
+    if not isinstance(value, str):
+        raise IngestError("timestamp must be an ISO 8601 string")
+
+    try:
+        timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise IngestError(f"bad timestamp {value!r}")
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if timestamp > now:
+        raise IngestError("timestamp is in the future")
+
+    return timestamp
+
+
+def idempotency_key(user_id, post_id, timestamp, text):
+    """The key a post is known by in `ingest_keys`."""
+
+    if post_id is not None:
+        parts = ['id', user_id, post_id]
+    else:
+        parts = ['post', user_id,
+                 timestamp and timestamp.isoformat(), text]
+
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def parse_line(line, now):
+    """(key, text, timestamp or None, user_id) from one NDJSON line."""
+
+    try:
+        post = json.loads(line)
+    except ValueError:
+        raise IngestError("not valid JSON")
+
+    if not isinstance(post, dict):
+        raise IngestError("expected a JSON object")
+
+    user_id = post.get('user_id')
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise IngestError("user_id must be an integer")
+
+    text = post.get('text')
+    if not isinstance(text, str) or not text:
+        raise IngestError("text is required")
+    if len(text) > MAX_TEXT_LENGTH:
+        raise IngestError(f"text is longer than {MAX_TEXT_LENGTH} characters")
+
+    timestamp = post.get('timestamp')
+    if timestamp is not None:
+        timestamp = parse_timestamp(timestamp, now)
+
+    post_id = post.get('id')
+    if post_id is not None and (
+            not isinstance(post_id, str) or not post_id
+            or len(post_id) > MAX_POST_ID_LENGTH):
+        raise IngestError(
+            f"id must be a string of 1-{MAX_POST_ID_LENGTH} characters")
+
+    key = idempotency_key(user_id, post_id, timestamp, text)
+
+    return key, text, timestamp, user_id
+
+
+def parse_batch(lines, id_ranges, now=None):
+    """Check every line of a batch.
+
+    `id_ranges` are the (lower, upper) id bounds of the live partitions.
+    Returns (rows, errors): rows are (line, key, text, timestamp,
+    user_id); errors are {'line': n, 'error': message}, lines numbered
+    from 1.
+    """
+
+    now = now or datetime.utcnow()
+    rows = []
+    errors = []
+    lines_by_key = {}
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            key, text, timestamp, user_id = parse_line(line, now)
+            timestamp = timestamp or now
+
+            if key in lines_by_key:
+                raise IngestError(f"same post as line {lines_by_key[key]}")
+
+            id = snowflake_from_datetime(timestamp)
+            if not any((lower is None or lower <= id) and id < upper
+                       for lower, upper in id_ranges):
+                raise IngestError(
+                    f"no live partition for {timestamp:%Y-%m} "
+                    f"(archived, or not created yet)")
+        except IngestError as e:
+            errors.append({'line': number, 'error': str(e)})
+        else:
+            lines_by_key[key] = number
+            rows.append((number, key, text, timestamp, user_id))
+
+    return rows, errors
+
+
+# Held until the batch commits; live workers never lease this worker id.
+LEASE = text("SELECT pg_advisory_xact_lock(:space, :worker_id)")
+
+STAGE = """
+CREATE TEMP TABLE ingest_staging (
+    line INTEGER NOT NULL,
+    key VARCHAR(64) NOT NULL,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    user_id INTEGER NOT NULL,
+    id BIGINT
+) ON COMMIT DROP
+"""
+
+UNKNOWN_AUTHORS = """
+DELETE FROM ingest_staging s
+WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = s.user_id)
+RETURNING s.line
+"""
+
+ALREADY_INGESTED = """
+DELETE FROM ingest_staging s
+USING ingest_keys k
+WHERE k.key = s.key
+RETURNING s.line
+"""
+
+# Each post's millisecond, as the smallest id the ingest worker has in
+# it; numbered on from the highest id already there.
+MINT = text("""
+UPDATE ingest_staging s
+SET id = minted.id
+FROM (
+    SELECT line,
+           coalesce((SELECT max(m.id) FROM messages m
+                     WHERE m.id BETWEEN base AND base + :max_sequence),
+                    base - 1)
+           + row_number() OVER (PARTITION BY base ORDER BY line) AS id
+    FROM (
+        SELECT line,
+               ((floor(extract(epoch FROM timestamp) * 1000)::bigint
+                 - :epoch_ms) << :timestamp_shift) | :worker_bits AS base
+        FROM ingest_staging
+    ) AS staged
+) AS minted
+WHERE s.line = minted.line
+""")
+
+# Numbered past the end of their millisecond, into the next worker's.
+SEQUENCE_EXHAUSTED = text("""
+DELETE FROM ingest_staging
+WHERE (id >> :sequence_bits) & :max_worker_id <> :worker_id
+RETURNING line
+""")
+
+INSERT = """
+INSERT INTO messages (id, text, timestamp, user_id)
+SELECT id, text, timestamp, user_id FROM ingest_staging
+RETURNING id, text
+"""
+
+RECORD_KEYS = """
+INSERT INTO ingest_keys (key, message_id)
+SELECT key, id FROM ingest_staging
+"""
+
+
+def copy_rows(connection, rows):
+    """COPY `rows` into ingest_staging."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY ingest_staging (line, key, text, timestamp, user_id) "
+            "FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def ingest_batch(connection, lines):
+    """Write one batch of NDJSON lines, in the caller's transaction.
+
+    Returns the batch's report: {'inserted': n, 'errors': [...]}.
+    """
+
+    id_ranges = [(lower, upper) for name, lower, upper
+                 in list_partitions(connection, LIVE_TABLE)]
+    rows, errors = parse_batch(lines, id_ranges)
+    inserted = []
+
+    if rows:
+        connection.execute(LEASE, space=LEASE_LOCK_SPACE,
+                           worker_id=INGEST_WORKER_ID)
+        connection.execute(text(STAGE))
+        copy_rows(connection, rows)
+
+        for line, in connection.execute(text(UNKNOWN_AUTHORS)):
+            errors.append({'line': line, 'error': "no such user"})
+
+        for line, in connection.execute(text(ALREADY_INGESTED)):
+            errors.append({'line': line, 'error': "already ingested"})
+
+        connection.execute(
+            MINT, max_sequence=MAX_SEQUENCE, epoch_ms=WARBLER_EPOCH_MS,
+            timestamp_shift=TIMESTAMP_SHIFT,
+            worker_bits=INGEST_WORKER_ID << SEQUENCE_BITS)
+
+        for line, in connection.execute(
+                SEQUENCE_EXHAUSTED, sequence_bits=SEQUENCE_BITS,
+                max_worker_id=MAX_WORKER_ID, worker_id=INGEST_WORKER_ID):
+            errors.append({'line': line,
+                           'error': "too many posts in one millisecond"})
+
+        inserted = connection.execute(text(INSERT)).fetchall()
+        connection.execute(text(RECORD_KEYS))
+        index_messages(connection, inserted)
+
+        connection.execute(text("DROP TABLE ingest_staging"))
+
+    return {'inserted': len(inserted),
+            'errors': sorted(errors, key=lambda error: error['line'])}
+
+
+def batches(lines, size=BATCH_SIZE):
+    """Split an iterable of lines into lists of at most `size`."""
+
+    batch = []
+
+    for line in lines:
+        batch.append(line)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+if __name__ == '__main__':
+    from app import create_app
+    from models import db
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python ingest.py FILE.ndjson  (- for stdin)")
+
+    create_app()
+
+    source = sys.stdin if sys.argv[1] == '-' else open(sys.argv[1])
+    inserted = failed = 0
+
+    with source:
+        for number, batch in enumerate(batches(source), 1):
+            with db.engine.begin() as conn:
+                report = ingest_batch(conn, batch)
+
+            inserted += report['inserted']
+            failed += len(report['errors'])
+
+            for error in report['errors']:
+                line = (number - 1) * BATCH_SIZE + error['line']
+                print(f"line {line}: {error['error']}", file=sys.stderr)
+
+            print(f"batch {number}: {report['inserted']} inserted, "
+                  f"{len(report['errors'])} rejected")
+
+    print(f"{inserted} inserted, {failed} rejected")
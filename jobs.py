@@ -0,0 +1,335 @@
+"""A durable background job queue in a Postgres table.
+
+Anything that can happen after a response is sent (like delivering a
+warble's mentions as notifications) is queued as a row in `jobs` with
+enqueue(), in the same transaction as the write that caused it: the job
+exists exactly when that write committed, and no broker is needed.
+
+A pool of worker threads (run it with `python jobs.py work`) takes ready
+jobs off the table in batches:
+
+- SELECT ... FOR UPDATE SKIP LOCKED claims up to BATCH_SIZE jobs, so any
+  number of workers, in any number of processes, share the queue without
+  taking the same job twice
+- each kind's jobs are handed to its handler together (one INSERT for a
+  whole batch of notifications, say); if the batch fails, its jobs are
+  retried one at a time, so one bad job can't hold up the rest
+- a job that ran is deleted in the transaction that did its work; one
+  that failed is pushed back with exponential backoff, and after
+  MAX_ATTEMPTS it's marked failed and left for a human to look at
+
+Handlers get (connection, payloads) and must not commit. A job may run
+again if a worker dies after its work but before the commit, so handlers
+should be idempotent (ON CONFLICT DO NOTHING and the like).
+
+Periodic work is a job that queues its next run as it finishes;
+`python jobs.py work` starts each such chain with enqueue_once().
+
+    python jobs.py work [threads]    run a worker pool (default WORKERS)
+    python jobs.py stats             queue depth and lag
+
+The same stats are served as JSON from /_debug/jobs, with the
+STATS_TOKEN as a bearer token.
+"""
+
+import json
+import logging
+import sys
+import threading
+from collections import defaultdict
+
+from sqlalchemy import text
+
+import partitions
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+WORKERS = 4
+
+# Seconds an idle worker waits before looking for jobs again.
+POLL_INTERVAL = 1.0
+
+MAX_ATTEMPTS = 8
+
+# Retry n waits BACKOFF_SECONDS * 2**(n-1), at most MAX_BACKOFF_SECONDS.
+BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 3600
+
+# Seconds between runs of the partition upkeep job.
+PARTITION_INTERVAL = 6 * 3600
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the decorated function as the handler for `kind` jobs."""
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(connection, kind, payload, delay=0):
+    """Queue a `kind` job, to run no sooner than `delay` seconds from now.
+
+    `connection` is a Connection or db.session; the job is only visible
+    to workers once the caller commits.
+    """
+
+    connection.execute(text(
+        "INSERT INTO jobs (kind, payload, run_at) "
+        "VALUES (:kind, CAST(:payload AS JSONB), "
+        "timezone('utc', now()) + make_interval(secs => :delay))"),
+        {'kind': kind, 'payload': json.dumps(payload), 'delay': delay})
+
+
+def enqueue_once(connection, kind, payload, delay=0):
+    """enqueue(), unless a `kind` job is already waiting or running.
+
+    Returns whether it queued one.
+    """
+
+    # two callers at once would each find none
+    connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:kind))"),
+                       {'kind': kind})
+    pending = connection.execute(text(
+        "SELECT 1 FROM jobs WHERE kind = :kind AND failed_at IS NULL LIMIT 1"),
+        {'kind': kind}).first()
+
+    if pending is None:
+        enqueue(connection, kind, payload, delay)
+
+    return pending is None
+
+
+CLAIM = text("""
+SELECT id, kind, payload, attempts FROM jobs
+WHERE failed_at IS NULL AND run_at <= timezone('utc', now())
+ORDER BY run_at, id
+LIMIT :limit
+FOR UPDATE SKIP LOCKED
+""")
+
+DONE = text("DELETE FROM jobs WHERE id = ANY(:ids)")
+
+RETRY = text("""
+UPDATE jobs SET
+    attempts = attempts + 1,
+    last_error = :error,
+    run_at = timezone('utc', now()) + make_interval(secs => :delay),
+    failed_at = CASE WHEN attempts + 1 >= :max_attempts
+                     THEN timezone('utc', now()) END
+WHERE id = :id
+""")
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts` times."""
+
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+
+
+def run_kind(connection, kind, jobs):
+    """Run `jobs` of one kind, as a batch if that works.
+
+    Each attempt is in a SAVEPOINT, so a failure undoes only its own
+    writes. Returns {job id: exception} for the jobs that failed.
+    """
+
+    try:
+        with connection.begin_nested():
+            HANDLERS[kind](connection, [job.payload for job in jobs])
+        return {}
+    except Exception as exc:
+        if len(jobs) == 1:
+            return {jobs[0].id: exc}
+
+    errors = {}
+    for job in jobs:
+        errors.update(run_kind(connection, kind, [job]))
+
+    return errors
+
+
+def run_batch(connection, limit=BATCH_SIZE):
+    """Claim and run up to `limit` ready jobs in the caller's transaction.
+
+    Returns how many jobs were claimed.
+    """
+
+    jobs = connection.execute(CLAIM, limit=limit).fetchall()
+    by_kind = defaultdict(list)
+
+    for job in jobs:
+        by_kind[job.kind].append(job)
+
+    errors = {}
+
+    for kind, kind_jobs in by_kind.items():
+        if kind in HANDLERS:
+            errors.update(run_kind(connection, kind, kind_jobs))
+        else:
+            errors.update((job.id, LookupError(f"no handler for {kind!r}"))
+                          for job in kind_jobs)
+
+    done = [job.id for job in jobs if job.id not in errors]
+    if done:
+        connection.execute(DONE, ids=done)
+
+    for job in jobs:
+        if job.id in errors:
+            attempts = job.attempts + 1
+            logger.warning("Job %s (%s) failed, attempt %d: %r",
+                           job.id, job.kind, attempts, errors[job.id])
+            connection.execute(RETRY, id=job.id, error=repr(errors[job.id]),
+                               delay=backoff(attempts),
+                               max_attempts=MAX_ATTEMPTS)
+
+    return len(jobs)
+
+
+STATS = text("""
+SELECT
+    count(*) FILTER (WHERE failed_at IS NULL
+                     AND run_at <= timezone('utc', now())) AS ready,
+    count(*) FILTER (WHERE failed_at IS NULL
+                     AND run_at > timezone('utc', now())) AS scheduled,
+    count(*) FILTER (WHERE failed_at IS NOT NULL) AS failed,
+    coalesce(extract(epoch FROM timezone('utc', now()) - min(run_at)
+             FILTER (WHERE failed_at IS NULL
+                     AND run_at <= timezone('utc', now()))), 0) AS lag
+FROM jobs
+""")
+
+
+def queue_stats(connection):
+    """Queue depth and lag.
+
+    ready: jobs waiting to run now; scheduled: waiting out a delay or
+    backoff; failed: out of attempts; lag_seconds: how long the oldest
+    ready job has been waiting.
+    """
+
+    row = connection.execute(STATS).first()
+
+    return {
+        'ready': row.ready,
+        'scheduled': row.scheduled,
+        'failed': row.failed,
+        'lag_seconds': float(row.lag),
+    }
+
+
+class WorkerPool:
+    """Threads that each run batches of jobs until stopped."""
+
+    def __init__(self, engine, threads=WORKERS, poll_interval=POLL_INTERVAL,
+                 app=None):
+        self.engine = engine
+        # handlers needing app config (thumbnails) run in its context
+        self.app = app
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self.work, name=f"jobs-{i}", daemon=True)
+            for i in range(threads)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop once the batches in progress are done."""
+
+        self._stop.set()
+
+        for thread in self._threads:
+            thread.join()
+
+    def work(self):
+        if self.app is not None:
+            with self.app.app_context():
+                self._work()
+        else:
+            self._work()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                with self.engine.begin() as conn:
+                    claimed = run_batch(conn)
+            except Exception:
+                logger.exception("Job batch failed")
+                claimed = 0
+
+            # a full batch probably means more are waiting
+            if claimed < BATCH_SIZE:
+                self._stop.wait(self.poll_interval)
+
+
+##############################################################################
+# Handlers
+
+
+@handler('deliver_mentions')
+def deliver_mentions(connection, payloads):
+    """Notify everyone mentioned in the payloads' warbles, but their authors.
+
+    Payloads are {"message_ids": [...]}; mentions were resolved to users
+    when the warbles were written (see hashtags.py).
+    """
+
+    message_ids = [id for payload in payloads for id in payload['message_ids']]
+
+    connection.execute(text("""
+        INSERT INTO notifications (user_id, message_id, kind)
+        SELECT mentions.user_id, mentions.message_id, 'mention'
+        FROM mentions JOIN messages ON messages.id = mentions.message_id
+        WHERE mentions.message_id = ANY(:ids)
+          AND mentions.user_id <> messages.user_id
+        ON CONFLICT DO NOTHING
+    """), ids=message_ids)
+
+
+@handler('maintain_partitions')
+def maintain_partitions(connection, payloads):
+    """Create the coming months' message partitions (see partitions.py),
+    then run again in PARTITION_INTERVAL."""
+
+    partitions.maintain_partitions(connection)
+    enqueue(connection, 'maintain_partitions', {}, delay=PARTITION_INTERVAL)
+
+
+if __name__ == '__main__':
+    from app import create_app
+    from models import db
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(threadName)s %(message)s")
+
+    app = create_app()
+    command, *args = sys.argv[1:] or ['work']
+
+    with app.app_context():
+        if command == 'work':
+            with db.engine.begin() as conn:
+                enqueue_once(conn, 'maintain_partitions', {})
+
+            threads = int(args[0]) if args else WORKERS
+            pool = WorkerPool(db.engine, threads=threads, app=app)
+            pool.start()
+            logger.info("Running %d job workers", threads)
+
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                logger.info("Stopping after the current batches")
+                pool.stop()
+        elif command == 'stats':
+            with db.engine.connect() as conn:
+                print(json.dumps(queue_stats(conn), indent=2))
+        else:
+            sys.exit(__doc__)
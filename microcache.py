@@ -0,0 +1,165 @@
+"""A few seconds of full-page caching for anonymous visitors.
+
+Logged-out visitors all get the same homepage, profile and warble pages,
+so when a link to one warble goes viral, rendering it for each of them
+is thousands of identical query-and-render passes a second. Views
+decorated with @microcache keep their rendered response for
+MICROCACHE_TTL seconds, per URL (path and query string), and serve it
+to every anonymous request in that window.
+
+While a page is being rendered, other requests for the same URL wait
+for that render instead of starting their own, so a burst of misses
+costs one render, not one per request.
+
+Requests that might see something personal skip the cache entirely:
+
+- any request carrying a session cookie (logged in, or with flashes or
+  a CSRF token waiting)
+- anything but GET and HEAD
+
+Only 200s that didn't touch the session are stored. Each worker process
+has its own cache of at most MICROCACHE_MAX_ENTRIES pages; a page can be
+up to MICROCACHE_TTL seconds stale, and nothing else invalidates it.
+Set MICROCACHE_TTL to 0 to turn it off.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+
+HEADER = 'X-Micro-Cache'
+
+# How long a request waits on another's render before doing its own.
+WAIT_TIMEOUT = 10
+
+
+class _Render:
+    """A render in progress, waited on by requests for the same URL."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.page = None
+
+
+class MicroCache:
+    """Short-lived rendered pages, with concurrent misses coalesced."""
+
+    def __init__(self, app=None):
+        self._pages = OrderedDict()
+        self._renders = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['MICROCACHE_TTL']
+        self.max_entries = app.config['MICROCACHE_MAX_ENTRIES']
+        self.session_cookie = app.session_cookie_name
+        app.extensions['microcache'] = self
+
+    def cacheable(self):
+        return (self.ttl > 0 and request.method in ('GET', 'HEAD')
+                and self.session_cookie not in request.cookies)
+
+    def get(self, key, render):
+        """The page for `key`, from the cache or from render().
+
+        Pages are (body, status, headers) tuples; render() returns one,
+        or None if it isn't to be cached.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            cached = self._pages.get(key)
+
+            if cached and cached[0] > now:
+                self.hits += 1
+                return cached[1], 'HIT'
+
+            in_progress = self._renders.get(key)
+
+            if in_progress is None:
+                self._renders[key] = in_progress = _Render()
+                leader = True
+            else:
+                leader = False
+
+            self.misses += 1
+
+        if not leader:
+            in_progress.done.wait(WAIT_TIMEOUT)
+
+            # the leader's render failed or wasn't cacheable: do our own
+            if in_progress.page is None:
+                return render(), 'MISS'
+
+            return in_progress.page, 'COALESCED'
+
+        try:
+            page = in_progress.page = render()
+        finally:
+            with self._lock:
+                del self._renders[key]
+
+                if in_progress.page is not None:
+                    self._store(key, in_progress.page)
+
+            in_progress.done.set()
+
+        return page, 'MISS'
+
+    def _store(self, key, page):
+        """Add a page; call with the lock held."""
+
+        self._pages[key] = (time.monotonic() + self.ttl, page)
+        self._pages.move_to_end(key)
+
+        while len(self._pages) > self.max_entries:
+            self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+def microcache(view):
+    """Serve anonymous requests for `view` from the micro-cache."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions['microcache']
+
+        if not cache.cacheable():
+            return view(*args, **kwargs)
+
+        response = None
+
+        def render():
+            nonlocal response
+            response = make_response(view(*args, **kwargs))
+
+            if response.status_code != 200 or session.modified:
+                return None
+
+            # after_request functions change responses in place, so the
+            # cache keeps the parts and builds a fresh one for each request
+            return (response.get_data(), response.status_code,
+                    list(response.headers))
+
+        page, outcome = cache.get(request.full_path, render)
+
+        # rendered by someone else
+        if response is None:
+            body, status, headers = page
+            response = current_app.response_class(body, status, headers)
+
+        response.headers[HEADER] = outcome
+        return response
+
+    return wrapper
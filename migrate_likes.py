@@ -0,0 +1,97 @@
+"""Re-key likes on (user_id, message_id) and record when each was made.
+
+Databases created before this change have a surrogate `likes.id` and a
+unique `likes.message_id`, so only one user could ever like a given
+warble, and nothing said when a like happened. This script, run once:
+
+- drops likes with no user or message (the columns were nullable)
+- adds likes.created_at, set to the liked warble's timestamp for existing
+  likes (the closest thing on record) and to now() for new ones
+- drops likes.id and the unique constraint on message_id
+- makes (user_id, message_id) the primary key
+- adds the "my likes, newest first" and message_id indexes
+- does the same to likes_archive, if partitions.py has made one
+
+This is the offline way to do it: it runs in a single transaction, so it
+either all happens or none does, but it holds an exclusive lock on likes
+throughout, so stop the site first. Migration 0003 (migrations.py) does
+the same while the site is up, and is what to use normally. After running
+this script, record that 0003 is done:
+
+    python migrate_likes.py
+    python migrations.py stamp 0003_likes_composite_key
+"""
+
+from app import create_app
+from models import db
+
+STATEMENTS = [
+    "DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL",
+
+    """
+    ALTER TABLE likes
+    ADD COLUMN created_at TIMESTAMP WITHOUT TIME ZONE
+    """,
+    """
+    UPDATE likes SET created_at = m.timestamp
+    FROM messages m WHERE m.id = likes.message_id
+    """,
+    """
+    ALTER TABLE likes
+    ALTER COLUMN created_at SET DEFAULT timezone('utc', now()),
+    ALTER COLUMN created_at SET NOT NULL
+    """,
+
+    "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key",
+    "ALTER TABLE likes DROP COLUMN id",
+    "ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)",
+    """
+    CREATE INDEX ix_likes_user_id_created_at
+    ON likes (user_id, created_at DESC, message_id)
+    """,
+    "CREATE INDEX ix_likes_message_id ON likes (message_id)",
+]
+
+# Archived likes' warbles are in messages_archive, not messages.
+ARCHIVE_STATEMENTS = [
+    """
+    ALTER TABLE IF EXISTS likes_archive
+    ADD COLUMN created_at TIMESTAMP WITHOUT TIME ZONE
+    """,
+    """
+    DO $$ BEGIN
+        IF to_regclass('likes_archive') IS NOT NULL THEN
+            UPDATE likes_archive SET created_at = m.timestamp
+            FROM messages_archive m WHERE m.id = likes_archive.message_id;
+            UPDATE likes_archive SET created_at = timezone('utc', now())
+            WHERE created_at IS NULL;
+        END IF;
+    END $$
+    """,
+    "ALTER TABLE IF EXISTS likes_archive DROP COLUMN id",
+    """
+    ALTER TABLE IF EXISTS likes_archive
+    ALTER COLUMN created_at SET NOT NULL,
+    ADD PRIMARY KEY (user_id, message_id)
+    """,
+]
+
+STATEMENTS += ARCHIVE_STATEMENTS
+
+
+def migrate_likes(engine):
+    """Run the migration against `engine` in one transaction."""
+
+    with engine.begin() as conn:
+        for statement in STATEMENTS:
+            conn.execute(db.text(statement))
+
+        count = conn.execute(db.text("SELECT count(*) FROM likes")).scalar()
+
+    return count
+
+
+if __name__ == '__main__':
+    create_app()
+    count = migrate_likes(db.engine)
+    print(f"Re-keyed {count} likes.")
@@ -0,0 +1,736 @@
+"""Schema and data migrations that can run while the site is up.
+
+A migration is a named list of steps, applied in order and recorded in
+the schema_migrations table. Steps are built to avoid long locks on big
+tables:
+
+- SQL: statements run in one short transaction with a lock_timeout, so
+  DDL gives up (and is retried) rather than queueing behind a long
+  transaction and blocking every query behind it
+- CreateIndex: CREATE INDEX CONCURRENTLY, one partition at a time for
+  partitioned tables; an invalid index left by an interrupted build is
+  dropped and built again
+- Backfill: an UPDATE run in batches of primary-key range, each batch
+  its own transaction, the last key done checkpointed with it. Batches
+  are sized to take about `target_seconds`, with a pause between them;
+  an interrupted backfill resumes from its checkpoint, and progress is
+  logged as it goes
+- PythonBackfill: the same, but each batch's rows are passed to a
+  function rather than updated in SQL
+- RunPython: a function called with a connection, in a transaction
+
+Batches are cut by walking the primary key index (keyset), not by
+arithmetic on key values, so they stay the same size over sparse ids
+(snowflakes) and composite keys (follows, likes).
+
+    python migrations.py status          what's applied, what's pending
+    python migrations.py run [name]      apply pending migrations (up to name)
+    python migrations.py stamp [name]    mark them applied without running
+
+A database made by db.create_all() already has the latest schema;
+seed.py stamps it. One brought up to date by hand with the standalone
+scripts (backfill_message_ids.py, partitions.py convert, migrate_likes.py)
+should be stamped up to the last one it ran.
+"""
+
+import json
+import logging
+import sys
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, FOLLOW_CHANGES_DDL, REPLY_COUNT_DDL
+import backfill_message_ids
+import hashtags
+import migrate_likes
+import partitions
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = '5s'
+LOCK_RETRIES = 10
+
+# How often a backfill logs its progress, in seconds.
+PROGRESS_EVERY = 10
+
+LOCK_NOT_AVAILABLE = '55P03'
+
+BOOKKEEPING = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name TEXT PRIMARY KEY,
+        step INTEGER NOT NULL DEFAULT 0,
+        checkpoint TEXT,
+        rows_done BIGINT NOT NULL DEFAULT 0,
+        applied_at TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT timezone('utc', now())
+    )
+"""
+
+
+def autocommit(engine):
+    return engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+
+def retry_on_lock_timeout(func):
+    """Call func(), retrying with backoff while it can't get its locks."""
+
+    for attempt in range(LOCK_RETRIES):
+        try:
+            return func()
+        except OperationalError as exc:
+            if getattr(exc.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE:
+                raise
+
+            wait = min(2 ** attempt, 30)
+            logger.warning("Lock timeout; retrying in %ss", wait)
+            time.sleep(wait)
+
+    return func()
+
+
+##############################################################################
+# Steps
+
+
+class SQL:
+    """Statements run together in one transaction, under a lock_timeout."""
+
+    def __init__(self, *statements):
+        self.statements = statements
+
+    def __str__(self):
+        return f"SQL: {self.statements[0].strip().splitlines()[0]}"
+
+    def run(self, engine, progress):
+        def attempt():
+            with engine.begin() as conn:
+                conn.execute(db.text(
+                    f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+
+                for statement in self.statements:
+                    conn.execute(db.text(statement))
+
+        retry_on_lock_timeout(attempt)
+
+
+class RunPython:
+    """func(connection), in a transaction under a lock_timeout."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __str__(self):
+        return f"Python: {self.func.__module__}.{self.func.__name__}"
+
+    def run(self, engine, progress):
+        def attempt():
+            with engine.begin() as conn:
+                conn.execute(db.text(
+                    f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+                self.func(conn)
+
+        retry_on_lock_timeout(attempt)
+
+
+class CreateIndex:
+    """Build an index without blocking writes to its table."""
+
+    def __init__(self, name, table, columns, unique=False):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.unique = unique
+
+    def __str__(self):
+        return f"CreateIndex: {self.name} ON {self.table} ({self.columns})"
+
+    def run(self, engine, progress):
+        with autocommit(engine) as conn:
+            if relkind(conn, self.table) == 'p':
+                self.create_partitioned(conn)
+            else:
+                self.create(conn, self.name, self.table)
+
+    def create(self, conn, name, table):
+        unique = "UNIQUE " if self.unique else ""
+        valid = index_valid(conn, name)
+
+        if valid:
+            return
+
+        if valid is False:
+            logger.info("Rebuilding invalid index %s", name)
+            conn.execute(db.text(f"DROP INDEX CONCURRENTLY {name}"))
+
+        conn.execute(db.text(
+            f"CREATE {unique}INDEX CONCURRENTLY {name} "
+            f"ON {table} ({self.columns})"))
+
+    def create_partitioned(self, conn):
+        """Partitioned tables can't be indexed concurrently in one go.
+
+        An index is made on the parent alone (instant, and invalid until
+        every partition has one), then built concurrently on each
+        partition and attached.
+        """
+
+        unique = "UNIQUE " if self.unique else ""
+
+        conn.execute(db.text(
+            f"CREATE {unique}INDEX IF NOT EXISTS {self.name} "
+            f"ON ONLY {self.table} ({self.columns})"))
+
+        for partition, in conn.execute(db.text("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = CAST(:table AS regclass)
+                ORDER BY c.relname
+                """), table=self.table):
+            name = f"{partition}_{self.name}"
+            self.create(conn, name, partition)
+
+            attached = conn.execute(db.text("""
+                SELECT 1 FROM pg_inherits
+                WHERE inhrelid = CAST(:name AS regclass)
+                """), name=name).first()
+
+            if not attached:
+                conn.execute(db.text(
+                    f"ALTER INDEX {self.name} ATTACH PARTITION {name}"))
+
+
+class Backfill:
+    """UPDATE `table` SET `assignments` [WHERE `where`], in key order batches.
+
+    `key` is the table's primary key columns. The table is aliased `t`
+    in `assignments` and `where`.
+    """
+
+    def __init__(self, table, assignments, key=('id',), where=None,
+                 batch_size=1000, min_batch=100, max_batch=50000,
+                 target_seconds=0.5, pause=0.1):
+        self.table = table
+        self.assignments = assignments
+        self.key = tuple(key)
+        self.where = where
+        self.batch_size = batch_size
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.target_seconds = target_seconds
+        self.pause = pause
+
+    def __str__(self):
+        return f"Backfill: {self.table} SET {self.assignments}"
+
+    def next_bound(self, conn, after, batch_size):
+        """Key of the last row in the batch after `after` (None: to the end)."""
+
+        columns = ", ".join(self.key)
+        query = f"SELECT {columns} FROM {self.table} t"
+        params = {'offset': batch_size - 1}
+
+        if after is not None:
+            query += f" WHERE {self.row(self.key)} > {self.row(after, 'a')}"
+            params.update(self.params(after, 'a'))
+
+        row = conn.execute(db.text(
+            f"{query} ORDER BY {columns} LIMIT 1 OFFSET :offset"),
+            **params).first()
+
+        return list(row) if row else None
+
+    def batch_where(self, after, upto):
+        """The WHERE clause for the rows after `after`, up to `upto`."""
+
+        conditions = []
+        params = {}
+
+        if after is not None:
+            conditions.append(f"{self.row(self.key)} > {self.row(after, 'a')}")
+            params.update(self.params(after, 'a'))
+
+        if upto is not None:
+            conditions.append(f"{self.row(self.key)} <= {self.row(upto, 'u')}")
+            params.update(self.params(upto, 'u'))
+
+        if self.where:
+            conditions.append(f"({self.where})")
+
+        return " AND ".join(conditions) or "true", params
+
+    def update_batch(self, conn, after, upto):
+        where, params = self.batch_where(after, upto)
+
+        return conn.execute(db.text(
+            f"UPDATE {self.table} t SET {self.assignments} WHERE {where}"),
+            **params).rowcount
+
+    def row(self, values, prefix=None):
+        if prefix is None:
+            names = [f"t.{column}" for column in values]
+        else:
+            names = [f":{prefix}{i}" for i in range(len(values))]
+
+        return f"({', '.join(names)})"
+
+    @staticmethod
+    def params(values, prefix):
+        return {f"{prefix}{i}": value for i, value in enumerate(values)}
+
+    def run(self, engine, progress):
+        after = progress.checkpoint
+        batch_size = self.batch_size
+        estimate = estimated_rows(engine, self.table)
+        started = time.monotonic()
+        rows_at_start = progress.rows_done
+        last_report = started
+
+        while True:
+            batch_started = time.monotonic()
+
+            with engine.begin() as conn:
+                upto = self.next_bound(conn, after, batch_size)
+                rows = self.update_batch(conn, after, upto)
+                progress.save(conn, checkpoint=upto,
+                              rows_done=progress.rows_done + rows)
+
+            if upto is None:
+                break
+
+            after = upto
+            elapsed = time.monotonic() - batch_started
+
+            # aim each batch at target_seconds
+            scale = self.target_seconds / max(elapsed, 1e-3)
+            batch_size = int(min(self.max_batch, max(
+                self.min_batch, batch_size * min(2, max(0.5, scale)))))
+
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_EVERY:
+                last_report = now
+                report(progress, estimate, rows_at_start, now - started)
+
+            time.sleep(self.pause)
+
+        report(progress, estimate, rows_at_start, time.monotonic() - started)
+
+
+class PythonBackfill(Backfill):
+    """func(connection, rows) for `columns` of `table`, in key order batches.
+
+    Each batch is its own transaction and checkpointed like a Backfill;
+    `func` should cope with seeing a row again.
+    """
+
+    def __init__(self, table, columns, func, **kwargs):
+        super().__init__(table, None, **kwargs)
+        self.columns = columns
+        self.func = func
+
+    def __str__(self):
+        return (f"PythonBackfill: {self.func.__module__}.{self.func.__name__}"
+                f" over {self.table}")
+
+    def update_batch(self, conn, after, upto):
+        where, params = self.batch_where(after, upto)
+        rows = conn.execute(db.text(
+            f"SELECT {self.columns} FROM {self.table} t WHERE {where}"),
+            **params).fetchall()
+
+        if rows:
+            self.func(conn, rows)
+
+        return len(rows)
+
+
+def report(progress, estimate, rows_at_start, elapsed):
+    done = progress.rows_done
+    rate = (done - rows_at_start) / max(elapsed, 1e-3)
+    percent = min(100.0, 100.0 * done / estimate) if estimate else 100.0
+    eta = max(0, estimate - done) / rate if rate else 0
+
+    logger.info("%s: %d/~%d rows (%.1f%%), %.0f rows/s, ~%.0fs left",
+                progress.name, done, estimate, percent, rate, eta)
+
+
+def relkind(conn, table):
+    return conn.execute(db.text(
+        "SELECT relkind FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+        table=table).scalar()
+
+
+def index_valid(conn, name):
+    """True/False for a valid/invalid index called `name`; None if none."""
+
+    return conn.execute(db.text("""
+        SELECT indisvalid FROM pg_index
+        WHERE indexrelid = to_regclass(:name)
+        """), name=name).scalar()
+
+
+def estimated_rows(engine, table):
+    """The planner's row count estimate, summed over any partitions."""
+
+    with engine.connect() as conn:
+        return int(conn.execute(db.text("""
+            SELECT coalesce(sum(greatest(c.reltuples, 0)), 0) FROM pg_class c
+            WHERE c.oid = CAST(:table AS regclass)
+               OR c.oid IN (SELECT inhrelid FROM pg_inherits
+                            WHERE inhparent = CAST(:table AS regclass))
+            """), table=table).scalar())
+
+
+##############################################################################
+# Running
+
+
+class Migration:
+    def __init__(self, name, *steps):
+        self.name = name
+        self.steps = steps
+
+
+class Progress:
+    """A migration's row in schema_migrations: which step, and where in it."""
+
+    def __init__(self, name, step=0, checkpoint=None, rows_done=0,
+                 applied_at=None):
+        self.name = name
+        self.step = step
+        self.checkpoint = json.loads(checkpoint) if checkpoint else None
+        self.rows_done = rows_done
+        self.applied_at = applied_at
+
+    def save(self, conn, step=None, checkpoint=None, rows_done=0,
+             applied=False):
+        if step is not None:
+            self.step = step
+
+        self.checkpoint = checkpoint
+        self.rows_done = rows_done
+
+        conn.execute(db.text("""
+            INSERT INTO schema_migrations
+                (name, step, checkpoint, rows_done, applied_at)
+            VALUES (:name, :step, :checkpoint, :rows_done,
+                    CASE WHEN :applied THEN timezone('utc', now()) END)
+            ON CONFLICT (name) DO UPDATE SET
+                step = excluded.step,
+                checkpoint = excluded.checkpoint,
+                rows_done = excluded.rows_done,
+                applied_at = excluded.applied_at,
+                updated_at = timezone('utc', now())
+            """),
+            name=self.name, step=self.step,
+            checkpoint=json.dumps(checkpoint) if checkpoint else None,
+            rows_done=rows_done, applied=applied)
+
+
+def load_progress(engine):
+    with engine.begin() as conn:
+        conn.execute(db.text(BOOKKEEPING))
+
+        rows = conn.execute(db.text(
+            "SELECT name, step, checkpoint, rows_done, applied_at "
+            "FROM schema_migrations"))
+
+        return {row.name: Progress(**row) for row in rows}
+
+
+def select(upto):
+    """MIGRATIONS up to and including the one named `upto` (all if None)."""
+
+    names = [migration.name for migration in MIGRATIONS]
+
+    if upto is None:
+        return MIGRATIONS
+
+    if upto not in names:
+        raise KeyError(f"No migration named {upto!r}")
+
+    return MIGRATIONS[:names.index(upto) + 1]
+
+
+def migrate(engine, upto=None):
+    """Apply pending migrations in order; returns the names applied."""
+
+    done = load_progress(engine)
+    applied = []
+
+    for migration in select(upto):
+        progress = done.get(migration.name) or Progress(migration.name)
+
+        if progress.applied_at:
+            continue
+
+        for i, step in enumerate(migration.steps):
+            if i < progress.step:
+                continue
+
+            logger.info("%s: step %d/%d, %s", migration.name, i + 1,
+                        len(migration.steps), step)
+            step.run(engine, progress)
+
+            with engine.begin() as conn:
+                progress.save(conn, step=i + 1,
+                              applied=i + 1 == len(migration.steps))
+
+        if not migration.steps:
+            with engine.begin() as conn:
+                progress.save(conn, applied=True)
+
+        applied.append(migration.name)
+
+    return applied
+
+
+def stamp(engine, upto=None):
+    """Record migrations as applied without running them."""
+
+    with engine.begin() as conn:
+        conn.execute(db.text(BOOKKEEPING))
+
+        for migration in select(upto):
+            Progress(migration.name, step=len(migration.steps)).save(
+                conn, applied=True)
+
+
+def status(engine):
+    """(name, state) for every migration."""
+
+    done = load_progress(engine)
+    lines = []
+
+    for migration in MIGRATIONS:
+        progress = done.get(migration.name)
+
+        if progress is None:
+            state = "pending"
+        elif progress.applied_at:
+            state = f"applied {progress.applied_at:%Y-%m-%d %H:%M}"
+        else:
+            state = (f"in progress: step {progress.step + 1}/"
+                     f"{len(migration.steps)}, {progress.rows_done} rows")
+
+        lines.append((migration.name, state))
+
+    return lines
+
+
+##############################################################################
+# The migrations, oldest first. Never edit one that's been released; add
+# another.
+
+MIGRATIONS = [
+    # backfill_message_ids.py, online: the new ids go in a new column,
+    # filled in batches, and are swapped in at the end in one short step
+    # that also numbers whatever arrived meanwhile. (The unique constraint
+    # on likes.message_id goes with the old column; 0003 drops it anyway.)
+    Migration('0001_snowflake_message_ids',
+              SQL("ALTER TABLE messages ADD COLUMN new_id BIGINT",
+                  "ALTER TABLE likes ADD COLUMN new_message_id BIGINT"),
+              # to number each millisecond's rows; goes with the old id
+              CreateIndex('ix_messages_timestamp_id', 'messages',
+                          'timestamp, id'),
+              Backfill('messages',
+                       f"new_id = {backfill_message_ids.ROW_SNOWFLAKE_ID}",
+                       where="t.new_id IS NULL"),
+              CreateIndex('messages_new_id_key', 'messages', 'new_id',
+                          unique=True),
+              Backfill('likes',
+                       "new_message_id = (SELECT m.new_id FROM messages m "
+                       "WHERE m.id = t.message_id)",
+                       where="t.new_message_id IS NULL"),
+              SQL("LOCK TABLE messages, likes IN ACCESS EXCLUSIVE MODE",
+                  "UPDATE messages t SET new_id = "
+                  f"{backfill_message_ids.ROW_SNOWFLAKE_ID} "
+                  "WHERE t.new_id IS NULL",
+                  "UPDATE likes t SET new_message_id = m.new_id "
+                  "FROM messages m "
+                  "WHERE m.id = t.message_id AND t.new_message_id IS NULL",
+                  "ALTER TABLE likes "
+                  "DROP CONSTRAINT IF EXISTS likes_message_id_fkey",
+                  "ALTER TABLE likes DROP COLUMN message_id",
+                  "ALTER TABLE likes "
+                  "RENAME COLUMN new_message_id TO message_id",
+                  "ALTER TABLE messages DROP COLUMN id",
+                  "DROP SEQUENCE IF EXISTS messages_id_seq",
+                  "ALTER TABLE messages RENAME COLUMN new_id TO id",
+                  "ALTER TABLE messages ADD CONSTRAINT messages_pkey "
+                  "PRIMARY KEY USING INDEX messages_new_id_key",
+                  """
+                  ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey
+                  FOREIGN KEY (message_id) REFERENCES messages (id)
+                  ON DELETE CASCADE NOT VALID""",
+                  "ALTER TABLE messages ALTER COLUMN timestamp "
+                  "SET DEFAULT timezone('utc', now())"),
+              # checks the likes without blocking writes to either table
+              SQL("ALTER TABLE likes VALIDATE CONSTRAINT likes_message_id_fkey"),
+              CreateIndex('ix_messages_user_id_id', 'messages', 'user_id, id')),
+    Migration('0002_partition_messages',
+              RunPython(partitions.convert_to_partitioned),
+              # the archive tier, empty until partitions.py archive; likes
+              # as they are at this point (0003 re-keys both tables)
+              SQL("""
+                  CREATE TABLE messages_archive (
+                      id BIGINT PRIMARY KEY,
+                      text VARCHAR(140) NOT NULL,
+                      timestamp TIMESTAMP NOT NULL
+                          DEFAULT timezone('utc', now()),
+                      user_id INTEGER NOT NULL
+                          REFERENCES users (id) ON DELETE CASCADE
+                  ) PARTITION BY RANGE (id)""",
+                  "CREATE INDEX ix_messages_archive_user_id_id "
+                  "ON messages_archive (user_id, id)",
+                  """
+                  CREATE TABLE likes_archive (
+                      id INTEGER PRIMARY KEY,
+                      user_id INTEGER
+                          REFERENCES users (id) ON DELETE CASCADE,
+                      message_id BIGINT
+                  )""")),
+    # migrate_likes.py, online; likes made meanwhile get the default.
+    Migration('0003_likes_composite_key',
+              SQL("DELETE FROM likes "
+                  "WHERE user_id IS NULL OR message_id IS NULL",
+                  "ALTER TABLE likes "
+                  "ADD COLUMN created_at TIMESTAMP WITHOUT TIME ZONE",
+                  "ALTER TABLE likes "
+                  "ALTER COLUMN created_at SET DEFAULT timezone('utc', now())"),
+              Backfill('likes',
+                       "created_at = (SELECT m.timestamp FROM messages m "
+                       "WHERE m.id = t.message_id)",
+                       where="t.created_at IS NULL"),
+              CreateIndex('likes_user_id_message_id_key', 'likes',
+                          'user_id, message_id', unique=True),
+              CreateIndex('ix_likes_user_id_created_at', 'likes',
+                          'user_id, created_at DESC, message_id'),
+              CreateIndex('ix_likes_message_id', 'likes', 'message_id'),
+              SQL("ALTER TABLE likes ALTER COLUMN created_at SET NOT NULL",
+                  "ALTER TABLE likes "
+                  "DROP CONSTRAINT IF EXISTS likes_message_id_key",
+                  "ALTER TABLE likes DROP COLUMN id",
+                  "ALTER TABLE likes ADD CONSTRAINT likes_pkey "
+                  "PRIMARY KEY USING INDEX likes_user_id_message_id_key",
+                  *migrate_likes.ARCHIVE_STATEMENTS)),
+    Migration('0004_hashtags_and_mentions',
+              SQL("""
+                  CREATE TABLE message_tags (
+                      tag TEXT NOT NULL,
+                      message_id BIGINT NOT NULL
+                          REFERENCES messages (id) ON DELETE CASCADE,
+                      PRIMARY KEY (tag, message_id)
+                  )""",
+                  "CREATE INDEX ix_message_tags_message_id "
+                  "ON message_tags (message_id)",
+                  """
+                  CREATE TABLE mentions (
+                      user_id INTEGER NOT NULL
+                          REFERENCES users (id) ON DELETE CASCADE,
+                      message_id BIGINT NOT NULL
+                          REFERENCES messages (id) ON DELETE CASCADE,
+                      PRIMARY KEY (user_id, message_id)
+                  )""",
+                  "CREATE INDEX ix_mentions_message_id "
+                  "ON mentions (message_id)"),
+              # already-indexed rows are skipped (ON CONFLICT DO NOTHING)
+              PythonBackfill('messages', 't.id, t.text',
+                             hashtags.index_messages)),
+    Migration('0005_jobs_and_notifications',
+              SQL("""
+                  CREATE TABLE jobs (
+                      id BIGSERIAL PRIMARY KEY,
+                      kind VARCHAR(50) NOT NULL,
+                      payload JSONB NOT NULL,
+                      run_at TIMESTAMP NOT NULL
+                          DEFAULT timezone('utc', now()),
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      last_error TEXT,
+                      failed_at TIMESTAMP,
+                      created_at TIMESTAMP NOT NULL
+                          DEFAULT timezone('utc', now())
+                  )""",
+                  "CREATE INDEX ix_jobs_ready ON jobs (run_at, id) "
+                  "WHERE failed_at IS NULL",
+                  """
+                  CREATE TABLE notifications (
+                      user_id INTEGER NOT NULL
+                          REFERENCES users (id) ON DELETE CASCADE,
+                      message_id BIGINT NOT NULL
+                          REFERENCES messages (id) ON DELETE CASCADE,
+                      kind VARCHAR(20) NOT NULL,
+                      created_at TIMESTAMP NOT NULL
+                          DEFAULT timezone('utc', now()),
+                      PRIMARY KEY (user_id, message_id, kind)
+                  )""",
+                  "CREATE INDEX ix_notifications_message_id "
+                  "ON notifications (message_id)")),
+    Migration('0006_replies',
+              # no table rewrite: a constant default is only recorded
+              SQL("ALTER TABLE messages "
+                  "ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0",
+                  "ALTER TABLE messages_archive "
+                  "ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0",
+                  """
+                  CREATE TABLE replies (
+                      message_id BIGINT PRIMARY KEY
+                          REFERENCES messages (id) ON DELETE CASCADE,
+                      parent_id BIGINT NOT NULL,
+                      root_id BIGINT NOT NULL,
+                      path BIGINT[] NOT NULL
+                  )""",
+                  "CREATE INDEX ix_replies_root_id_path "
+                  "ON replies (root_id, path)",
+                  *REPLY_COUNT_DDL)),
+    Migration('0007_follow_changes',
+              SQL("""
+                  CREATE TABLE follow_changes (
+                      id BIGSERIAL PRIMARY KEY,
+                      xid BIGINT NOT NULL DEFAULT txid_current(),
+                      user_following_id INTEGER NOT NULL,
+                      user_being_followed_id INTEGER NOT NULL,
+                      followed BOOLEAN NOT NULL
+                  )""",
+                  "CREATE INDEX ix_follow_changes_xid "
+                  "ON follow_changes (xid)",
+                  *FOLLOW_CHANGES_DDL)),
+    Migration('0008_ingest_keys',
+              SQL("""
+                  CREATE TABLE ingest_keys (
+                      key VARCHAR(64) PRIMARY KEY,
+                      message_id BIGINT NOT NULL
+                  )""")),
+    Migration('0009_rate_limit_buckets',
+              SQL("""
+                  CREATE TABLE rate_limit_buckets (
+                      key TEXT PRIMARY KEY,
+                      tokens FLOAT NOT NULL,
+                      updated_at FLOAT NOT NULL,
+                      allowed BOOLEAN NOT NULL
+                  )""")),
+    Migration('0010_follows_following_index',
+              CreateIndex('ix_follows_following_followed', 'follows',
+                          'user_following_id, user_being_followed_id')),
+]
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    create_app()
+    command, *args = sys.argv[1:] or ['status']
+    upto = args[0] if args else None
+
+    if command == 'run':
+        for name in migrate(db.engine, upto):
+            print(f"Applied {name}")
+    elif command == 'stamp':
+        stamp(db.engine, upto)
+    elif command == 'status':
+        for name, state in status(db.engine):
+            print(f"{name:40} {state}")
+    else:
+        sys.exit(__doc__)
@@ -1,9 +1,11 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
-
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+
+from partitions import create_initial_partitions
+from snowflake import next_message_id
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -26,28 +28,135 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "followers of X"; this serves "X follows".
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def relationships(cls, viewer_id, user_ids):
+        """Which of `user_ids` does `viewer_id` follow, and which follow them?
+
+        One query for the whole list. Returns two sets of ids:
+        (followed by the viewer, following the viewer).
+        """
+
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set(), set()
+
+        rows = (db.session
+                .query(cls.user_being_followed_id, cls.user_following_id)
+                .filter(db.or_(
+                    db.and_(cls.user_following_id == viewer_id,
+                            cls.user_being_followed_id.in_(user_ids)),
+                    db.and_(cls.user_being_followed_id == viewer_id,
+                            cls.user_following_id.in_(user_ids))))
+                .all())
+
+        following = {followed for followed, follower in rows
+                     if follower == viewer_id}
+        followers = {follower for followed, follower in rows
+                     if followed == viewer_id}
+
+        return following, followers
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Follow a user; following them again is a no-op.
+
+        One INSERT, without loading either side's follows. Returns
+        whether a new follow was made. Raises IntegrityError if either
+        user doesn't exist. Doesn't commit.
+        """
+
+        stmt = (postgresql.insert(cls.__table__)
+                .values(user_following_id=follower_id,
+                        user_being_followed_id=followed_id)
+                .on_conflict_do_nothing())
+
+        return db.session.execute(stmt).rowcount == 1
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Unfollow a user; unfollowing one you don't follow is a no-op.
+
+        Returns whether a follow was removed. Doesn't commit.
+        """
+
+        return cls.query.filter_by(
+            user_following_id=follower_id,
+            user_being_followed_id=followed_id).delete() == 1
+
+    @classmethod
+    def add_by_username(cls, follower_id, usernames):
+        """Follow every user named in `usernames`, except yourself.
+
+        One INSERT ... SELECT however many names there are; names of
+        nobody and users already followed are skipped. Returns how many
+        new follows were made. Doesn't commit.
+        """
+
+        users = User.__table__
+        names = db.literal(list(usernames), type_=postgresql.ARRAY(db.Text))
+
+        stmt = (postgresql.insert(cls.__table__)
+                .from_select(
+                    ['user_being_followed_id', 'user_following_id'],
+                    db.select([users.c.id, db.literal(follower_id)])
+                    .where(users.c.username == db.any_(names))
+                    .where(users.c.id != follower_id))
+                .on_conflict_do_nothing())
+
+        return db.session.execute(stmt).rowcount
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
-
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
+    __tablename__ = 'likes'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    # "my likes, newest first" is an index-only scan; the message_id index
+    # serves cascades, like counts and moving likes to the archive.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_created_at',
+                 'user_id', db.text('created_at DESC'), 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like a warble; liking it again is a no-op.
+
+        Returns whether a new like was made. Doesn't commit.
+        """
+
+        stmt = (postgresql.insert(cls.__table__)
+                .values(user_id=user_id, message_id=message_id)
+                .on_conflict_do_nothing())
+
+        return db.session.execute(stmt).rowcount == 1
+
 
 class User(db.Model):
     """User in the system."""
@@ -175,11 +284,212 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # Feeds are "this set of authors, newest first", served off this index.
+    # The table is split into monthly id ranges; see partitions.py.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
+
+    # Snowflake-style ids (see snowflake.py) are time-sortable, so feeds
+    # order and paginate on the primary key alone.
     id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        default=next_message_id,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # Direct replies; kept up by a trigger on `replies` (see Reply).
+    reply_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='0',
+    )
+
+    user = db.relationship('User')
+
+
+db.event.listen(Message.__table__, 'after_create', create_initial_partitions)
+
+
+class MessageTag(db.Model):
+    """A #hashtag in a warble (see hashtags.py)."""
+
+    __tablename__ = 'message_tags'
+
+    # Keyed (tag, message_id): a tag page is a range read, newest first.
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # serves cascades and archiving
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a warble (see hashtags.py)."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
         db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
         primary_key=True,
     )
 
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+
+class Reply(db.Model):
+    """A reply's place in its conversation (see threads.py)."""
+
+    __tablename__ = 'replies'
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Not foreign keys: replies keep their place when the warble they
+    # answer is deleted or archived.
+    parent_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    root_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    # Ids from the root down to this reply.
+    path = db.Column(
+        postgresql.ARRAY(db.BigInteger),
+        nullable=False,
+    )
+
+    # A conversation, or any warble's part of it, is a range of this.
+    __table_args__ = (
+        db.Index('ix_replies_root_id_path', 'root_id', 'path'),
+    )
+
+
+# messages.reply_count follows the rows of `replies`, however they come
+# and go (cascades included). A reply archived with its month, so still
+# in `messages` when its row is dropped, keeps counting.
+REPLY_COUNT_DDL = (
+    """
+    CREATE OR REPLACE FUNCTION count_replies() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE messages SET reply_count = reply_count + 1
+            WHERE id = NEW.parent_id;
+        ELSIF NOT EXISTS (SELECT 1 FROM messages WHERE id = OLD.message_id) THEN
+            UPDATE messages SET reply_count = reply_count - 1
+            WHERE id = OLD.parent_id;
+        END IF;
+
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER replies_count_replies AFTER INSERT OR DELETE ON replies
+    FOR EACH ROW EXECUTE FUNCTION count_replies()
+    """,
+)
+
+for statement in REPLY_COUNT_DDL:
+    db.event.listen(Reply.__table__, 'after_create', db.DDL(statement))
+
+
+# Profile stats, as counts instead of loading whole collections. Deferred
+# in one group: the first one read loads all four in a single query.
+
+User.message_count = db.column_property(
+    db.select([db.func.count(Message.id)])
+    .where(Message.user_id == User.id)
+    .correlate_except(Message),
+    deferred=True, group='stats')
+
+User.following_count = db.column_property(
+    db.select([db.func.count()])
+    .select_from(Follows.__table__)
+    .where(Follows.user_following_id == User.id)
+    .correlate_except(Follows),
+    deferred=True, group='stats')
+
+User.followers_count = db.column_property(
+    db.select([db.func.count()])
+    .select_from(Follows.__table__)
+    .where(Follows.user_being_followed_id == User.id)
+    .correlate_except(Follows),
+    deferred=True, group='stats')
+
+User.likes_count = db.column_property(
+    db.select([db.func.count()])
+    .select_from(Likes.__table__)
+    .where(Likes.user_id == User.id)
+    .correlate_except(Likes),
+    deferred=True, group='stats')
+
+
+class ArchivedMessage(db.Model):
+    """A warble in a cold partition, moved out of `messages`.
+
+    Same columns as Message; partitions are detached from `messages` and
+    attached here by partitions.archive_partitions.
+    """
+
+    __tablename__ = 'messages_archive'
+
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_id', 'user_id', 'id'),
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
     text = db.Column(
         db.String(140),
         nullable=False,
@@ -188,7 +498,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=db.text("timezone('utc', now())"),
     )
 
     user_id = db.Column(
@@ -197,9 +507,253 @@ class Message(db.Model):
         nullable=False,
     )
 
+    reply_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
 
+class ArchivedLike(db.Model):
+    """A like of an archived warble.
+
+    Same columns, in the same order, as Likes.
+    """
+
+    __tablename__ = 'likes_archive'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Notification(db.Model):
+    """Something for a user to see; written by background jobs (jobs.py)."""
+
+    __tablename__ = 'notifications'
+
+    # Keyed like the feeds: a user's notifications, newest warble first,
+    # are a range read, and delivering one twice is a no-op.
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(20),
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    __table_args__ = (
+        db.Index('ix_notifications_message_id', 'message_id'),
+    )
+
+
+class Job(db.Model):
+    """A queued unit of background work (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        postgresql.JSONB,
+        nullable=False,
+    )
+
+    # not before; pushed back after each failed attempt
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='0',
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # set when it's out of attempts; it then stays for a human to look at
+    failed_at = db.Column(
+        db.DateTime,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("timezone('utc', now())"),
+    )
+
+    # workers take the oldest ready jobs off this
+    __table_args__ = (
+        db.Index('ix_jobs_ready', 'run_at', 'id',
+                 postgresql_where=db.text('failed_at IS NULL')),
+    )
+
+
+class RateLimitBucket(db.Model):
+    """Token bucket state for the shared login throttle (see throttle.py)."""
+
+    __tablename__ = 'rate_limit_buckets'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # epoch seconds, from the database clock
+    updated_at = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # whether the most recent take succeeded
+    allowed = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+
+class IngestKey(db.Model):
+    """An ingested post's idempotency key (see ingest.py).
+
+    A post sent again, in any later batch, has the same key, so it isn't
+    inserted twice.
+    """
+
+    __tablename__ = 'ingest_keys'
+
+    # sha256, in hex, of the client's id for the post, or of its author,
+    # timestamp and text
+    key = db.Column(
+        db.String(64),
+        primary_key=True,
+    )
+
+    # no foreign key: the key outlives the message moving to the archive
+    message_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
+class FollowChange(db.Model):
+    """A follow or unfollow, logged for the follow graph (see followgraph.py).
+
+    Written by a trigger on `follows` (FOLLOW_CHANGES_DDL), so it catches
+    every change, cascades included; followgraph.build_snapshot prunes it.
+    """
+
+    __tablename__ = 'follow_changes'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    # the writing transaction, to tell which changes a snapshot has seen
+    xid = db.Column(
+        db.BigInteger,
+        nullable=False,
+        server_default=db.text('txid_current()'),
+    )
+
+    # no foreign keys: a deleted user's follows still need unlogging
+    user_following_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    user_being_followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # True for a follow, False for an unfollow
+    followed = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_follow_changes_xid', 'xid'),
+    )
+
+
+FOLLOW_CHANGES_DDL = (
+    """
+    CREATE OR REPLACE FUNCTION log_follow_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO follow_changes
+                (user_following_id, user_being_followed_id, followed)
+            VALUES (NEW.user_following_id, NEW.user_being_followed_id, TRUE);
+        ELSE
+            INSERT INTO follow_changes
+                (user_following_id, user_being_followed_id, followed)
+            VALUES (OLD.user_following_id, OLD.user_being_followed_id, FALSE);
+        END IF;
+
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER follows_log_follow_change AFTER INSERT OR DELETE ON follows
+    FOR EACH ROW EXECUTE FUNCTION log_follow_change()
+    """,
+)
+
+for statement in FOLLOW_CHANGES_DDL:
+    db.event.listen(Follows.__table__, 'after_create', db.DDL(statement))
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -208,3 +762,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
@@ -0,0 +1,292 @@
+"""Monthly range partitions for the messages table.
+
+`messages` is partitioned by RANGE (id). Message ids are snowflakes (see
+snowflake.py), so each id range is a time range, and the feeds' ORDER BY
+id DESC ... LIMIT only reaches into the newest partitions.
+
+Layout:
+
+- messages_history: everything before the month the table was created in
+- messages_YYYY_MM: one partition per month after that
+
+Cold partitions are detached and re-attached under `messages_archive`
+(the archive tier), with their likes moved to `likes_archive` and their
+tag, mention, notification and reply rows dropped, so the live table's
+indexes and vacuum work only cover recent warbles.
+
+The app creates missing monthly partitions as it warms up (app.warmup),
+and the job queue does every PARTITION_INTERVAL (see jobs.py), warning
+in the log when fewer than MIN_MONTHS_AHEAD months were ready. Run from
+cron (or by hand):
+
+    python partitions.py ensure     # create this month + MONTHS_AHEAD
+    python partitions.py archive    # archive months older than ARCHIVE_AFTER_MONTHS
+
+An existing database (after backfill_message_ids.py) is moved over once with:
+
+    python partitions.py convert
+"""
+
+import logging
+import re
+import sys
+from datetime import datetime
+
+from sqlalchemy import text
+
+from snowflake import snowflake_from_datetime, snowflake_to_datetime
+
+logger = logging.getLogger(__name__)
+
+LIVE_TABLE = 'messages'
+ARCHIVE_TABLE = 'messages_archive'
+HISTORY_PARTITION = 'messages_history'
+
+# Tables with rows per live warble (hashtags.py, jobs.py, threads.py),
+# emptied of a month's rows when it's archived.
+LIVE_ONLY_TABLES = ('message_tags', 'mentions', 'notifications', 'replies')
+
+MONTHS_AHEAD = 2
+MIN_MONTHS_AHEAD = 1
+ARCHIVE_AFTER_MONTHS = 12
+
+BOUND_RE = re.compile(r"FROM \((?:'?(-?\d+)'?|MINVALUE)\) TO \('?(-?\d+)'?\)")
+
+
+def month_start(dt, offset=0):
+    """First instant of the month `offset` months from `dt`'s month."""
+
+    months = dt.year * 12 + (dt.month - 1) + offset
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(start):
+    """Name of the live partition holding the month beginning at `start`."""
+
+    return f"{LIVE_TABLE}_{start:%Y_%m}"
+
+
+def create_initial_partitions(target, connection, **kw):
+    """Create the history partition and the first monthly partitions.
+
+    Registered as an after_create listener on the messages table.
+    """
+
+    now = datetime.utcnow()
+
+    connection.execute(text(
+        f"CREATE TABLE {HISTORY_PARTITION} PARTITION OF {LIVE_TABLE} "
+        f"FOR VALUES FROM (MINVALUE) "
+        f"TO ({snowflake_from_datetime(month_start(now))})"))
+
+    ensure_partitions(connection, now=now)
+
+
+def ensure_partitions(connection, now=None, months_ahead=MONTHS_AHEAD):
+    """Create any missing monthly partitions up to `months_ahead` months on.
+
+    Starts from the month after the newest partition, if that's before
+    this one, so months missed while nothing ran (which back-dated
+    ingests can still land in) aren't left as a gap.
+
+    Returns the names of the partitions created.
+    """
+
+    now = now or datetime.utcnow()
+    partitions = list_partitions(connection)
+    covered = max((upper for name, lower, upper in partitions), default=None)
+    created = []
+
+    start = month_start(now)
+    if covered is not None:
+        start = min(start, month_start(snowflake_to_datetime(covered)))
+
+    while start <= month_start(now, months_ahead):
+        name = partition_name(start)
+
+        # not already there, or inside the history partition
+        if covered is None or snowflake_from_datetime(start) >= covered:
+            connection.execute(text(
+                f"CREATE TABLE {name} PARTITION OF {LIVE_TABLE} "
+                f"FOR VALUES FROM ({snowflake_from_datetime(start)}) "
+                f"TO ({snowflake_from_datetime(month_start(start, 1))})"))
+            created.append(name)
+
+        start = month_start(start, 1)
+
+    return created
+
+
+def months_ahead(connection, now=None):
+    """How many whole months after this one have partitions already."""
+
+    now = now or datetime.utcnow()
+    covered = max((upper for name, lower, upper in list_partitions(connection)),
+                  default=None)
+    months = 0
+
+    while (covered is not None
+           and snowflake_from_datetime(month_start(now, months + 2))
+           <= covered):
+        months += 1
+
+    return months
+
+
+def maintain_partitions(connection, now=None):
+    """ensure_partitions, warning first if it had been left too long.
+
+    Returns the names of the partitions created.
+    """
+
+    ahead = months_ahead(connection, now)
+    if ahead < MIN_MONTHS_AHEAD:
+        logger.warning("Only %d month(s) of message partitions were ready "
+                       "ahead; is the partition job running?", ahead)
+
+    created = ensure_partitions(connection, now=now)
+    for name in created:
+        logger.info("Created partition %s", name)
+
+    return created
+
+
+def convert_to_partitioned(connection, now=None):
+    """Turn an existing, unpartitioned messages table into a partitioned one.
+
+    The old table is renamed and attached as the history partition,
+    covering everything up to the start of next month; monthly partitions
+    follow from there. Attaching has to scan the old table once to check
+    its ids fit the range.
+    """
+
+    now = now or datetime.utcnow()
+    history_end = snowflake_from_datetime(month_start(now, 1))
+
+    for statement in [
+        "ALTER TABLE likes DROP CONSTRAINT likes_message_id_fkey",
+        f"ALTER TABLE {LIVE_TABLE} RENAME TO {HISTORY_PARTITION}",
+        f"ALTER TABLE {HISTORY_PARTITION} "
+        f"RENAME CONSTRAINT messages_pkey TO {HISTORY_PARTITION}_pkey",
+        f"ALTER TABLE {HISTORY_PARTITION} "
+        f"RENAME CONSTRAINT messages_user_id_fkey "
+        f"TO {HISTORY_PARTITION}_user_id_fkey",
+        f"ALTER INDEX ix_messages_user_id_id "
+        f"RENAME TO {HISTORY_PARTITION}_user_id_id_idx",
+
+        f"CREATE TABLE {LIVE_TABLE} "
+        f"(LIKE {HISTORY_PARTITION} INCLUDING DEFAULTS) PARTITION BY RANGE (id)",
+        f"ALTER TABLE {LIVE_TABLE} ADD PRIMARY KEY (id)",
+        f"ALTER TABLE {LIVE_TABLE} ADD CONSTRAINT messages_user_id_fkey "
+        f"FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE",
+        f"CREATE INDEX ix_messages_user_id_id ON {LIVE_TABLE} (user_id, id)",
+        f"ALTER TABLE {LIVE_TABLE} ATTACH PARTITION {HISTORY_PARTITION} "
+        f"FOR VALUES FROM (MINVALUE) TO ({history_end})",
+
+        "ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey "
+        "FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE",
+    ]:
+        connection.execute(text(statement))
+
+    return ensure_partitions(connection, now=now)
+
+
+def list_partitions(connection, parent=LIVE_TABLE):
+    """Return (name, lower, upper) for each partition of `parent`.
+
+    Bounds are message ids; `lower` is None for a MINVALUE bound.
+    """
+
+    rows = connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:parent AS regclass) "
+        "ORDER BY c.relname"), parent=parent)
+
+    partitions = []
+
+    for name, bound in rows:
+        match = BOUND_RE.search(bound)
+        lower, upper = match.groups()
+        partitions.append((name,
+                           int(lower) if lower is not None else None,
+                           int(upper)))
+
+    return partitions
+
+
+def archive_partitions(connection, now=None,
+                       older_than_months=ARCHIVE_AFTER_MONTHS,
+                       tablespace=None):
+    """Move live partitions that end before the cutoff to the archive tier.
+
+    Likes of the archived warbles move to likes_archive in the same
+    transaction (they can't keep a foreign key into a detached partition).
+    If `tablespace` is given, archived partitions are moved onto it.
+
+    Returns the names of the partitions archived.
+    """
+
+    now = now or datetime.utcnow()
+    cutoff = snowflake_from_datetime(month_start(now, -older_than_months))
+    archived = []
+
+    for name, lower, upper in list_partitions(connection):
+        if upper > cutoff:
+            continue
+
+        lower_sql = 'MINVALUE' if lower is None else str(lower)
+        id_range = "message_id < :upper"
+        if lower is not None:
+            id_range += " AND message_id >= :lower"
+
+        connection.execute(text(
+            f"WITH moved AS (DELETE FROM likes WHERE {id_range} RETURNING *) "
+            f"INSERT INTO likes_archive (user_id, message_id, created_at) "
+            f"SELECT user_id, message_id, created_at FROM moved"),
+            lower=lower, upper=upper)
+
+        # tag pages, mention feeds, notifications and conversations only
+        # cover the live tier
+        for table in LIVE_ONLY_TABLES:
+            connection.execute(text(
+                f"DELETE FROM {table} WHERE {id_range}"),
+                lower=lower, upper=upper)
+
+        connection.execute(text(
+            f"ALTER TABLE {LIVE_TABLE} DETACH PARTITION {name}"))
+        connection.execute(text(
+            f"ALTER TABLE {ARCHIVE_TABLE} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ({lower_sql}) TO ({upper})"))
+
+        if tablespace:
+            connection.execute(text(
+                f"ALTER TABLE {name} SET TABLESPACE {tablespace}"))
+
+        archived.append(name)
+
+    return archived
+
+
+if __name__ == '__main__':
+    from app import create_app
+    from models import db
+
+    create_app()
+
+    commands = {
+        'ensure': maintain_partitions,
+        'archive': archive_partitions,
+        'convert': convert_to_partitioned,
+    }
+
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit(f"usage: python partitions.py {'|'.join(commands)}")
+
+    with db.engine.begin() as conn:
+        for name in commands[sys.argv[1]](conn):
+            print(name)
+
+    if sys.argv[1] == 'convert':
+        # messages_archive and likes_archive
+        db.create_all()
@@ -0,0 +1,262 @@
+"""On-demand sampling profiler for individual requests.
+
+When a route is slow in production, profile the next few requests to it
+instead of attaching a debugger. A profiled request gets a sampler
+thread that looks at the request thread's stack every PROFILE_INTERVAL
+seconds; requests that aren't profiled pay for one header lookup.
+
+A request is profiled when PROFILE_REQUESTS is on and either:
+
+- it carries an X-Profile header with a token signed by SECRET_KEY
+  (`python profiling.py token` prints one, good for PROFILE_TOKEN_MAX_AGE)
+- it's picked at random, for a PROFILE_SAMPLE_RATE fraction of requests
+
+Each profile is written to PROFILE_DIR in collapsed-stack format, one
+"frame;frame;frame count" line per distinct stack, which flamegraph.pl,
+speedscope and most flamegraph tools read directly:
+
+    GET /users/<int:user_id>;flask.app:dispatch_request;app:users_show;feed:hydrate;[sql] 12
+
+Stacks start at Flask's request dispatch. Frames are module:function, templates are
+template:block, and the SQLAlchemy/driver internals under a query are
+folded into one [sql] frame, so each sample's leaf says where the time
+went. The totals per kind (sql, template, python) are logged and sent
+back in Server-Timing.
+
+Only the newest PROFILE_KEEP files are kept; pull them off the host
+with scp or the like. Streamed responses (exports) are profiled up to
+the first byte.
+"""
+
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Profile'
+SALT = 'warbler-profile'
+
+# Library code under these is folded into a single [sql] frame.
+SQL_MODULES = ('sqlalchemy', 'flask_sqlalchemy', 'psycopg2')
+
+
+def serializer(app):
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=SALT)
+
+
+def make_token(app):
+    """A token that turns on profiling for requests that send it."""
+
+    return serializer(app).dumps('profile')
+
+
+def token_ok(app, token):
+    try:
+        serializer(app).loads(
+            token, max_age=app.config['PROFILE_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+
+    return True
+
+
+def frame_label(frame):
+    """(label, kind) for one stack frame."""
+
+    code = frame.f_code
+
+    # compiled templates keep the template's file name
+    if code.co_filename.endswith('.html'):
+        name = frame.f_globals.get('name') or os.path.basename(code.co_filename)
+        return f"{name}:{code.co_name}", 'template'
+
+    module = frame.f_globals.get('__name__', '?')
+
+    if module.startswith(SQL_MODULES):
+        return '[sql]', 'sql'
+
+    return f"{module}:{code.co_name}", 'python'
+
+
+def collapse(frame):
+    """The labels of `frame`'s stack from Flask's dispatch down, and its kind.
+
+    Frames above Flask's dispatch (the server, WSGI middleware) are
+    dropped; everything below the first SQL frame is one [sql] frame.
+    """
+
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+
+    frames.reverse()
+
+    for i, f in enumerate(frames):
+        if (f.f_code.co_name == 'full_dispatch_request'
+                and f.f_globals.get('__name__') == 'flask.app'):
+            frames = frames[i + 1:]
+            break
+
+    labels = []
+    kind = 'python'
+
+    for f in frames:
+        label, frame_kind = frame_label(f)
+        labels.append(label)
+
+        if frame_kind == 'sql':
+            kind = 'sql'
+            break
+
+        if frame_kind == 'template':
+            kind = 'template'
+
+    return labels, kind
+
+
+class Sampler:
+    """Samples one thread's stack on a background thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.kinds = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is None:
+                continue
+
+            labels, kind = collapse(frame)
+            self.stacks[tuple(labels)] += 1
+            self.kinds[kind] += 1
+
+            del frame
+
+    def seconds_by_kind(self):
+        """Sampled time per kind, scaled to the measured wall time."""
+
+        samples = sum(self.kinds.values())
+
+        return {kind: self.elapsed * self.kinds[kind] / samples if samples else 0.0
+                for kind in ('sql', 'template', 'python')}
+
+
+def write_profile(directory, keep, name, root, stacks):
+    """Write `stacks` as a collapsed-stack file; keep the newest `keep`.
+
+    Returns the file's path.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    # time first, so names sort oldest first
+    path = os.path.join(
+        directory, f"{time.time_ns()}-{os.getpid()}-{name}.collapsed")
+
+    with open(path + '.tmp', 'w') as f:
+        for labels, count in stacks.most_common():
+            f.write(';'.join((root,) + labels) + f" {count}\n")
+
+    os.replace(path + '.tmp', path)
+
+    with os.scandir(directory) as entries:
+        profiles = sorted(entry.name for entry in entries
+                          if entry.name.endswith('.collapsed'))
+
+    for old in profiles[:-keep]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except FileNotFoundError:
+            # another worker got there first
+            pass
+
+    return path
+
+
+def init_profiling(app):
+    """Turn on request profiling for `app`.
+
+    Call before registering blueprints, so the sampler is already
+    running for their before_request functions.
+    """
+
+    directory = app.config['PROFILE_DIR']
+    keep = app.config['PROFILE_KEEP']
+    interval = app.config['PROFILE_INTERVAL']
+    rate = app.config['PROFILE_SAMPLE_RATE']
+
+    @app.before_request
+    def start_profile():
+        token = request.headers.get(HEADER)
+
+        if token and token_ok(app, token) or rate and random.random() < rate:
+            g.profiler = Sampler(threading.get_ident(), interval)
+            g.profiler.start()
+
+    @app.after_request
+    def finish_profile(resp):
+        sampler = g.pop('profiler', None)
+
+        if sampler is None:
+            return resp
+
+        sampler.stop()
+
+        root = f"{request.method} {request.url_rule or request.path}"
+        path = write_profile(directory, keep, request.endpoint or 'none',
+                             root, sampler.stacks)
+        seconds = sampler.seconds_by_kind()
+
+        logger.info("Profiled %s in %.1fms (%s): %s", root,
+                    sampler.elapsed * 1000,
+                    ", ".join(f"{kind} {s * 1000:.1f}ms"
+                              for kind, s in seconds.items()),
+                    path)
+
+        resp.headers.add('Server-Timing', ", ".join(
+            f"prof-{kind};dur={s * 1000:.2f}" for kind, s in seconds.items()))
+        resp.headers[HEADER] = os.path.basename(path)
+
+        return resp
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # after_request doesn't run for an unhandled exception
+        sampler = g.pop('profiler', None)
+
+        if sampler is not None:
+            sampler.stop()
+
+
+if __name__ == '__main__':
+    from app import create_app
+
+    if sys.argv[1:] != ['token']:
+        sys.exit(__doc__)
+
+    print(make_token(create_app()))
@@ -0,0 +1,50 @@
+"""Users as the read-only pages show them.
+
+Loading a User through the ORM to render a profile header or a card
+brings the identity map, change tracking and every column (password
+hash included) along for the few attributes Jinja reads. The pages that
+only show users select just those columns, with Core, as named tuples,
+the way feed.hydrate does for warbles. Pages that change a user keep
+using the ORM, as does g.user.
+
+bench_read_models.py measures the difference.
+"""
+
+from collections import namedtuple
+
+from models import db, User
+
+users = User.__table__
+
+# All a user card shows (/users, followers, following).
+CARD_COLUMNS = (
+    users.c.id, users.c.username, users.c.image_url,
+    users.c.header_image_url, users.c.bio)
+
+UserCard = namedtuple('UserCard', [column.key for column in CARD_COLUMNS])
+
+# A profile page's header: the card, where they are and the stats.
+PROFILE_COLUMNS = CARD_COLUMNS + (
+    users.c.location,
+    User.message_count.expression.label('message_count'),
+    User.following_count.expression.label('following_count'),
+    User.followers_count.expression.label('followers_count'),
+    User.likes_count.expression.label('likes_count'),
+)
+
+Profile = namedtuple('Profile', [column.key for column in PROFILE_COLUMNS])
+
+
+def user_cards(query):
+    """UserCards for the rows of `query`, a select of CARD_COLUMNS."""
+
+    return [UserCard(*row) for row in db.session.execute(query)]
+
+
+def load_profile(user_id):
+    """The Profile of `user_id`, or None if there's no such user."""
+
+    row = db.session.execute(
+        db.select(PROFILE_COLUMNS).where(users.c.id == user_id)).first()
+
+    return Profile(*row) if row else None
@@ -1,20 +1,38 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
+from app import create_app
+from hashtags import index_all_messages
+from migrations import stamp
+from models import db, User, Message, Follows
+from snowflake import snowflake_from_datetime
 
 
+def message_rows(reader):
+    """Give each CSV message a snowflake id matching its timestamp."""
+
+    for i, row in enumerate(reader):
+        timestamp = datetime.fromisoformat(row['timestamp'])
+        row['id'] = snowflake_from_datetime(timestamp, low_bits=i)
+        yield row
+
+
+create_app()
+
 db.drop_all()
 db.create_all()
+stamp(db.engine)
 
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.bulk_insert_mappings(Message, list(message_rows(DictReader(messages))))
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+index_all_messages(db.session.connection())
+
 db.session.commit()
@@ -0,0 +1,224 @@
+"""Time-sortable 64-bit ids for Warbler messages.
+
+Ids are laid out snowflake-style, from the high bit down:
+
+    41 bits  milliseconds since WARBLER_EPOCH
+    10 bits  worker id
+    12 bits  per-millisecond sequence
+
+so sorting by id sorts by creation time, and the id alone is enough to
+order and paginate a feed.
+
+Two processes minting with the same worker id can mint the same id, so
+each needs one nobody else has:
+
+- WARBLER_WORKER_ID in the environment, for a process started on its own
+- otherwise, once lease_from() has been given an engine (production
+  does, see app.create_app), the lowest id no other process holds, held
+  with a Postgres advisory lock for as long as the process lives
+- otherwise (development, tests, scripts) one derived from the pid
+
+The highest worker id, INGEST_WORKER_ID, is never handed out: bulk
+ingestion (ingest.py) mints history with it.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+# 2010-01-01T00:00:00Z, in milliseconds. Early enough that the seed data
+# (and any imported history) still gets positive ids.
+WARBLER_EPOCH_MS = 1262304000000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# Reserved for ingest.py; live workers get ids below it.
+INGEST_WORKER_ID = MAX_WORKER_ID
+
+# Advisory lock keys of worker id leases are (LEASE_LOCK_SPACE, worker id).
+LEASE_LOCK_SPACE = 0x57424c52
+
+
+def check_worker_id(worker_id):
+    """`worker_id`, if a live worker may use it; ValueError if not."""
+
+    if not 0 <= worker_id < INGEST_WORKER_ID:
+        raise ValueError(f"worker id {worker_id} isn't in 0-"
+                         f"{INGEST_WORKER_ID - 1}")
+
+    return worker_id
+
+
+def _environment_worker_id():
+    """The worker id from WARBLER_WORKER_ID, or None if it isn't set."""
+
+    worker_id = os.environ.get('WARBLER_WORKER_ID')
+
+    if worker_id is None:
+        return None
+
+    try:
+        return check_worker_id(int(worker_id))
+    except ValueError as e:
+        raise ValueError(f"bad WARBLER_WORKER_ID {worker_id!r}: {e}")
+
+
+def _default_worker_id():
+    """Worker id from WARBLER_WORKER_ID, else derived from our pid."""
+
+    worker_id = _environment_worker_id()
+
+    if worker_id is not None:
+        return worker_id
+
+    return os.getpid() % INGEST_WORKER_ID
+
+
+def lease_worker_id(engine):
+    """Take the lowest worker id no other process has leased.
+
+    Returns (worker_id, connection). The lease is a session advisory lock
+    on `connection`, which is taken out of the pool: it's released when
+    the connection closes, or the process holding it dies.
+    """
+
+    connection = engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT')
+    connection.detach()
+
+    try:
+        for worker_id in range(INGEST_WORKER_ID):
+            if connection.execute(
+                    "SELECT pg_try_advisory_lock(%s, %s)",
+                    LEASE_LOCK_SPACE, worker_id).scalar():
+                return worker_id, connection
+    except Exception:
+        connection.close()
+        raise
+
+    connection.close()
+    raise RuntimeError("every worker id is leased")
+
+
+class SnowflakeGenerator:
+    """Thread-safe generator of monotonically increasing snowflake ids.
+
+    The worker id is re-derived after a fork, so each pre-forked server
+    worker gets its own id space.
+    """
+
+    def __init__(self, worker_id=None):
+        if worker_id is not None:
+            check_worker_id(worker_id)
+
+        self._fixed_worker_id = worker_id
+        self._lease_engine = None
+        self._lease = None
+        # leases inherited over a fork: the parent's, not ours to close
+        self._inherited = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def lease_from(self, engine):
+        """Lease worker ids from `engine`'s database, unless the
+        environment sets one (see lease_worker_id).
+
+        Checks WARBLER_WORKER_ID now, so a bad one fails at startup.
+        """
+
+        _environment_worker_id()
+
+        with self._lock:
+            self._lease_engine = engine
+
+    def _reset(self):
+        if self._lease is not None:
+            self._inherited.append(self._lease)
+            self._lease = None
+
+        self.worker_id = self._fixed_worker_id
+
+        if self.worker_id is None:
+            self.worker_id = _environment_worker_id()
+
+        if self.worker_id is None and self._lease_engine is not None:
+            self.worker_id, self._lease = lease_worker_id(self._lease_engine)
+
+        if self.worker_id is None:
+            self.worker_id = _default_worker_id()
+
+        self._pid = os.getpid()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def claim(self):
+        """This process's worker id, leasing it now if need be.
+
+        Servers call it as a worker starts, so a worker that can't get one
+        fails then rather than on its first write.
+        """
+
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._reset()
+
+            return self.worker_id
+
+    def __call__(self):
+        return self.next_id()
+
+    def next_id(self):
+        """Return a new id, strictly greater than any previously returned."""
+
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._reset()
+
+            now_ms = int(time.time() * 1000)
+
+            # never go backwards, even if the wall clock does
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+
+                if self._sequence == MAX_SEQUENCE:
+                    # sequence exhausted for this millisecond: borrow the next
+                    now_ms += 1
+                    self._sequence = 0
+                else:
+                    self._sequence += 1
+            else:
+                self._sequence = 0
+
+            self._last_ms = now_ms
+
+            return (((now_ms - WARBLER_EPOCH_MS) << TIMESTAMP_SHIFT)
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self._sequence)
+
+
+next_message_id = SnowflakeGenerator()
+
+
+def snowflake_from_datetime(dt, low_bits=0):
+    """Build an id for a naive UTC datetime.
+
+    `low_bits` fills the worker/sequence part; the backfill uses it to keep
+    rows created in the same millisecond distinct. Passing 0 gives the
+    smallest id for that millisecond, which is handy as a range bound.
+    """
+
+    ms = int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+    return ((ms - WARBLER_EPOCH_MS) << TIMESTAMP_SHIFT) | low_bits
+
+
+def snowflake_to_datetime(snowflake_id):
+    """Return the naive UTC datetime a snowflake id was minted at."""
+
+    ms = (snowflake_id >> TIMESTAMP_SHIFT) + WARBLER_EPOCH_MS
+    return datetime.utcfromtimestamp(ms / 1000)
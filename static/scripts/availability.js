@@ -0,0 +1,37 @@
+// Say whether a username is free while it's typed, from /users/available
+// (see availability.py). The server checks again on submit, e-mail
+// addresses included; this only saves a round trip to find out.
+$(function () {
+  $('#user_form').find('#username').each(function () {
+    var $input = $(this);
+    var $note = $('<small class="form-text"></small>').insertAfter($input);
+    var timer;
+
+    $input.on('input', function () {
+      clearTimeout(timer);
+      $note.text('');
+
+      var value = $.trim($input.val());
+      if (!value) {
+        return;
+      }
+
+      timer = setTimeout(function () {
+        var params = {};
+        params[$input.attr('name')] = value;
+
+        $.getJSON('/users/available', params, function (result) {
+          // typed on since
+          if ($.trim($input.val()) !== value) {
+            return;
+          }
+
+          var available = result[$input.attr('name')];
+          $note.text(available ? 'Available' : 'Already taken')
+               .toggleClass('text-success', available)
+               .toggleClass('text-danger', !available);
+        });
+      }, 250);
+    });
+  });
+});
@@ -0,0 +1,155 @@
+"""Per-template and per-block render timing.
+
+Every template the app loads gets its root render function and each of
+its block functions wrapped in a timer. Timings are:
+
+- added up per request and sent back in a Server-Timing header, so they
+  show up in the browser's network panel next to the response
+- aggregated per process, and served as JSON from /_debug/templates
+
+Times are inclusive: a child template's total includes the base layout
+it extends, and a block's time includes any blocks nested inside it.
+A template's time minus its blocks' is what its own markup costs.
+
+Turned on by the PROFILE_TEMPLATES config setting.
+"""
+
+import threading
+from time import perf_counter
+
+from flask import g, has_request_context, jsonify
+from jinja2 import BaseLoader
+
+
+class RenderStats:
+    """Thread-safe running totals of render times, keyed by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, key, seconds):
+        with self._lock:
+            count, total, worst = self._stats.get(key, (0, 0.0, 0.0))
+            self._stats[key] = (count + 1, total + seconds, max(worst, seconds))
+
+    def snapshot(self):
+        """Stats as a list of dicts, biggest total time first."""
+
+        with self._lock:
+            items = list(self._stats.items())
+
+        return [
+            {
+                'name': key,
+                'count': count,
+                'total_ms': total * 1000,
+                'mean_ms': total * 1000 / count,
+                'max_ms': worst * 1000,
+            }
+            for key, (count, total, worst)
+            in sorted(items, key=lambda item: -item[1][1])
+        ]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def timed(render_func, key, stats):
+    """Wrap a Jinja render generator so the time spent in it is recorded.
+
+    Only time spent producing output counts, not time the caller spends
+    between chunks.
+    """
+
+    def wrapper(context, *args, **kwargs):
+        chunks = iter(render_func(context, *args, **kwargs))
+        elapsed = 0.0
+
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += perf_counter() - start
+
+                yield chunk
+        finally:
+            stats.record(key, elapsed)
+
+            if has_request_context():
+                g.setdefault('template_timings', []).append((key, elapsed))
+
+    return wrapper
+
+
+def instrument(template, stats):
+    """Wrap `template`'s root render function and its blocks."""
+
+    name = template.name
+    template.root_render_func = timed(template.root_render_func, name, stats)
+
+    for block, render_func in template.blocks.items():
+        template.blocks[block] = timed(render_func, f"{name}:{block}", stats)
+
+    return template
+
+
+class ProfilingLoader(BaseLoader):
+    """Wraps the app's loader; instruments each template as it's loaded.
+
+    Loading still goes through BaseLoader.load, so the bytecode cache
+    keeps working.
+    """
+
+    def __init__(self, loader, stats):
+        self.loader = loader
+        self.stats = stats
+
+    def get_source(self, environment, template):
+        return self.loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        template = super().load(environment, name, globals)
+        return instrument(template, self.stats)
+
+
+def server_timing_header(timings):
+    """Format (name, seconds) pairs as a Server-Timing header value."""
+
+    return ", ".join(
+        f'tpl{i};dur={seconds * 1000:.2f};desc="{name}"'
+        for i, (name, seconds) in enumerate(timings))
+
+
+def init_template_profiling(app):
+    """Turn on template timing for `app`. Call before any template loads."""
+
+    stats = RenderStats()
+    app.extensions['template_stats'] = stats
+    app.jinja_env.loader = ProfilingLoader(app.jinja_env.loader, stats)
+
+    @app.after_request
+    def add_server_timing(resp):
+        timings = g.get('template_timings')
+
+        if timings:
+            resp.headers.add('Server-Timing', server_timing_header(timings))
+
+        return resp
+
+    def template_stats():
+        """Aggregated render times for this process."""
+
+        return jsonify(templates=stats.snapshot())
+
+    app.add_url_rule('/_debug/templates', 'template_stats', template_stats)
+
+    return stats
@@ -0,0 +1,76 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+import testing
+
+from app import create_app
+
+# Cold start budget for create_app('prod'), imports included.
+STARTUP_BUDGET_SECONDS = 5
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+app = create_app(sys.argv[1])
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'toolbar_imported': 'flask_debugtoolbar' in sys.modules,
+    'heavy_imported': [name for name in ('PIL', 'brotli')
+                       if name in sys.modules],
+    'templates_cached': len(app.jinja_env.cache),
+}))
+"""
+
+
+class AppFactoryTestCase(TestCase):
+    """Test create_app and its profiles."""
+
+    def cold_start(self, profile):
+        """Build an app for `profile` in a fresh interpreter."""
+
+        # it connects to DATABASE_URL, so that has to exist first
+        testing.engine()
+        env = dict(os.environ, SECRET_KEY="test-secret")
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT, profile],
+            env=env, check=True, stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        return json.loads(out.stdout)
+
+    def test_prod_startup(self):
+        """Does a cold prod start stay lean, fast and warm?"""
+
+        result = self.cold_start('prod')
+
+        self.assertLess(result['seconds'], STARTUP_BUDGET_SECONDS)
+        self.assertFalse(result['toolbar_imported'])
+        self.assertEqual(result['heavy_imported'], [])
+
+        app = create_app('test')
+        self.assertEqual(result['templates_cached'],
+                         len(app.jinja_env.list_templates()))
+
+    def test_prod_requires_secret_key(self):
+        env_secret = os.environ.pop('SECRET_KEY', None)
+
+        try:
+            with self.assertRaises(RuntimeError):
+                create_app('prod')
+        finally:
+            if env_secret is not None:
+                os.environ['SECRET_KEY'] = env_secret
+
+    def test_dev_has_toolbar(self):
+        self.assertTrue(self.cold_start('dev')['toolbar_imported'])
@@ -0,0 +1,151 @@
+"""ASGI entry point tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+from unittest import TestCase, mock
+
+from starlette.testclient import TestClient
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let testing point DATABASE_URL at this test
+# process's own database (we need to do this before we import our app,
+# since that will have already connected to the database)
+
+import testing
+
+
+# Now we can import app
+
+from app import app as flask_app, CURR_USER_KEY
+from asgi import app, session_serializer
+from threads import add_reply
+
+
+class AsgiViewsTestCase(TestCase):
+    """Test the async read routes."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        # committed for real: asyncpg reads on its own connections
+        testing.reset_tables()
+
+        self.testuser = User.signup("testuser", "test@test.com", "password", None)
+        self.testuser.id = 8989
+        self.other = User.signup("other", "other@test.com", "password", None)
+        self.other.id = 778
+        db.session.commit()
+
+        db.session.add_all([
+            Message(text="my own warble", user_id=8989),
+            Message(text="warble I follow", user_id=778),
+            Follows(user_being_followed_id=778, user_following_id=8989),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        resp = super().tearDown()
+        db.session.rollback()
+        return resp
+
+    def login_cookie(self, **extra):
+        """A Flask session cookie for testuser."""
+
+        return session_serializer.dumps({CURR_USER_KEY: 8989, **extra})
+
+    def test_homepage_anon(self):
+        with TestClient(app) as client:
+            resp = client.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Sign up now", resp.text)
+
+    def test_compressed(self):
+        with TestClient(app, cookies={"session": self.login_cookie()}) as client:
+            resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.headers["content-encoding"], "gzip")
+            self.assertEqual(resp.headers["vary"], "Accept-Encoding")
+            self.assertIn("warble I follow", resp.text)
+
+    def test_homepage_timeline(self):
+        """Does the logged-in timeline show followed warbles and flashes?"""
+
+        cookie = self.login_cookie(_flashes=[("success", "Hello, testuser!")])
+
+        with TestClient(app, cookies={"session": cookie}) as client:
+            resp = client.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("my own warble", resp.text)
+            self.assertIn("warble I follow", resp.text)
+            self.assertIn("Hello, testuser!", resp.text)
+
+            # the flash was consumed and the cookie rewritten
+            session = session_serializer.loads(resp.cookies["session"])
+            self.assertNotIn("_flashes", session)
+
+    def test_session_cookie_flags(self):
+        """Is the rewritten cookie flagged like Flask's?"""
+
+        cookie = self.login_cookie(_flashes=[("success", "Hello, testuser!")])
+
+        with mock.patch.dict(flask_app.config, SESSION_COOKIE_SECURE=True,
+                             SESSION_COOKIE_SAMESITE='Lax'):
+            with TestClient(app, base_url="https://testserver",
+                            cookies={"session": cookie}) as client:
+                header = client.get("/").headers["set-cookie"]
+
+        for flag in ("Secure", "HttpOnly", "SameSite=Lax", "Path=/"):
+            self.assertIn(flag, header)
+
+    def test_users_show(self):
+        with TestClient(app) as client:
+            resp = client.get("/users/8989")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<h4 id="sidebar-username">@testuser</h4>', resp.text)
+            self.assertIn("my own warble", resp.text)
+
+            resp = client.get("/users/1")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_messages_show_thread(self):
+        """Is a warble shown with what it replies to and its replies?"""
+
+        root = Message.query.filter_by(text="my own warble").one()
+        reply = Message(text="a reply", user_id=778)
+        deeper = Message(text="a reply to the reply", user_id=8989)
+        db.session.add(reply)
+        db.session.flush()
+        add_reply(db.session, reply.id, root.id)
+        db.session.add(deeper)
+        db.session.flush()
+        add_reply(db.session, deeper.id, reply.id)
+        db.session.commit()
+
+        with TestClient(app) as client:
+            resp = client.get(f"/messages/{reply.id}")
+            self.assertEqual(resp.status_code, 200)
+
+            html = resp.text
+            self.assertLess(html.index("my own warble"), html.index("a reply"))
+            self.assertIn("a reply to the reply", html)
+
+            resp = client.get("/messages/1")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_search(self):
+        with TestClient(app) as client:
+            resp = client.get("/users?q=oth")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@other", resp.text)
+            self.assertNotIn("@testuser", resp.text)
+
+    def test_falls_through_to_flask(self):
+        """Are the routes we don't handle served by the Flask app?"""
+
+        with TestClient(app) as client:
+            resp = client.get("/login")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Welcome back.", resp.text)
@@ -0,0 +1,177 @@
+"""Username and e-mail availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+from unittest import TestCase, mock
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY
+from availability import Availability, BloomFilter
+from models import db, User
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def make_availability(refresh_interval=60, rebuild_interval=3600,
+                      refresh_lookback=60):
+    availability = Availability()
+    availability.error_rate = 0.01
+    availability.refresh_interval = refresh_interval
+    availability.rebuild_interval = rebuild_interval
+    availability.refresh_lookback = refresh_lookback
+    return availability
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the filter remembers everything, and little else."""
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityTestCase(DatabaseTestCase):
+    """Test checks are answered from the filter, and confirmed exactly."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup("alice", "alice@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+
+    def test_is_available(self):
+        availability = make_availability()
+
+        with app.app_context():
+            self.assertTrue(availability.is_available('username', "bob"))
+            self.assertTrue(availability.is_available('email', "bob@test.com"))
+            self.assertEqual(availability.queries, 0)
+
+            self.assertFalse(availability.is_available('username', "alice"))
+            self.assertFalse(
+                availability.is_available('email', "alice@test.com"))
+            self.assertEqual(availability.queries, 2)
+
+            # your own are yours to keep
+            self.assertTrue(
+                availability.is_available('username', "alice", self.user))
+
+    def test_other_workers_signups(self):
+        availability = make_availability(refresh_interval=0)
+
+        with app.app_context():
+            self.assertTrue(availability.is_available('username', "bob"))
+
+            # signed up in another worker
+            User.signup("bob", "bob@test.com", "password", None)
+            db.session.commit()
+
+            self.assertFalse(availability.is_available('username', "bob"))
+
+    def test_late_commits(self):
+        """Is a signup that commits after a higher id was read caught?"""
+
+        availability = make_availability(refresh_interval=0)
+
+        def signup(id, name):
+            db.session.execute(
+                "INSERT INTO users (id, username, email, password) "
+                "VALUES (:id, :name, :email, 'x')",
+                {'id': id, 'name': name, 'email': f"{name}@test.com"})
+            db.session.commit()
+
+        with app.app_context():
+            self.assertTrue(availability.is_available('username', "bob"))
+            signup(self.user_id + 10, "dave")
+            self.assertFalse(availability.is_available('username', "dave"))
+
+            # given its id first, committed second
+            signup(self.user_id + 5, "carol")
+            self.assertFalse(availability.is_available('username', "carol"))
+
+            # reads again aren't counted against the filter's capacity
+            self.assertEqual(availability.filter.count, 6)
+
+        # the limit: later than the lookback, and it's missed until a rebuild
+        availability = make_availability(refresh_interval=0,
+                                         refresh_lookback=0)
+
+        with app.app_context():
+            self.assertTrue(availability.is_available('username', "erin"))
+            signup(self.user_id + 20, "frank")
+            self.assertFalse(availability.is_available('username', "frank"))
+            signup(self.user_id + 15, "erin")
+            self.assertTrue(availability.is_available('username', "erin"))
+
+    def test_false_positive_confirmed(self):
+        availability = make_availability()
+
+        with app.app_context():
+            availability.is_available('username', "alice")
+            # a filter that says "maybe" to everything
+            availability.filter.bits[:] = b"\xff" * len(availability.filter.bits)
+
+            self.assertTrue(availability.is_available('username', "bob"))
+            self.assertEqual(availability.false_positives, 1)
+
+    def test_endpoint(self):
+        resp = self.client.get("/users/available?username=alice&email=new@test.com")
+        self.assertEqual(resp.json, {"username": False})
+
+        # whether an address has an account isn't anyone's business
+        resp = self.client.get("/users/available?email=alice@test.com")
+        self.assertEqual(resp.json, {})
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get("/users/available?username=alice")
+        self.assertEqual(resp.json, {"username": True})
+
+    def test_taken_signup_skips_bcrypt(self):
+        with mock.patch.object(User, 'signup') as signup:
+            signup.side_effect = RuntimeError("should not get here")
+
+            resp = self.client.post("/signup", data={
+                "username": "alice",
+                "email": "other@test.com",
+                "password": "password",
+            })
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Already taken.", resp.get_data(as_text=True))
+        signup.assert_not_called()
+
+    def test_taken_profile_edit_skips_bcrypt(self):
+        User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        with mock.patch.object(User, 'authenticate') as authenticate:
+            resp = self.client.post("/users/profile", data={
+                "username": "bob",
+                "email": "alice@test.com",
+                "image_url": "/static/images/default-pic.png",
+                "header_image_url": "/static/images/warbler-hero.jpg",
+                "bio": "hi",
+                "password": "password",
+            })
+
+        self.assertIn("Already taken.", resp.get_data(as_text=True))
+        authenticate.assert_not_called()
@@ -0,0 +1,142 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import brotli
+
+import testing
+
+from app import create_app
+from compression import build_static, choose_encoding
+from config import TestConfig
+
+testing.engine()
+
+
+class ChooseEncodingTestCase(TestCase):
+    """Test Accept-Encoding negotiation."""
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding("gzip, deflate, br"), "br")
+        self.assertEqual(choose_encoding("gzip, br;q=0"), "gzip")
+        self.assertEqual(choose_encoding("*"), "br")
+        self.assertEqual(choose_encoding("identity"), None)
+        self.assertEqual(choose_encoding(None), None)
+        self.assertEqual(choose_encoding("br", ("gzip",)), None)
+
+
+class CompressionTestCase(TestCase):
+    """Test dynamic responses are compressed, and big enough ones only."""
+
+    def setUp(self):
+        self.app = create_app('test')
+        self.app.add_url_rule('/_test/short', 'short', lambda: "short")
+        self.client = self.app.test_client()
+
+    def test_dynamic(self):
+        plain = self.client.get("/login")
+
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertEqual(plain.headers["Vary"], "Accept-Encoding")
+
+        resp = self.client.get("/login", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(int(resp.headers["Content-Length"]), len(resp.data))
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+        resp = self.client.get("/login", headers={"Accept-Encoding": "gzip, br"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(resp.data), plain.data)
+
+    def test_small_responses_left_alone(self):
+        resp = self.client.get("/_test/short", headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.data, b"short")
+
+    def test_off(self):
+        class Config(TestConfig):
+            COMPRESS = False
+
+        resp = create_app(Config).test_client().get(
+            "/login", headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+
+class StaticTestCase(TestCase):
+    """Test pre-compressed static files are built and served."""
+
+    def setUp(self):
+        self.static = tempfile.TemporaryDirectory()
+        self.css = os.path.join(self.static.name, "site.css")
+
+        with open(self.css, "w") as f:
+            f.write("li.message { margin: 0; }\n" * 100)
+
+        with open(os.path.join(self.static.name, "logo.png"), "wb") as f:
+            f.write(b"\x89PNG not really")
+
+        self.app = create_app('test')
+        self.app.static_folder = self.static.name
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.static.cleanup()
+
+    def get(self, accept_encoding=None):
+        headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+        return self.client.get("/static/site.css", headers=headers)
+
+    def test_build(self):
+        written = build_static(self.static.name)
+
+        self.assertEqual(sorted(written), [self.css + ".br", self.css + ".gz"])
+
+        # up to date: nothing to do
+        self.assertEqual(build_static(self.static.name), [])
+
+    def test_served_precompressed(self):
+        with open(self.css, "rb") as f:
+            original = f.read()
+
+        self.assertNotIn("Content-Encoding", self.get("gzip, br").headers)
+
+        build_static(self.static.name)
+
+        resp = self.get("gzip, br")
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(resp.headers["Content-Type"], "text/css; charset=utf-8")
+        self.assertEqual(brotli.decompress(resp.get_data()), original)
+        resp.close()
+
+        resp = self.get("gzip")
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp.get_data()), original)
+        resp.close()
+
+        resp = self.get()
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.get_data(), original)
+        resp.close()
+
+    def test_stale_siblings_ignored(self):
+        build_static(self.static.name)
+
+        later = time.time() + 10
+        os.utime(self.css, (later, later))
+
+        resp = self.get("br")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()
@@ -0,0 +1,140 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import io
+import json
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, ArchivedMessage, Follows, Likes
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(DatabaseTestCase):
+    """Test /users/<id>/export."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup("exporter", "exporter@test.com", "password", None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.other_id = self.other.id
+
+        messages = [Message(text=f"warble {i}", user_id=self.user_id)
+                    for i in range(5)]
+        theirs = Message(text="theirs", user_id=self.other_id)
+        db.session.add_all(messages + [theirs])
+        # the archive tier only gets partitions as months are archived
+        db.session.execute(
+            "CREATE TABLE messages_archive_export_test "
+            "PARTITION OF messages_archive FOR VALUES FROM (0) TO (1000)")
+        db.session.add(ArchivedMessage(id=42, text="old warble",
+                                       user_id=self.user_id,
+                                       timestamp=datetime(2019, 1, 1)))
+        db.session.add_all([
+            Follows(user_being_followed_id=self.other_id,
+                    user_following_id=self.user_id),
+            Follows(user_being_followed_id=self.user_id,
+                    user_following_id=self.other_id),
+        ])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user_id, message_id=theirs.id,
+                             created_at=datetime(2020, 1, 1)))
+        db.session.commit()
+
+        self.theirs_id = theirs.id
+        self.client = app.test_client()
+
+    def export(self, query=""):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        return self.client.get(f"/users/{self.user_id}/export{query}")
+
+    def test_ndjson(self):
+        resp = self.export()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIn("attachment", resp.headers["Content-Disposition"])
+
+        records = [json.loads(line)
+                   for line in resp.get_data(as_text=True).splitlines()]
+        by_type = {}
+        for record in records:
+            by_type.setdefault(record.pop("type"), []).append(record)
+
+        self.assertEqual(
+            sorted(m["text"] for m in by_type["message"]),
+            ["old warble"] + [f"warble {i}" for i in range(5)])
+        self.assertEqual(by_type["following"], [{"user_id": self.other_id}])
+        self.assertEqual(by_type["follower"], [{"user_id": self.other_id}])
+        self.assertEqual(by_type["like"], [{"id": self.theirs_id,
+                                            "created_at": "2020-01-01T00:00:00"}])
+
+    def test_csv(self):
+        resp = self.export("?format=csv")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/csv")
+
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+
+        self.assertEqual(len(rows), 6 + 2 + 1)
+        self.assertEqual([r["text"] for r in rows if r["type"] == "message"
+                          and r["id"] == "42"], ["old warble"])
+
+        self.assertEqual(self.export("?format=xml").status_code, 400)
+
+    def test_streamed_in_batches(self):
+        """Is every table read from a server-side cursor, a batch at a time?"""
+
+        cursors = []
+
+        def capture(conn, cursor, statement, *args):
+            cursors.append(cursor)
+
+        event.listen(Engine, "before_cursor_execute", capture)
+
+        try:
+            with mock.patch('export.FETCH_SIZE', 2):
+                resp = self.export()
+                chunks = list(resp.response)
+        finally:
+            event.remove(Engine, "before_cursor_execute", capture)
+
+        named = [c for c in cursors if c.name]
+        self.assertEqual(len(named), 6)
+
+        # 5 messages in batches of 2, then the archived one, a following,
+        # a follower and a like
+        self.assertEqual([chunk.count(b"\n") for chunk in chunks if chunk],
+                         [2, 2, 1, 1, 1, 1, 1])
+
+    def test_only_own_data(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.other_id
+
+        resp = self.client.get(f"/users/{self.user_id}/export")
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.get(f"/users/{self.user_id}/export",
+                               follow_redirects=True)
+        self.assertIn("Access unauthorized", resp.get_data(as_text=True))
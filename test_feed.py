@@ -0,0 +1,174 @@
+"""Feed hydration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_feed.py
+
+
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY, paginate_likes
+from feed import hydrate
+from models import db, User, Message, Follows, Likes
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FeedTestCase(DatabaseTestCase):
+    """Test hydrate() and the pages built on it."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+
+        self.viewer_id = self.viewer.id
+        self.author_id = self.author.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add_messages(self, user_id, count):
+        messages = [Message(text=f"warble {i}", user_id=user_id)
+                    for i in range(count)]
+        db.session.add_all(messages)
+        db.session.commit()
+        return [m.id for m in messages]
+
+    def test_hydrate(self):
+        first, second = self.add_messages(self.author_id, 2)
+
+        Likes.add(self.viewer_id, first)
+        Likes.add(self.author_id, first)
+        db.session.commit()
+
+        messages = hydrate([second, first, 12345], self.viewer_id)
+
+        # in the order asked for, missing ids skipped
+        self.assertEqual([m.id for m in messages], [second, first])
+
+        self.assertEqual(messages[0].like_count, 0)
+        self.assertFalse(messages[0].liked)
+        self.assertEqual(messages[1].like_count, 2)
+        self.assertTrue(messages[1].liked)
+
+        self.assertEqual(messages[1].user.username, "author")
+        self.assertEqual(messages[1].user.id, self.author_id)
+
+        # no viewer: nothing is liked
+        self.assertFalse(any(m.liked for m in hydrate([first], None)))
+
+        self.assertEqual(hydrate([]), [])
+
+    def count_queries(self, path):
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", capture)
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            resp = self.client.get(path)
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            event.remove(Engine, "before_cursor_execute", capture)
+
+        return len(statements)
+
+    def test_fixed_query_count(self):
+        """Does a page cost the same number of queries however full it is?"""
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.viewer_id))
+        db.session.commit()
+
+        ids = self.add_messages(self.author_id, 1)
+        Likes.add(self.viewer_id, ids[0])
+        db.session.commit()
+
+        pages = ["/", f"/users/{self.author_id}", f"/messages/{ids[0]}"]
+        before = [self.count_queries(page) for page in pages]
+
+        others = [User.signup(f"other{i}", f"other{i}@test.com", "password",
+                              None)
+                  for i in range(5)]
+        db.session.commit()
+
+        for other in others:
+            db.session.add(Follows(user_being_followed_id=other.id,
+                                   user_following_id=self.viewer_id))
+            for message_id in self.add_messages(other.id, 3):
+                Likes.add(self.viewer_id, message_id)
+        more = self.add_messages(self.author_id, 10)
+        Likes.add(self.viewer_id, more[0])
+        db.session.commit()
+
+        after = [self.count_queries(page) for page in pages]
+
+        self.assertEqual(before, after)
+
+    def test_likes_pages(self):
+        """Do likes page by like time, ties and all, off the index alone?"""
+
+        ids = self.add_messages(self.author_id, 5)
+        liked_at = [datetime(2020, 1, 1), datetime(2021, 1, 1),
+                    datetime(2021, 1, 1), datetime(2021, 1, 1),
+                    datetime(2022, 1, 1)]
+
+        db.session.add_all([
+            Likes(user_id=self.viewer_id, message_id=id, created_at=at)
+            for id, at in zip(ids, liked_at)])
+        db.session.commit()
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, *args):
+            if "FROM likes" in statement:
+                statements.append((statement, parameters))
+
+        event.listen(Engine, "before_cursor_execute", capture)
+
+        pages = []
+        cursor = None
+
+        try:
+            while True:
+                query = f"?before={cursor}" if cursor else ""
+
+                with app.test_request_context(f"/{query}"):
+                    page, cursor = paginate_likes(self.viewer_id, limit=2)
+
+                pages.append(page)
+
+                if cursor is None:
+                    break
+        finally:
+            event.remove(Engine, "before_cursor_execute", capture)
+
+        self.assertEqual(pages, [[ids[4], ids[1]], [ids[2], ids[3]], [ids[0]]])
+
+        raw = db.session.connection().connection.cursor()
+        # the table is tiny; make the planner show what it does at scale
+        raw.execute("SET LOCAL enable_seqscan = off")
+        raw.execute("SET LOCAL enable_bitmapscan = off")
+
+        for statement, parameters in statements:
+            raw.execute("EXPLAIN " + statement, parameters)
+            plan = "\n".join(line for line, in raw.fetchall())
+
+            self.assertIn("Index Only Scan using ix_likes_user_id_created_at",
+                          plan)
+            self.assertNotIn("Sort", plan)
@@ -0,0 +1,173 @@
+"""Shared follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_followgraph.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+import testing
+
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
+from followgraph import Snapshot, build_snapshot
+
+
+class FollowGraphTestCase(TestCase):
+    """Test snapshots, the change log and lookups across both."""
+
+    def setUp(self):
+        # committed for real: the graph reads with its own connections
+        testing.reset_tables()
+        self.addCleanup(testing.reset_tables)
+
+        self.engine = testing.engine()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'graph')
+
+        class Config(TestConfig):
+            FOLLOW_GRAPH_PATH = self.path
+            FOLLOW_GRAPH_SYNC_INTERVAL = 60
+
+        self.app = create_app(Config)
+        self.graph = self.app.extensions['follow_graph']
+
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+        with self.engine.begin() as conn:
+            self.a, self.b, self.c = [conn.execute(
+                "INSERT INTO users (username, email, password) "
+                "VALUES (%s, %s, 'x') RETURNING id",
+                name, f"{name}@test.com").scalar() for name in "abc"]
+
+    def follow(self, follower_id, followed_id, conn=None):
+        (conn or self.engine).execute(
+            "INSERT INTO follows (user_following_id, user_being_followed_id) "
+            "VALUES (%s, %s)", follower_id, followed_id)
+
+    def unfollow(self, follower_id, followed_id):
+        self.engine.execute(
+            "DELETE FROM follows WHERE user_following_id = %s "
+            "AND user_being_followed_id = %s", follower_id, followed_id)
+
+    def lookups(self):
+        self.graph.expire()
+        return ({user_id: self.graph.following(user_id)
+                 for user_id in (self.a, self.b, self.c)},
+                self.graph.relationships(self.a, [self.b, self.c]))
+
+    def change_count(self):
+        return self.engine.execute(
+            "SELECT count(*) FROM follow_changes").scalar()
+
+    def test_snapshot(self):
+        self.follow(self.a, self.c)
+        self.follow(self.a, self.b)
+        self.follow(self.b, self.a)
+
+        self.assertEqual(build_snapshot(self.engine, self.path), (3, 3))
+
+        snapshot = Snapshot(self.path)
+        self.assertEqual(list(snapshot.following(self.a)),
+                         sorted([self.b, self.c]))
+        self.assertTrue(snapshot.is_following(self.b, self.a))
+        self.assertFalse(snapshot.is_following(self.c, self.a))
+        # signed up since
+        self.assertEqual(list(snapshot.following(self.c + 100)), [])
+
+        following, relationships = self.lookups()
+        self.assertEqual(following, {self.a: {self.b, self.c},
+                                     self.b: {self.a},
+                                     self.c: set()})
+        self.assertEqual(relationships, ({self.b, self.c}, {self.b}))
+
+    def test_changes_since_snapshot(self):
+        self.follow(self.a, self.c)
+        build_snapshot(self.engine, self.path)
+
+        self.unfollow(self.a, self.c)
+        self.follow(self.c, self.a)
+        self.follow(self.a, self.b)
+
+        following, relationships = self.lookups()
+        self.assertEqual(following, {self.a: {self.b},
+                                     self.b: set(),
+                                     self.c: {self.a}})
+        self.assertEqual(relationships, ({self.b}, {self.c}))
+
+        # until expired, the graph doesn't look again
+        self.unfollow(self.a, self.b)
+        self.assertEqual(self.graph.following(self.a), {self.b})
+
+    def test_late_commit_not_skipped(self):
+        build_snapshot(self.engine, self.path)
+
+        with self.engine.connect() as slow:
+            transaction = slow.begin()
+            # logged first, committed last
+            self.follow(self.c, self.b, slow)
+            self.follow(self.a, self.b)
+
+            following, relationships = self.lookups()
+            self.assertEqual(following[self.c], set())
+
+            transaction.commit()
+
+        following, relationships = self.lookups()
+        self.assertEqual(following[self.c], {self.b})
+        self.assertEqual(following[self.a], {self.b})
+
+    def test_rebuild(self):
+        self.follow(self.a, self.b)
+        self.assertEqual(build_snapshot(self.engine, self.path), (1, 1))
+        self.follow(self.a, self.c)
+        self.lookups()
+
+        # workers may still be on the first snapshot, which hadn't seen it
+        self.assertEqual(build_snapshot(self.engine, self.path), (2, 0))
+        self.assertEqual(self.change_count(), 1)
+        self.assertEqual(build_snapshot(self.engine, self.path), (2, 1))
+
+        self.unfollow(self.a, self.b)
+        following, relationships = self.lookups()
+        self.assertEqual(following[self.a], {self.c})
+
+        # workers map the new file
+        self.assertEqual(self.graph.snapshot.identity,
+                         Snapshot(self.path).identity)
+
+    def test_without_snapshot(self):
+        self.follow(self.a, self.b)
+
+        following, relationships = self.lookups()
+        self.assertEqual(following[self.a], {self.b})
+        self.assertEqual(relationships, ({self.b}, set()))
+
+        self.graph.path = None
+        self.assertEqual(self.lookups()[0][self.a], {self.b})
+
+    def test_views(self):
+        build_snapshot(self.engine, self.path)
+        client = self.app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.a
+
+        client.post(f"/users/follow/{self.b}")
+
+        # read straight back in this worker, without waiting a sync out
+        html = client.get("/users").get_data(as_text=True)
+        self.assertIn(f'action="/users/stop-following/{self.b}"', html)
+
+        client.post(f"/users/stop-following/{self.b}")
+
+        html = client.get("/users").get_data(as_text=True)
+        self.assertIn(f'action="/users/follow/{self.b}"', html)
+        self.assertEqual(self.graph.following(self.a), set())
+
@@ -0,0 +1,154 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashtags.py
+
+
+import json
+from datetime import datetime
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY
+from hashtags import extract, index_messages, link_hashtags
+from ingest import ingest_batch
+from models import db, User, Message, MessageTag, Mention
+from partitions import archive_partitions
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExtractTestCase(TestCase):
+    """Test pulling tags and mentions out of text."""
+
+    def test_extract(self):
+        tags, usernames = extract(
+            "#Flask and #flask, @alice@bob email@example.com x#no #ünï_1")
+
+        self.assertEqual(tags, {"flask", "ünï_1"})
+        self.assertEqual(usernames, {"alice"})
+
+    def test_link_hashtags(self):
+        html = link_hashtags("<b>#Hi</b> & it's #2")
+
+        self.assertEqual(
+            html,
+            '&lt;b&gt;<a href="/tags/hi">#Hi</a>&lt;/b&gt; &amp; it&#39;s '
+            '<a href="/tags/2">#2</a>')
+
+
+class HashtagTestCase(DatabaseTestCase):
+    """Test the index is written on every path and read by the pages."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        self.alice_id = self.alice.id
+        self.bob_id = self.bob.id
+
+        self.client = app.test_client()
+
+    def add_message(self, text, user_id=None):
+        msg = Message(text=text, user_id=user_id or self.alice_id)
+        db.session.add(msg)
+        db.session.flush()
+        index_messages(db.session, [(msg.id, msg.text)])
+        db.session.commit()
+        return msg.id
+
+    def test_messages_add(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+
+        resp = self.client.post("/messages/new",
+                                data={"text": "Hi @bob and @nobody #Python"})
+        self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.filter_by(user_id=self.alice_id).one()
+
+        self.assertEqual([(t.tag, t.message_id) for t in MessageTag.query],
+                         [("python", msg.id)])
+        self.assertEqual([(m.user_id, m.message_id) for m in Mention.query],
+                         [(self.bob_id, msg.id)])
+
+    def test_ingest(self):
+        lines = [json.dumps({"user_id": self.bob_id, "text": "#bulk to @alice",
+                             "timestamp": "2015-06-01T00:00:00"})]
+
+        self.assertEqual(ingest_batch(db.session.connection(), lines)['inserted'], 1)
+
+        self.assertEqual(MessageTag.query.filter_by(tag="bulk").count(), 1)
+        self.assertEqual(Mention.query.filter_by(user_id=self.alice_id).count(), 1)
+
+    def test_tag_page(self):
+        older = self.add_message("first #News")
+        self.add_message("not tagged")
+        newer = self.add_message("second #news #other")
+
+        html = self.client.get("/tags/NEWS").get_data(as_text=True)
+
+        self.assertIn("#news", html)
+        self.assertIn("second", html)
+        self.assertIn("first", html)
+        self.assertNotIn("not tagged", html)
+        self.assertLess(html.index("second"), html.index("first"))
+        self.assertIn('<a href="/tags/other">#other</a>', html)
+
+        html = self.client.get(f"/tags/news?before={newer}").get_data(as_text=True)
+        self.assertIn("first", html)
+        self.assertNotIn("second", html)
+
+        html = self.client.get(f"/tags/news?before={older}").get_data(as_text=True)
+        self.assertNotIn("first", html)
+
+    def test_mentions_page(self):
+        self.add_message("hey @bob")
+        self.add_message("hey @alice", user_id=self.bob_id)
+
+        html = self.client.get(f"/users/{self.bob_id}/mentions").get_data(as_text=True)
+
+        self.assertIn("Mentioning @bob", html)
+        self.assertIn("hey @bob", html)
+        self.assertNotIn("hey @alice", html)
+
+    def test_index_rows_follow_messages(self):
+        """Are index rows deleted with their warble, and when archived?"""
+
+        deleted = self.add_message("#gone")
+        db.session.delete(Message.query.get(deleted))
+        db.session.commit()
+        self.assertEqual(MessageTag.query.count(), 0)
+
+        self.add_message("#old @bob")
+        archive_partitions(db.session.connection(), now=datetime(2040, 1, 1))
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def test_tag_page_is_a_range_read(self):
+        for i in range(3):
+            self.add_message(f"#perf {i}")
+
+        raw = db.session.connection().connection.cursor()
+        # the table is tiny; make the planner show what it does at scale
+        raw.execute("SET LOCAL enable_seqscan = off")
+        raw.execute("SET LOCAL enable_bitmapscan = off")
+
+        query = (db.session.query(MessageTag.message_id)
+                 .filter(MessageTag.tag == "perf", MessageTag.message_id < 2 ** 62)
+                 .order_by(MessageTag.message_id.desc())
+                 .limit(100))
+        statement = query.statement.compile(dialect=db.engine.dialect,
+                                            compile_kwargs={"literal_binds": True})
+
+        raw.execute(f"EXPLAIN {statement}")
+        plan = "\n".join(line for line, in raw.fetchall())
+
+        self.assertIn("Index Only Scan Backward using message_tags_pkey", plan)
+        self.assertNotIn("Sort", plan)
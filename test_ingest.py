@@ -0,0 +1,210 @@
+"""Bulk ingestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ingest.py
+
+
+import json
+from datetime import datetime
+from unittest import TestCase, mock
+
+from testing import DatabaseTestCase
+
+from app import app
+from ingest import batches, ingest_batch, parse_batch
+from models import db, User, Message
+from snowflake import (
+    INGEST_WORKER_ID, MAX_WORKER_ID, SEQUENCE_BITS, snowflake_to_datetime)
+
+TOKEN = "partner-token"
+
+
+def ndjson(*posts):
+    return [json.dumps(post) for post in posts]
+
+
+class ParseBatchTestCase(TestCase):
+    """Test the line checks, which need no database."""
+
+    def test_errors_by_line(self):
+        lines = ndjson(
+            {"user_id": 1, "text": "fine"},
+            {"user_id": 1, "text": "x" * 141},
+            {"user_id": "1", "text": "fine"},
+            {"user_id": 1, "text": ""},
+            {"user_id": 1, "text": "fine", "timestamp": "2999-01-01T00:00:00Z"},
+            {"user_id": 1, "text": "fine", "timestamp": "last tuesday"},
+        ) + ["{not json", "", '["a list"]']
+
+        rows, errors = parse_batch(lines, [(None, 1 << 62)])
+
+        self.assertEqual([row[0] for row in rows], [1])
+        self.assertEqual([error['line'] for error in errors],
+                         [2, 3, 4, 5, 6, 7, 9])
+        self.assertIn("140", errors[0]['error'])
+
+    def test_idempotency_keys(self):
+        post = {"user_id": 1, "text": "a", "timestamp": "2016-03-01T12:00:00Z"}
+        lines = ndjson(
+            post,
+            dict(post, text="b"),
+            dict(post, timestamp="2016-03-01T13:00:00+01:00"),
+            dict(post, id="p1"),
+            dict(post, id="p1", text="edited"),
+            {"user_id": 1, "text": "a"},
+        )
+
+        rows, errors = parse_batch(lines, [(None, 1 << 62)])
+        keys = [row[1] for row in rows]
+
+        self.assertEqual([row[0] for row in rows], [1, 2, 4, 6])
+        self.assertEqual(errors, [
+            {'line': 3, 'error': "same post as line 1"},
+            {'line': 5, 'error': "same post as line 4"}])
+        self.assertEqual(len(set(keys)), 4)
+
+        # ...and the same again for the same posts, in any order
+        rows, errors = parse_batch(lines[::-1], [(None, 1 << 62)])
+        self.assertEqual({row[1] for row in rows}, set(keys))
+
+    def test_partition_bounds(self):
+        lines = ndjson(
+            {"user_id": 1, "text": "a", "timestamp": "2016-03-01T12:00:00Z"})
+
+        rows, errors = parse_batch(lines, [(1 << 61, 1 << 62)])
+
+        self.assertEqual(rows, [])
+        self.assertIn("no live partition for 2016-03", errors[0]['error'])
+
+    def test_batches(self):
+        self.assertEqual(list(batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+
+class IngestTestCase(DatabaseTestCase):
+    """Test writing batches, directly and over HTTP."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup("partner", "partner@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+
+    def post(self, lines, token=TOKEN):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+        with mock.patch.dict(app.config, INGEST_TOKEN=TOKEN):
+            return self.client.post("/api/messages/bulk",
+                                    data="\n".join(lines), headers=headers)
+
+    def test_ingest_batch(self):
+        lines = ndjson(
+            {"user_id": self.user_id, "text": "old", "timestamp": "2012-05-01T00:00:00"},
+            {"user_id": 999999, "text": "nobody's"},
+            {"user_id": self.user_id, "text": "now, with, \"quotes\"\nand lines"},
+            {"user_id": self.user_id, "text": "x" * 200},
+        )
+
+        report = ingest_batch(db.session.connection(), lines)
+
+        self.assertEqual(report, {'inserted': 2, 'errors': [
+            {'line': 2, 'error': "no such user"},
+            {'line': 4, 'error': "text is longer than 140 characters"},
+        ]})
+
+        texts = [m.text for m in Message.query.filter_by(user_id=self.user_id)
+                 .order_by(Message.id)]
+        self.assertEqual(texts, ["old", "now, with, \"quotes\"\nand lines"])
+
+        old = Message.query.filter_by(text="old").one()
+        self.assertEqual(old.timestamp, datetime(2012, 5, 1))
+
+        # counts are computed, so the profile stats see the new rows
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.user_id).message_count, 2)
+
+    def test_resent_batch(self):
+        lines = ndjson(
+            {"user_id": self.user_id, "text": "once", "timestamp": "2012-05-01T00:00:00"})
+
+        ingest_batch(db.session.connection(), lines)
+        report = ingest_batch(db.session.connection(), lines)
+
+        self.assertEqual(report, {'inserted': 0, 'errors': [
+            {'line': 1, 'error': "already ingested"}]})
+        self.assertEqual(Message.query.filter_by(text="once").count(), 1)
+
+    def test_same_millisecond_across_batches(self):
+        first = ndjson({"user_id": self.user_id, "text": "first",
+                        "timestamp": "2012-05-01T00:00:00"})
+        second = ndjson({"user_id": self.user_id, "text": "second",
+                         "timestamp": "2012-05-01T00:00:00"})
+
+        for lines in (first, second):
+            report = ingest_batch(db.session.connection(), lines)
+            self.assertEqual(report, {'inserted': 1, 'errors': []})
+
+        ids = [m.id for m in Message.query.filter_by(user_id=self.user_id)]
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual({snowflake_to_datetime(id) for id in ids},
+                         {datetime(2012, 5, 1)})
+        self.assertEqual({(id >> SEQUENCE_BITS) & MAX_WORKER_ID for id in ids},
+                         {INGEST_WORKER_ID})
+
+    def test_resent_posts(self):
+        lines = ndjson(
+            {"user_id": self.user_id, "text": "one", "timestamp": "2012-05-01T00:00:00"},
+            {"user_id": self.user_id, "text": "two", "timestamp": "2012-05-01T00:00:00"},
+            {"user_id": self.user_id, "text": "no timestamp"},
+            {"user_id": self.user_id, "text": "mine", "id": "p1"},
+        )
+        ingest_batch(db.session.connection(), lines)
+
+        # reordered, with the client-id'd post edited since
+        resent = ndjson(
+            {"user_id": self.user_id, "text": "mine, edited", "id": "p1"},
+            {"user_id": self.user_id, "text": "two", "timestamp": "2012-05-01T00:00:00"},
+            {"user_id": self.user_id, "text": "no timestamp"},
+            {"user_id": self.user_id, "text": "three", "timestamp": "2012-05-01T00:00:00"},
+        )
+        report = ingest_batch(db.session.connection(), resent)
+
+        self.assertEqual(report, {'inserted': 1, 'errors': [
+            {'line': n, 'error': "already ingested"} for n in (1, 2, 3)]})
+        self.assertEqual(
+            sorted(m.text for m in Message.query.filter_by(user_id=self.user_id)),
+            ["mine", "no timestamp", "one", "three", "two"])
+
+    def test_endpoint(self):
+        lines = ndjson({"user_id": self.user_id, "text": "over http"},
+                       {"user_id": self.user_id, "text": ""})
+
+        resp = self.post(lines)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['inserted'], 1)
+        self.assertEqual(resp.json['errors'],
+                         [{'line': 2, 'error': "text is required"}])
+        self.assertEqual(Message.query.filter_by(text="over http").count(), 1)
+
+    def test_endpoint_needs_token(self):
+        lines = ndjson({"user_id": self.user_id, "text": "sneaky"})
+
+        self.assertEqual(self.post(lines, token=None).status_code, 401)
+        self.assertEqual(self.post(lines, token="wrong").status_code, 401)
+
+        # no token configured: nobody gets in
+        resp = self.client.post("/api/messages/bulk", data=lines[0],
+                                headers={"Authorization": "Bearer "})
+        self.assertEqual(resp.status_code, 401)
+
+        self.assertEqual(Message.query.filter_by(text="sneaky").count(), 0)
+
+    def test_endpoint_batch_size(self):
+        with mock.patch('app.INGEST_BATCH_SIZE', 2):
+            resp = self.post(ndjson(*[{"user_id": self.user_id, "text": "x"}] * 3))
+
+        self.assertEqual(resp.status_code, 413)
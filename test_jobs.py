@@ -0,0 +1,234 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import time
+from datetime import timedelta
+from unittest import TestCase, mock
+
+from testing import DatabaseTestCase
+import testing
+
+from app import app, CURR_USER_KEY
+from jobs import (
+    MAX_ATTEMPTS, PARTITION_INTERVAL, WorkerPool, enqueue, enqueue_once,
+    handler, queue_stats, run_batch)
+from models import db, User, Message, Job, Notification
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+calls = []
+
+
+@handler('test_record')
+def record(connection, payloads):
+    calls.append([payload['n'] for payload in payloads])
+
+    if any(payload.get('fail') for payload in payloads):
+        raise RuntimeError("boom")
+
+    connection.execute(
+        db.text("INSERT INTO job_test (n) SELECT unnest(CAST(:ns AS INTEGER[]))"),
+        ns=[payload['n'] for payload in payloads])
+
+
+class JobQueueTestCase(DatabaseTestCase):
+    """Test claiming, batching and retrying."""
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+        db.session.execute("CREATE TABLE job_test (n INTEGER)")
+
+    def run_jobs(self):
+        return run_batch(db.session.connection())
+
+    def test_batches_by_kind(self):
+        for n in range(3):
+            enqueue(db.session, 'test_record', {'n': n})
+        db.session.commit()
+
+        self.assertEqual(self.run_jobs(), 3)
+
+        self.assertEqual(calls, [[0, 1, 2]])
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(
+            sorted(n for n, in db.session.execute("SELECT n FROM job_test")),
+            [0, 1, 2])
+
+    def test_bad_job_isolated_and_retried(self):
+        enqueue(db.session, 'test_record', {'n': 1})
+        enqueue(db.session, 'test_record', {'n': 2, 'fail': True})
+        enqueue(db.session, 'test_record', {'n': 3})
+        enqueue(db.session, 'no_such_kind', {})
+        db.session.commit()
+
+        self.assertEqual(self.run_jobs(), 4)
+
+        # the batch, then one at a time
+        self.assertEqual(calls, [[1, 2, 3], [1], [2], [3]])
+        self.assertEqual(
+            sorted(n for n, in db.session.execute("SELECT n FROM job_test")),
+            [1, 3])
+
+        failed = Job.query.order_by(Job.id).all()
+        self.assertEqual([job.attempts for job in failed], [1, 1])
+        self.assertIn("boom", failed[0].last_error)
+        self.assertIn("no handler", failed[1].last_error)
+
+        stats = queue_stats(db.session)
+        self.assertEqual((stats['ready'], stats['scheduled']), (0, 2))
+
+        # backed off: not ready again yet
+        self.assertEqual(self.run_jobs(), 0)
+
+    def test_gives_up(self):
+        enqueue(db.session, 'test_record', {'n': 1, 'fail': True})
+        db.session.commit()
+
+        with mock.patch('jobs.backoff', return_value=0):
+            for attempt in range(MAX_ATTEMPTS + 2):
+                self.run_jobs()
+
+        self.assertEqual(len(calls), MAX_ATTEMPTS)
+        job = Job.query.one()
+        self.assertIsNotNone(job.failed_at)
+        self.assertEqual(queue_stats(db.session)['failed'], 1)
+
+    def test_stats(self):
+        enqueue(db.session, 'test_record', {'n': 1})
+        enqueue(db.session, 'test_record', {'n': 2}, delay=3600)
+        db.session.execute(
+            "UPDATE jobs SET run_at = run_at - interval '30 seconds' "
+            "WHERE payload->>'n' = '1'")
+        db.session.commit()
+
+        stats = queue_stats(db.session)
+
+        self.assertEqual((stats['ready'], stats['scheduled'], stats['failed']),
+                         (1, 1, 0))
+        self.assertGreaterEqual(stats['lag_seconds'], 30)
+
+        client = app.test_client()
+
+        with mock.patch.dict(app.config, STATS_TOKEN="secret"):
+            resp = client.get("/_debug/jobs",
+                              headers={"Authorization": "Bearer secret"})
+            self.assertEqual(resp.json['jobs']['ready'], 1)
+
+            resp = client.get("/_debug/jobs",
+                              headers={"Authorization": "Bearer guess"})
+            self.assertEqual(resp.status_code, 401)
+
+        # off without a token
+        self.assertEqual(client.get("/_debug/jobs").status_code, 401)
+
+    def test_periodic_partition_job(self):
+        self.assertTrue(enqueue_once(db.session, 'maintain_partitions', {}))
+        self.assertFalse(enqueue_once(db.session, 'maintain_partitions', {}))
+        db.session.commit()
+
+        self.assertEqual(self.run_jobs(), 1)
+
+        # ...and queued its next run
+        job = Job.query.one()
+        self.assertEqual((job.kind, job.attempts, job.failed_at),
+                         ('maintain_partitions', 0, None))
+        self.assertGreater(job.run_at - job.created_at,
+                           timedelta(seconds=PARTITION_INTERVAL - 60))
+
+
+class MentionNotificationTestCase(DatabaseTestCase):
+    """Test mentions become notifications through the queue."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        self.alice_id = self.alice.id
+        self.bob_id = self.bob.id
+        self.client = app.test_client()
+
+    def post(self, user_id, text):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_mentions_delivered(self):
+        self.post(self.alice_id, "hi @bob and @alice")
+        self.post(self.alice_id, "no mentions here")
+
+        # queued, not delivered while posting
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(Job.query.count(), 1)
+
+        run_batch(db.session.connection())
+        db.session.commit()
+
+        # not for mentioning yourself
+        self.assertEqual([(n.user_id, n.kind) for n in Notification.query],
+                         [(self.bob_id, 'mention')])
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.bob_id
+
+        html = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("hi @bob and @alice", html)
+        self.assertNotIn("no mentions here", html)
+
+        message_id = Message.query.filter_by(text="hi @bob and @alice").one().id
+        html = self.client.get(
+            f"/notifications?before={message_id}").get_data(as_text=True)
+        self.assertNotIn("hi @bob", html)
+
+    def test_notifications_need_login(self):
+        resp = self.client.get("/notifications")
+        self.assertEqual(resp.status_code, 302)
+
+
+class WorkerPoolTestCase(TestCase):
+    """Test the pool runs jobs committed by other connections."""
+
+    @classmethod
+    def setUpClass(cls):
+        # committed for real: the workers have their own connections
+        testing.reset_tables()
+
+        with testing.engine().begin() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS job_test (n INTEGER)")
+
+    @classmethod
+    def tearDownClass(cls):
+        with testing.engine().begin() as conn:
+            conn.execute("DROP TABLE job_test")
+            conn.execute("DELETE FROM jobs")
+
+    def test_pool(self):
+        engine = testing.engine()
+
+        with engine.begin() as conn:
+            for n in range(10):
+                enqueue(conn, 'test_record', {'n': n})
+
+        pool = WorkerPool(engine, threads=2, poll_interval=0.01)
+        pool.start()
+
+        try:
+            deadline = time.time() + 10
+            while queue_stats(engine)['ready'] and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            pool.stop()
+
+        with engine.connect() as conn:
+            done = sorted(n for n, in conn.execute("SELECT n FROM job_test"))
+
+        # each job once, whichever worker got it
+        self.assertEqual(done, list(range(10)))
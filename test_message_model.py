@@ -5,18 +5,20 @@
 #    python -m unittest test_message_model.py
 
 
-import os
-from unittest import TestCase
+from datetime import datetime
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User, Message, Likes
+from models import db, User, Message, Likes, ArchivedMessage, ArchivedLike
+from partitions import (
+    MONTHS_AHEAD, archive_partitions, ensure_partitions, maintain_partitions,
+    month_start, months_ahead, partition_name)
+from snowflake import snowflake_from_datetime
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, let testing point DATABASE_URL at this test
+# process's own database (we need to do this before we import our app,
+# since that will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from testing import DatabaseTestCase
 
 
 # Now we can import app
@@ -24,20 +26,13 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from app import app
 import pdb
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
     """Teste Message model functionality"""
 
     def setUp(self):
         """Add sample data"""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         user = User.signup("test1", "email1@email.com", "password", None)
         uid = 1111
@@ -101,4 +96,110 @@ class MessageModelTestCase(TestCase):
         likes=Likes.query.filter(Likes.user_id==user.id).all()
 
         self.assertEqual(len(likes), 1)
-        self.assertEqual(likes[0].message_id, m.id)
\ No newline at end of file
+        self.assertEqual(likes[0].message_id, m.id)
+
+    def test_likes_keyed_by_user_and_message(self):
+        """Can many users like a warble, each only once?"""
+
+        other = User.signup("other", "other@test.com", "password", None)
+        m = Message(text="popular", user_id=self.uid)
+        db.session.add(m)
+        db.session.commit()
+
+        self.assertTrue(Likes.add(self.uid, m.id))
+        self.assertTrue(Likes.add(other.id, m.id))
+        self.assertFalse(Likes.add(other.id, m.id))
+        db.session.commit()
+
+        likes = Likes.query.filter_by(message_id=m.id).all()
+        self.assertEqual({like.user_id for like in likes}, {self.uid, other.id})
+        self.assertTrue(all(like.created_at for like in likes))
+
+    ### Id / timestamp tests ###
+
+    def test_message_ids_are_time_sortable(self):
+        """Are message ids increasing, and do timestamps come from the database?"""
+
+        m1 = Message(text="first", user_id=self.uid)
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(text="second", user_id=self.uid)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertGreater(m2.id, m1.id)
+        self.assertIsNotNone(m1.timestamp)
+        self.assertLessEqual(m1.timestamp, m2.timestamp)
+
+        newest = Message.query.order_by(Message.id.desc()).first()
+        self.assertEqual(newest.text, "second")
+
+
+    ### Partitioning tests ###
+
+    def test_ensure_partitions(self):
+        """Are missing monthly partitions created, and only once?"""
+
+        conn = db.session.connection()
+        later = month_start(datetime.utcnow(), MONTHS_AHEAD + 1)
+
+        created = ensure_partitions(conn, now=later, months_ahead=1)
+        self.assertEqual(created, [partition_name(later),
+                                   partition_name(month_start(later, 1))])
+
+        created = ensure_partitions(conn, now=later, months_ahead=1)
+        self.assertEqual(created, [])
+
+    def test_ensure_partitions_fills_gaps(self):
+        """After months with no upkeep, are the months missed made too?"""
+
+        conn = db.session.connection()
+        # the newest partition is MONTHS_AHEAD months on; three past that
+        later = month_start(datetime.utcnow(), MONTHS_AHEAD + 3)
+
+        created = ensure_partitions(conn, now=later, months_ahead=0)
+        self.assertEqual(created, [partition_name(month_start(later, offset))
+                                   for offset in (-2, -1, 0)])
+
+        # a back-dated warble in a missed month has somewhere to go
+        missed = month_start(later, -2)
+        db.session.add(Message(id=snowflake_from_datetime(missed, 1),
+                               text="late", user_id=self.uid))
+        db.session.flush()
+
+    def test_maintain_partitions(self):
+        """Is running out of partitions ahead warned about, and fixed?"""
+
+        conn = db.session.connection()
+        later = month_start(datetime.utcnow(), MONTHS_AHEAD + 1)
+
+        self.assertEqual(months_ahead(conn), MONTHS_AHEAD)
+        self.assertEqual(months_ahead(conn, now=later), 0)
+
+        with self.assertLogs('partitions', 'WARNING'):
+            maintain_partitions(conn, now=later)
+
+        self.assertEqual(months_ahead(conn, now=later), MONTHS_AHEAD)
+
+    def test_archive_partitions(self):
+        """Do archived warbles (and their likes) leave the live tables?"""
+
+        m = Message(text="old news", user_id=self.uid)
+        db.session.add(m)
+        db.session.flush()
+        msg_id = m.id
+
+        db.session.add(Likes(user_id=self.uid, message_id=msg_id))
+        db.session.commit()
+
+        archived = archive_partitions(db.session.connection(),
+                                      now=datetime(2040, 1, 1))
+
+        self.assertIn(partition_name(month_start(datetime.utcnow())), archived)
+
+        self.assertEqual(Message.query.filter_by(id=msg_id).count(), 0)
+        self.assertEqual(ArchivedMessage.query.get(msg_id).text, "old news")
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(ArchivedLike.query.filter_by(message_id=msg_id).count(), 1)
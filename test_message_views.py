@@ -5,42 +5,31 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
-
 from models import db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, let testing point DATABASE_URL at this test
+# process's own database (we need to do this before we import our app,
+# since that will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from testing import DatabaseTestCase
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -122,7 +111,7 @@ class MessageViewTestCase(TestCase):
 
             resp = c.get('/messages/99999', follow_redirects=True)
 
-            self.assertEqual(resp.status_code, 500)
+            self.assertEqual(resp.status_code, 404)
 
     def test_message_delete(self):
         """Tests delete message route"""
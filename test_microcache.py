@@ -0,0 +1,132 @@
+"""Anonymous page micro-cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_microcache.py
+
+
+import threading
+import time
+from unittest import TestCase, mock
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY
+from microcache import HEADER, MicroCache
+from models import db, User, Message
+
+
+def make_cache(ttl=5, max_entries=10):
+    cache = MicroCache()
+    cache.ttl = ttl
+    cache.max_entries = max_entries
+    return cache
+
+
+class MicroCacheTestCase(TestCase):
+    """Test expiry, eviction and coalescing."""
+
+    def test_coalesced(self):
+        cache = make_cache()
+        renders = []
+        outcomes = []
+        started = threading.Barrier(5)
+
+        def render():
+            renders.append(1)
+            time.sleep(0.1)
+            return "page"
+
+        def request():
+            started.wait()
+            outcomes.append(cache.get("/", render))
+
+        threads = [threading.Thread(target=request) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(sorted(outcomes),
+                         [("page", "COALESCED")] * 4 + [("page", "MISS")])
+        self.assertEqual(cache.get("/", render), ("page", "HIT"))
+
+    def test_uncacheable_not_shared(self):
+        cache = make_cache()
+
+        self.assertEqual(cache.get("/", lambda: None), (None, "MISS"))
+        self.assertEqual(cache.get("/", lambda: "page"), ("page", "MISS"))
+
+    def test_expiry_and_eviction(self):
+        cache = make_cache(ttl=0.05, max_entries=2)
+
+        for key in "abc":
+            cache.get(key, lambda: key)
+
+        self.assertEqual(list(cache._pages), ["b", "c"])
+        self.assertEqual(cache.get("c", lambda: "new"), ("c", "HIT"))
+
+        time.sleep(0.06)
+        self.assertEqual(cache.get("c", lambda: "new"), ("new", "MISS"))
+
+
+class MicroCacheViewsTestCase(DatabaseTestCase):
+    """Test the views serve anonymous visitors from the cache."""
+
+    def setUp(self):
+        super().setUp()
+
+        cache = app.extensions['microcache']
+        cache.clear()
+        patcher = mock.patch.object(cache, 'ttl', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        msg = Message(text="first draft", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        self.client = app.test_client()
+
+    def edit_message(self):
+        Message.query.get(self.msg_id).text = "second draft"
+        db.session.commit()
+
+    def test_anonymous_cached(self):
+        url = f"/messages/{self.msg_id}"
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers[HEADER], "MISS")
+
+        self.edit_message()
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers[HEADER], "HIT")
+        self.assertIn("first draft", resp.get_data(as_text=True))
+
+        # a different query string is a different page
+        resp = self.client.get(f"/users/{self.user_id}?before={self.msg_id + 1}")
+        self.assertIn("second draft", resp.get_data(as_text=True))
+
+    def test_session_bypasses(self):
+        url = f"/messages/{self.msg_id}"
+        self.client.get(url)
+        self.edit_message()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get(url)
+        self.assertNotIn(HEADER, resp.headers)
+        self.assertIn("second draft", resp.get_data(as_text=True))
+
+    def test_errors_not_cached(self):
+        self.assertEqual(self.client.get("/users/999999").status_code, 404)
+        self.assertEqual(app.extensions['microcache']._pages, {})
@@ -0,0 +1,376 @@
+"""Migration runner tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+from datetime import datetime
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+
+import testing
+
+from app import create_app
+from migrations import (
+    Backfill, CreateIndex, Migration, PythonBackfill, SQL, MIGRATIONS,
+    index_valid, migrate, stamp, status)
+from models import db
+from snowflake import snowflake_from_datetime
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FlakyBackfill(Backfill):
+    """A backfill that dies after `batches` batches."""
+
+    def __init__(self, *args, batches, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = batches
+
+    def update_batch(self, conn, after, upto):
+        if self.batches == 0:
+            raise Interrupted()
+
+        self.batches -= 1
+        return super().update_batch(conn, after, upto)
+
+
+class MigrationsTestCase(TestCase):
+    """Test the runner against a scratch table."""
+
+    def setUp(self):
+        self.app = create_app('test')
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.engine = db.engine
+        testing.engine()
+
+        with self.engine.begin() as conn:
+            conn.execute(db.text("DROP TABLE IF EXISTS schema_migrations"))
+            conn.execute(db.text("DROP TABLE IF EXISTS migration_test"))
+            conn.execute(db.text(
+                "CREATE TABLE migration_test "
+                "(a INTEGER, b INTEGER, v INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (a, b))"))
+            # lumpy: a=1 has half the rows, as with a popular user's followers
+            conn.execute(db.text(
+                "INSERT INTO migration_test (a, b) "
+                "SELECT CASE WHEN n <= 500 THEN 1 ELSE n END, n "
+                "FROM generate_series(1, 1000) n"))
+
+    def tearDown(self):
+        with self.engine.begin() as conn:
+            conn.execute(db.text("DROP TABLE IF EXISTS migration_test"))
+            conn.execute(db.text("DROP TABLE IF EXISTS schema_migrations"))
+            conn.execute(db.text("DROP INDEX IF EXISTS ix_messages_test"))
+
+        self.ctx.pop()
+
+    def values(self):
+        with self.engine.connect() as conn:
+            return [v for v, in conn.execute(db.text(
+                "SELECT v FROM migration_test ORDER BY a, b"))]
+
+    def test_backfill_resumes(self):
+        """Does an interrupted backfill pick up where it left off?"""
+
+        options = dict(key=('a', 'b'), batch_size=64, min_batch=64,
+                       max_batch=64, pause=0)
+
+        flaky = Migration('0001_test', FlakyBackfill(
+            'migration_test', 'v = t.v + 1', batches=5, **options))
+
+        with mock.patch('migrations.MIGRATIONS', [flaky]):
+            with self.assertRaises(Interrupted):
+                migrate(self.engine)
+
+            self.assertEqual(self.values().count(1), 5 * 64)
+            self.assertIn("in progress", dict(status(self.engine))['0001_test'])
+
+            resumed = Migration('0001_test', Backfill(
+                'migration_test', 'v = t.v + 1', **options))
+
+            with mock.patch('migrations.MIGRATIONS', [resumed]):
+                self.assertEqual(migrate(self.engine), ['0001_test'])
+
+            # every row updated exactly once
+            self.assertEqual(set(self.values()), {1})
+            self.assertIn("applied", dict(status(self.engine))['0001_test'])
+
+            # and never again
+            self.assertEqual(migrate(self.engine), [])
+
+    def test_backfill_where(self):
+        backfill = Migration('0001_test', Backfill(
+            'migration_test', 'v = 7', key=('a', 'b'), where='t.b % 2 = 0',
+            batch_size=100, pause=0))
+
+        with mock.patch('migrations.MIGRATIONS', [backfill]):
+            migrate(self.engine)
+
+        self.assertEqual(self.values().count(7), 500)
+
+    def test_python_backfill(self):
+        """Is each row handed over once, across an interruption?"""
+
+        batches = []
+        fail_after = [3]
+
+        def bump(conn, rows):
+            if len(batches) == fail_after[0]:
+                raise Interrupted()
+
+            batches.append(rows)
+            conn.execute(db.text(
+                "UPDATE migration_test SET v = v + 1 WHERE (a, b) IN :keys"),
+                keys=tuple((a, b) for a, b in rows))
+
+        step = PythonBackfill('migration_test', 't.a, t.b', bump,
+                              key=('a', 'b'), batch_size=64, min_batch=64,
+                              max_batch=64, pause=0)
+
+        with mock.patch('migrations.MIGRATIONS', [Migration('0001_test', step)]):
+            with self.assertRaises(Interrupted):
+                migrate(self.engine)
+
+            self.assertEqual(self.values().count(1), 3 * 64)
+
+            fail_after[0] = None
+            self.assertEqual(migrate(self.engine), ['0001_test'])
+
+        self.assertEqual(set(self.values()), {1})
+
+    def test_create_index(self):
+        migrations = [
+            Migration('0001_test',
+                      CreateIndex('ix_migration_test_v', 'migration_test', 'v')),
+            Migration('0002_test',
+                      CreateIndex('ix_messages_test', 'messages',
+                                  'user_id, timestamp')),
+        ]
+
+        with mock.patch('migrations.MIGRATIONS', migrations):
+            migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            self.assertTrue(index_valid(conn, 'ix_migration_test_v'))
+            # valid on a partitioned table only once every partition has it
+            self.assertTrue(index_valid(conn, 'ix_messages_test'))
+
+    def test_create_index_rebuilds_invalid(self):
+        with self.engine.begin() as conn:
+            conn.execute(db.text(
+                "CREATE INDEX ix_migration_test_v ON migration_test (v)"))
+            conn.execute(db.text(
+                "UPDATE pg_index SET indisvalid = false "
+                "WHERE indexrelid = 'ix_migration_test_v'::regclass"))
+
+        with mock.patch('migrations.MIGRATIONS', [Migration(
+                '0001_test',
+                CreateIndex('ix_migration_test_v', 'migration_test', 'v'))]):
+            migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            self.assertTrue(index_valid(conn, 'ix_migration_test_v'))
+
+    def test_steps_run_in_order_once(self):
+        migrations = [
+            Migration('0001_test', SQL("UPDATE migration_test SET v = 1")),
+            Migration('0002_test', SQL("UPDATE migration_test SET v = v * 5")),
+        ]
+
+        with mock.patch('migrations.MIGRATIONS', migrations):
+            self.assertEqual(migrate(self.engine, upto='0001_test'),
+                             ['0001_test'])
+            self.assertEqual(migrate(self.engine), ['0002_test'])
+            migrate(self.engine)
+
+        self.assertEqual(set(self.values()), {5})
+
+    def test_stamp(self):
+        stamp(self.engine)
+
+        self.assertEqual(migrate(self.engine), [])
+        self.assertTrue(all(state.startswith("applied")
+                            for name, state in status(self.engine)))
+        self.assertEqual(len(status(self.engine)), len(MIGRATIONS))
+
+
+# The tables as they were before 0001, in a schema of their own.
+LEGACY_SCHEMA = [
+    """
+    CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL
+    )""",
+    """
+    CREATE TABLE follows (
+        user_being_followed_id INTEGER
+            REFERENCES users (id) ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id)
+    )""",
+    """
+    CREATE TABLE messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+    )""",
+    """
+    CREATE TABLE likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE
+    )""",
+]
+
+
+class LegacyMigrationsTestCase(TestCase):
+    """Test 0001 and 0003 bring an old database up, a batch at a time."""
+
+    def setUp(self):
+        testing.engine().execute("DROP SCHEMA IF EXISTS legacy CASCADE; "
+                                 "CREATE SCHEMA legacy")
+        self.engine = create_engine(
+            testing.DATABASE_URL,
+            connect_args={'options': '-c search_path=legacy'})
+
+        self.t0 = datetime(2023, 5, 1, 12, 0, 0, 123456)
+        self.t1 = datetime(2023, 5, 2, 8, 30)
+
+        with self.engine.begin() as conn:
+            for statement in LEGACY_SCHEMA:
+                conn.execute(statement)
+
+            conn.execute("INSERT INTO users (username, email, password) "
+                         "VALUES ('a', 'a@test.com', 'x'), "
+                         "('b', 'b@test.com', 'x')")
+            # three in one millisecond, as one process used to write them
+            conn.execute(
+                "INSERT INTO messages (text, timestamp, user_id) VALUES "
+                "('one', %(t0)s, 1), ('two', %(t0)s, 1), "
+                "('three', %(t0)s, 2), ('four', %(t1)s, 2)",
+                t0=self.t0, t1=self.t1)
+            conn.execute("INSERT INTO likes (user_id, message_id) "
+                         "VALUES (1, 2), (2, 4), (2, NULL)")
+
+    def tearDown(self):
+        self.engine.dispose()
+        testing.engine().execute("DROP SCHEMA IF EXISTS legacy CASCADE")
+
+    def test_legacy_database(self):
+        migrations = [migration for migration in MIGRATIONS
+                      if migration.name in ('0001_snowflake_message_ids',
+                                            '0003_likes_composite_key')]
+
+        run = Backfill.run
+
+        def run_while_in_use(backfill, engine, progress):
+            # the site carries on writing under the old schema
+            if backfill.assignments.startswith('new_message_id'):
+                with engine.begin() as conn:
+                    conn.execute(
+                        "INSERT INTO messages (text, timestamp, user_id) "
+                        "VALUES ('five', %s, 1)", self.t0)
+                    conn.execute(
+                        "INSERT INTO likes (user_id, message_id) "
+                        "SELECT 1, id FROM messages WHERE text = 'five'")
+
+            run(backfill, engine, progress)
+
+        with mock.patch('migrations.MIGRATIONS', migrations), \
+                mock.patch.object(Backfill, 'run', run_while_in_use):
+            self.assertEqual(len(migrate(self.engine)), 2)
+
+        ids = {text: snowflake_from_datetime(self.t0, i)
+               for i, text in enumerate(['one', 'two', 'three', 'five'])}
+        ids['four'] = snowflake_from_datetime(self.t1)
+
+        with self.engine.connect() as conn:
+            self.assertEqual(dict(conn.execute(
+                "SELECT text, id FROM messages").fetchall()), ids)
+            self.assertEqual(sorted(conn.execute(
+                "SELECT user_id, message_id, created_at FROM likes")), [
+                (1, ids['two'], self.t0),
+                (1, ids['five'], self.t0),
+                (2, ids['four'], self.t1),
+            ])
+            self.assertTrue(index_valid(conn, 'ix_messages_user_id_id'))
+            self.assertEqual(conn.execute(
+                "SELECT count(*) FROM pg_constraint WHERE NOT convalidated "
+                "AND connamespace = 'legacy'::regnamespace").scalar(), 0)
+
+            # more than one like per warble, but one per user
+            conn.execute("INSERT INTO likes (user_id, message_id) "
+                         "VALUES (2, %s)", ids['two'])
+            with self.assertRaises(IntegrityError):
+                conn.execute("INSERT INTO likes (user_id, message_id) "
+                             "VALUES (2, %s)", ids['two'])
+
+            conn.execute("DELETE FROM messages WHERE id = %s", ids['two'])
+            self.assertEqual(conn.execute(
+                "SELECT count(*) FROM likes").scalar(), 2)
+
+    def test_whole_chain(self):
+        """Does running every migration give the models' schema?"""
+
+        migrate(self.engine)
+
+        inspector = inspect(self.engine)
+        tables = set(inspector.get_table_names(schema='legacy'))
+
+        for table in db.metadata.sorted_tables:
+            with self.subTest(table=table.name):
+                self.assertIn(table.name, tables)
+
+                columns = {column['name']: column for column in
+                           inspector.get_columns(table.name, schema='legacy')}
+                self.assertEqual(set(columns), set(table.columns.keys()))
+
+                for column in table.columns:
+                    self.assertEqual(columns[column.name]['nullable'],
+                                     column.nullable, column.name)
+
+                self.assertEqual(
+                    inspector.get_pk_constraint(
+                        table.name, schema='legacy')['constrained_columns'],
+                    [column.name for column in table.primary_key])
+
+                with self.engine.connect() as conn:
+                    for index in table.indexes:
+                        self.assertTrue(index_valid(conn, index.name),
+                                        index.name)
+
+    def test_replies_after_whole_chain(self):
+        """Does 0006 apply after 0002, and count replies once it has?"""
+
+        migrate(self.engine)
+
+        with self.engine.begin() as conn:
+            one, four = [conn.execute(
+                "SELECT id FROM messages WHERE text = %s", text).scalar()
+                for text in ('one', 'four')]
+            conn.execute(
+                "INSERT INTO replies (message_id, parent_id, root_id, path) "
+                "VALUES (%s, %s, %s, ARRAY[%s, %s])", four, one, one, one, four)
+
+            self.assertEqual(conn.execute(
+                "SELECT reply_count FROM messages WHERE id = %s", one).scalar(),
+                1)
+            self.assertEqual(conn.execute(
+                "SELECT count(*) FROM messages_archive").scalar(), 0)
+
+        self.assertTrue(all(state.startswith("applied")
+                            for name, state in status(self.engine)))
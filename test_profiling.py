@@ -0,0 +1,103 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import testing
+
+from app import create_app
+from config import TestConfig
+from models import db
+from profiling import HEADER, make_token
+
+
+def slow():
+    """Half in the database, half in Python."""
+
+    db.session.execute("SELECT pg_sleep(0.05)")
+
+    end = time.perf_counter() + 0.05
+    while time.perf_counter() < end:
+        pass
+
+    return "done"
+
+
+class ProfilingTestCase(TestCase):
+    """Test who gets profiled, what's recorded and how much is kept."""
+
+    def setUp(self):
+        testing.engine()
+        self.profile_dir = tempfile.TemporaryDirectory()
+
+        class Config(TestConfig):
+            PROFILE_REQUESTS = True
+            PROFILE_DIR = self.profile_dir.name
+            PROFILE_KEEP = 2
+            PROFILE_INTERVAL = 0.002
+
+        self.app = create_app(Config)
+        self.app.add_url_rule('/_test/slow', 'slow', slow)
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            self.token = make_token(self.app)
+
+    def tearDown(self):
+        self.profile_dir.cleanup()
+
+    def get(self, url, token=None):
+        headers = {HEADER: token} if token else {}
+        return self.client.get(url, headers=headers)
+
+    def profiles(self):
+        return sorted(os.listdir(self.profile_dir.name))
+
+    def test_needs_token(self):
+        self.assertNotIn(HEADER, self.get("/login").headers)
+        self.assertNotIn(HEADER, self.get("/login", token="forged").headers)
+        self.assertEqual(self.profiles(), [])
+
+        resp = self.get("/login", token=self.token)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.profiles(), [resp.headers[HEADER]])
+
+    def test_sample_rate(self):
+        class Config(TestConfig):
+            PROFILE_REQUESTS = True
+            PROFILE_DIR = self.profile_dir.name
+            PROFILE_SAMPLE_RATE = 1.0
+
+        resp = create_app(Config).test_client().get("/login")
+
+        self.assertEqual(self.profiles(), [resp.headers[HEADER]])
+
+    def test_collapsed_stacks(self):
+        resp = self.get("/_test/slow", token=self.token)
+
+        with open(os.path.join(self.profile_dir.name, resp.headers[HEADER])) as f:
+            stacks = dict(line.rsplit(" ", 1) for line in f.read().splitlines())
+
+        view = "GET /_test/slow;flask.app:dispatch_request;test_profiling:slow"
+        self.assertIn(view + ";[sql]", stacks)
+        self.assertIn(view, stacks)
+
+        timings = dict(
+            entry.split(";dur=")
+            for entry in resp.headers["Server-Timing"].split(", "))
+        self.assertGreater(float(timings["prof-sql"]), 10)
+        self.assertGreater(float(timings["prof-python"]), 10)
+
+    def test_ring_buffer(self):
+        names = [self.get("/login", token=self.token).headers[HEADER]
+                 for i in range(3)]
+
+        self.assertEqual(self.profiles(), names[1:])
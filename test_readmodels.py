@@ -0,0 +1,78 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+from readmodels import CARD_COLUMNS, Profile, load_profile, user_cards
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReadModelTestCase(DatabaseTestCase):
+    """Test profiles and cards, and the pages built on them."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.alice = User.signup("alice", "alice@test.com", "password", None)
+        self.bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+
+        self.alice_id = self.alice.id
+        self.bob_id = self.bob.id
+
+        self.client = app.test_client()
+
+    def test_load_profile(self):
+        msg = Message(text="hello", user_id=self.alice_id)
+        db.session.add(msg)
+        db.session.add(Follows(user_being_followed_id=self.alice_id,
+                               user_following_id=self.bob_id))
+        db.session.commit()
+        Likes.add(self.alice_id, msg.id)
+        db.session.commit()
+
+        profile = load_profile(self.alice_id)
+
+        self.assertIsInstance(profile, Profile)
+        self.assertEqual(profile.username, "alice")
+        self.assertEqual((profile.message_count, profile.following_count,
+                          profile.followers_count, profile.likes_count),
+                         (1, 0, 1, 1))
+        self.assertNotIn("password", Profile._fields)
+
+        self.assertIsNone(load_profile(999999))
+
+    def test_user_cards(self):
+        cards = user_cards(db.select(CARD_COLUMNS).order_by(User.id))
+
+        self.assertEqual([card.username for card in cards], ["alice", "bob"])
+        self.assertNotIn("password", cards[0]._fields)
+        # only loaded, never tracked
+        self.assertEqual(len(db.session.identity_map), 2)
+
+    def test_pages(self):
+        db.session.add(Follows(user_being_followed_id=self.bob_id,
+                               user_following_id=self.alice_id))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn(f'action="/users/stop-following/{self.bob_id}"', html)
+        self.assertIn(f'action="/users/follow/{self.alice_id}"', html)
+
+        html = self.client.get(f"/users/{self.bob_id}/followers").get_data(
+            as_text=True)
+        self.assertIn("@alice", html)
+
+        for path in ("", "/following", "/followers", "/likes", "/mentions"):
+            resp = self.client.get(f"/users/999999{path}")
+            self.assertEqual(resp.status_code, 404, path)
@@ -0,0 +1,71 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import os
+from unittest import TestCase, mock
+
+import testing
+
+from snowflake import (
+    INGEST_WORKER_ID, SEQUENCE_BITS, SnowflakeGenerator, MAX_WORKER_ID)
+
+
+def worker_of(id):
+    return (id >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+
+class WorkerIdTestCase(TestCase):
+    """Test live workers never share ids, or use the ingest worker's."""
+
+    def test_ids_increase(self):
+        generator = SnowflakeGenerator(worker_id=3)
+        ids = [generator() for i in range(10000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual({worker_of(id) for id in ids}, {3})
+
+    def test_ingest_worker_id_reserved(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(worker_id=INGEST_WORKER_ID)
+
+        # from a pid that used to map onto it
+        with mock.patch('os.getpid', return_value=INGEST_WORKER_ID):
+            self.assertNotEqual(worker_of(SnowflakeGenerator()()),
+                                INGEST_WORKER_ID)
+
+    def test_environment(self):
+        with mock.patch.dict(os.environ, WARBLER_WORKER_ID="7"):
+            self.assertEqual(worker_of(SnowflakeGenerator()()), 7)
+
+        # out of range is an error, not wrapped onto someone else's id
+        for bad in (str(INGEST_WORKER_ID), "1030", "-1", "seven"):
+            with mock.patch.dict(os.environ, WARBLER_WORKER_ID=bad):
+                with self.assertRaises(ValueError):
+                    SnowflakeGenerator()()
+                with self.assertRaises(ValueError):
+                    SnowflakeGenerator().lease_from(None)
+
+    def test_leases(self):
+        engine = testing.engine()
+        first, second = SnowflakeGenerator(), SnowflakeGenerator()
+        first.lease_from(engine)
+        second.lease_from(engine)
+
+        with mock.patch.dict(os.environ):
+            os.environ.pop('WARBLER_WORKER_ID', None)
+
+            self.assertNotEqual(first.claim(), second.claim())
+            self.assertEqual(worker_of(first()), first.claim())
+
+            # released when its holder goes away
+            taken = second.claim()
+            second._lease.close()
+            third = SnowflakeGenerator()
+            third.lease_from(engine)
+            self.assertEqual(third.claim(), taken)
+            third._lease.close()
+            first._lease.close()
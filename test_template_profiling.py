@@ -0,0 +1,67 @@
+"""Template profiling and bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_template_profiling.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+import testing
+
+from app import create_app
+from config import TestConfig
+
+
+class TemplateProfilingTestCase(TestCase):
+    """Test render timing and the on-disk template cache."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+        class Config(TestConfig):
+            PROFILE_TEMPLATES = True
+            TEMPLATE_BYTECODE_CACHE_DIR = self.cache_dir.name
+
+        self.app = create_app(Config)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_render_times_recorded(self):
+        """Are templates and their blocks timed, per request and overall?"""
+
+        resp = self.client.get("/login")
+        self.assertEqual(resp.status_code, 200)
+
+        server_timing = resp.headers["Server-Timing"]
+        self.assertIn('desc="users/login.html"', server_timing)
+        self.assertIn('desc="users/login.html:content"', server_timing)
+        self.assertIn('desc="base.html"', server_timing)
+
+        self.client.get("/login")
+
+        stats = {s["name"]: s for s in self.client.get("/_debug/templates").json["templates"]}
+        self.assertEqual(stats["users/login.html"]["count"], 2)
+        self.assertEqual(stats["users/login.html:content"]["count"], 2)
+        self.assertGreaterEqual(stats["users/login.html"]["total_ms"],
+                                stats["users/login.html:content"]["total_ms"])
+
+    def test_bytecode_cache_shared(self):
+        """Does a second app load compiled templates from the disk cache?"""
+
+        self.client.get("/login")
+        cached = os.listdir(self.cache_dir.name)
+        self.assertEqual(len(cached), 2)
+
+        class OtherConfig(TestConfig):
+            TEMPLATE_BYTECODE_CACHE_DIR = self.cache_dir.name
+
+        env = create_app(OtherConfig).jinja_env
+        source, filename, uptodate = env.loader.get_source(env, "base.html")
+        bucket = env.bytecode_cache.get_bucket(env, "base.html", filename, source)
+
+        self.assertIsNotNone(bucket.code)
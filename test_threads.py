@@ -0,0 +1,193 @@
+"""Reply thread tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_threads.py
+
+
+from datetime import datetime
+from unittest import mock
+
+from testing import DatabaseTestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, ArchivedMessage, Reply
+from partitions import archive_partitions
+from threads import MAX_ID, add_reply, position, replies_page
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ThreadTestCase(DatabaseTestCase):
+    """Test storing, counting and paging conversations."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup("alice", "alice@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+
+    def post(self, text, reply_to=None):
+        msg = Message(text=text, user_id=self.user_id)
+        db.session.add(msg)
+        db.session.flush()
+
+        if reply_to:
+            add_reply(db.session, msg.id, reply_to)
+
+        db.session.commit()
+        return msg.id
+
+    def conversation(self):
+        """root
+             a
+               a1
+                 a1x
+               a2
+             b
+        """
+
+        ids = {'root': self.post("root")}
+        ids['a'] = self.post("a", ids['root'])
+        ids['b'] = self.post("b", ids['root'])
+        ids['a1'] = self.post("a1", ids['a'])
+        ids['a2'] = self.post("a2", ids['a'])
+        ids['a1x'] = self.post("a1x", ids['a1'])
+        return ids
+
+    def names(self, ids, page):
+        by_id = {id: name for name, id in ids.items()}
+        return [(by_id[id], depth) for id, depth in page]
+
+    def reply_count(self, message_id):
+        return db.session.query(Message.reply_count).filter_by(
+            id=message_id).scalar()
+
+    def test_paths(self):
+        ids = self.conversation()
+
+        self.assertEqual(position(db.session, ids['root']),
+                         (ids['root'], [ids['root']]))
+        self.assertEqual(position(db.session, ids['a1x']),
+                         (ids['root'], [ids['root'], ids['a'], ids['a1'], ids['a1x']]))
+
+    def test_replies_page(self):
+        ids = self.conversation()
+
+        root_id, path = position(db.session, ids['root'])
+
+        # depth-first, oldest first
+        self.assertEqual(self.names(ids, replies_page(db.session, root_id, path)),
+                         [('a', 1), ('a1', 2), ('a1x', 3), ('a2', 2), ('b', 1)])
+
+        self.assertEqual(
+            self.names(ids, replies_page(db.session, root_id, path, depth=1)),
+            [('a', 1), ('b', 1)])
+
+        self.assertEqual(
+            self.names(ids, replies_page(db.session, root_id, path,
+                                         after=ids['a1'], limit=2)),
+            [('a1x', 3), ('a2', 2)])
+
+        # one warble's part of the conversation
+        root_id, path = position(db.session, ids['a'])
+        self.assertEqual(self.names(ids, replies_page(db.session, root_id, path)),
+                         [('a1', 1), ('a1x', 2), ('a2', 1)])
+
+    def test_reply_counts(self):
+        ids = self.conversation()
+
+        self.assertEqual(self.reply_count(ids['root']), 2)
+        self.assertEqual(self.reply_count(ids['a']), 2)
+        self.assertEqual(self.reply_count(ids['a1x']), 0)
+
+        db.session.delete(Message.query.get(ids['a2']))
+        db.session.commit()
+        self.assertEqual(self.reply_count(ids['a']), 1)
+
+        # the replies under a deleted warble stay where they were
+        db.session.delete(Message.query.get(ids['a']))
+        db.session.commit()
+        self.assertEqual(self.reply_count(ids['root']), 1)
+
+        root_id, path = position(db.session, ids['root'])
+        self.assertEqual(self.names(ids, replies_page(db.session, root_id, path)),
+                         [('a1', 2), ('a1x', 3), ('b', 1)])
+
+    def test_archived_replies_still_counted(self):
+        ids = self.conversation()
+
+        archive_partitions(db.session.connection(), now=datetime(2040, 1, 1))
+
+        self.assertEqual(Reply.query.count(), 0)
+        self.assertEqual(
+            db.session.query(ArchivedMessage.reply_count)
+            .filter_by(id=ids['root']).scalar(), 2)
+
+    def test_views(self):
+        root_id = self.post("what's new?")
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get(f"/messages/new?reply_to={root_id}")
+        self.assertIn("Replying to", resp.get_data(as_text=True))
+
+        resp = self.client.post(f"/messages/new?reply_to={root_id}",
+                                data={"text": "not much"})
+        self.assertEqual(resp.location, f"http://localhost/messages/{root_id}")
+
+        reply_id = Message.query.filter_by(text="not much").one().id
+        self.assertEqual(self.reply_count(root_id), 1)
+
+        html = self.client.get(f"/messages/{root_id}").get_data(as_text=True)
+        self.assertIn("not much", html)
+
+        # a reply shows what it replies to
+        html = self.client.get(f"/messages/{reply_id}").get_data(as_text=True)
+        self.assertLess(html.index("what&#39;s new?"), html.index("not much"))
+
+        resp = self.client.post("/messages/new?reply_to=99999",
+                                data={"text": "to nobody"})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_view_pages_and_depth(self):
+        ids = self.conversation()
+
+        with mock.patch('app.REPLIES_PER_PAGE', 2), \
+                mock.patch('app.THREAD_DEPTH', 2):
+            html = self.client.get(f"/messages/{ids['root']}").get_data(as_text=True)
+
+            self.assertIn(f"/messages/{ids['root']}?after={ids['a1']}", html)
+            self.assertIn("a1", html)
+            self.assertNotIn("a2", html)
+
+            html = self.client.get(
+                f"/messages/{ids['root']}?after={ids['a1']}").get_data(as_text=True)
+
+            # a1x is too deep for this page
+            self.assertIn("a2", html)
+            self.assertIn("<p>b</p>", html)
+            self.assertNotIn("a1x", html)
+
+    def test_conversation_is_a_range_read(self):
+        ids = self.conversation()
+        root_id, path = position(db.session, ids['a'])
+
+        raw = db.session.connection().connection.cursor()
+        # the table is tiny; make the planner show what it does at scale
+        raw.execute("SET LOCAL enable_seqscan = off")
+        raw.execute("SET LOCAL enable_bitmapscan = off")
+
+        raw.execute(
+            "EXPLAIN SELECT message_id FROM replies "
+            "WHERE root_id = %s AND path > %s AND path < %s "
+            "ORDER BY path LIMIT 100",
+            (root_id, path, path + [MAX_ID]))
+        plan = "\n".join(line for line, in raw.fetchall())
+
+        self.assertIn("Index Scan using ix_replies_root_id_path", plan)
+        self.assertNotIn("Sort", plan)
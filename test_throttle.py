@@ -0,0 +1,131 @@
+"""Login throttle tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_throttle.py
+
+
+from unittest import TestCase, mock
+
+import testing
+
+from app import create_app
+from config import TestConfig
+from models import db, User, RateLimitBucket
+from throttle import MemoryBucketStore, DatabaseBucketStore
+
+
+class ThrottleConfig(TestConfig):
+    LOGIN_THROTTLE = True
+    LOGIN_THROTTLE_PER_IP = (4, 1 / 60)
+    LOGIN_THROTTLE_PER_USERNAME = (2, 1 / 60)
+
+
+class BucketStoreTestCase(TestCase):
+    """Test both bucket stores take and refill tokens the same way."""
+
+    def setUp(self):
+        self.app = create_app(ThrottleConfig)
+        testing.engine()
+        RateLimitBucket.query.delete()
+        db.session.commit()
+
+    def check_store(self, store):
+        self.assertEqual(store.take("k", 2, 1 / 60)[0], True)
+        self.assertEqual(store.take("k", 2, 1 / 60)[0], True)
+
+        allowed, tokens = store.take("k", 2, 1 / 60)
+        self.assertFalse(allowed)
+        self.assertLess(tokens, 1)
+
+        # other keys have their own bucket
+        self.assertEqual(store.take("other", 2, 1 / 60)[0], True)
+
+        # a fast refill rate lets attempts through again
+        self.assertEqual(store.take("k", 2, 1e9)[0], True)
+
+    def test_memory_store(self):
+        self.check_store(MemoryBucketStore())
+
+    def test_memory_store_bounded(self):
+        store = MemoryBucketStore(max_keys=10)
+
+        for i in range(50):
+            store.take(f"k{i}", 2, 1 / 60)
+            # kept in use, so never the one forgotten
+            store.take("busy", 1000, 1 / 60)
+
+        self.assertEqual(len(store._buckets), 10)
+        self.assertEqual(list(store._buckets)[-2:], ["k49", "busy"])
+
+    def test_database_store(self):
+        with self.app.app_context():
+            self.check_store(DatabaseBucketStore())
+
+
+class LoginThrottleViewTestCase(TestCase):
+    """Test the auth views turn away attempts over the limits."""
+
+    def setUp(self):
+        self.app = create_app(ThrottleConfig)
+        self.client = self.app.test_client()
+        self.throttle = self.app.extensions['login_throttle']
+
+    def test_login_throttled_per_username(self):
+        """Are attempts past the username limit refused without hashing?"""
+
+        with mock.patch.object(User, 'authenticate', return_value=False) as auth:
+            for i in range(2):
+                resp = self.client.post("/login", data={"username": "victim", "password": "guess123"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = self.client.post("/login", data={"username": "victim", "password": "guess123"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertIn("Too many attempts", str(resp.data))
+
+            # another username from the same IP still gets one more try
+            # (the refused attempt above counted against the IP too)
+            resp = self.client.post("/login", data={"username": "someone", "password": "guess123"})
+            self.assertEqual(resp.status_code, 200)
+
+            # ...and then the IP limit kicks in
+            resp = self.client.post("/login", data={"username": "else", "password": "guess123"})
+            self.assertEqual(resp.status_code, 429)
+
+            self.assertEqual(auth.call_count, 3)
+
+        self.assertEqual(self.throttle.rejected, 2)
+        self.assertGreater(self.throttle.saved_cpu_seconds(), 0)
+
+    def test_client_address_behind_proxy(self):
+        class ProxyConfig(ThrottleConfig):
+            PROXY_HOPS = 1
+
+        client = create_app(ProxyConfig).test_client()
+        throttle = client.application.extensions['login_throttle']
+
+        with mock.patch.object(throttle.store, 'take',
+                               return_value=(False, 0.5)) as take:
+            # the leftmost address is the client's to make up
+            client.post("/signup", data={
+                "username": "new", "email": "new@test.com",
+                "password": "password"},
+                headers={"X-Forwarded-For": "10.0.0.1, 203.0.113.7"})
+
+        take.assert_called_once_with("ip:203.0.113.7", 4, 1 / 60)
+
+    def test_calibrated_at_startup(self):
+        self.assertGreater(self.throttle.hash_seconds, 0)
+
+    def test_signup_throttled_per_ip(self):
+        with mock.patch.object(User, 'signup') as signup:
+            signup.side_effect = RuntimeError("should not get here")
+
+            with mock.patch.object(self.throttle.store, 'take', return_value=(False, 0.5)):
+                resp = self.client.post("/signup", data={
+                    "username": "new", "email": "new@test.com", "password": "password"})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers["Retry-After"], "30")
+            signup.assert_not_called()
@@ -0,0 +1,226 @@
+"""Thumbnail pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_thumbnails.py
+
+
+import io
+import os
+import re
+import socket
+import tempfile
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from testing import DatabaseTestCase
+
+from app import create_app, CURR_USER_KEY
+from config import TestConfig
+from models import db, User
+from jobs import run_batch
+from thumbnails import (
+    ThumbnailError, _opener, check_public_url, render_thumbnail)
+
+STATIC_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'static', 'images')
+
+THUMBNAIL_RE = re.compile(r'/thumbnails/[0-9a-f]{64}\.webp')
+
+
+def read_image(name):
+    with open(os.path.join(STATIC_IMAGES, name), 'rb') as f:
+        return f.read()
+
+
+class RenderThumbnailTestCase(TestCase):
+    """Test turning source images into thumbnails."""
+
+    def test_avatar_cropped_square(self):
+        webp = render_thumbnail(read_image('default-pic.png'), 96, 96, True)
+        image = Image.open(io.BytesIO(webp))
+
+        self.assertEqual(image.format, 'WEBP')
+        self.assertEqual(image.size, (96, 96))
+
+    def test_header_keeps_aspect_ratio(self):
+        source = read_image('warbler-hero.jpg')
+        width, height = Image.open(io.BytesIO(source)).size
+
+        webp = render_thumbnail(source, 600, 200, False)
+        thumb = Image.open(io.BytesIO(webp))
+
+        self.assertLessEqual(thumb.width, 600)
+        self.assertLessEqual(thumb.height, 200)
+        self.assertAlmostEqual(thumb.width / thumb.height, width / height,
+                               delta=0.05)
+        self.assertLess(len(webp), len(source))
+
+    def test_not_an_image(self):
+        with self.assertRaises(ThumbnailError):
+            render_thumbnail(b"<html></html>", 96, 96, True)
+
+    def test_private_sources_refused(self):
+        for url in ("http://127.0.0.1/a.png", "http://10.0.0.1/a.png",
+                    "file:///etc/passwd", "/etc/passwd"):
+            with self.assertRaises(ThumbnailError):
+                check_public_url(url)
+
+    def test_port_from_scheme(self):
+        with mock.patch('socket.getaddrinfo', return_value=[
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 ('93.184.216.34', 443))]) as getaddrinfo:
+            self.assertEqual(check_public_url("https://example.test/a.png"),
+                             "93.184.216.34")
+
+        self.assertEqual(getaddrinfo.call_args[0][:2], ("example.test", 443))
+
+    def test_connects_to_checked_address(self):
+        """Can't a name be re-resolved somewhere private after the check?"""
+
+        answers = iter(["93.184.216.34", "127.0.0.1"])
+
+        def getaddrinfo(host, port, *args, **kwargs):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     (next(answers), port))]
+
+        with mock.patch('socket.getaddrinfo', getaddrinfo), \
+                mock.patch('socket.create_connection',
+                           side_effect=OSError("no network")) as connect:
+            with self.assertRaises(OSError):
+                _opener.open("http://rebind.test/a.png", timeout=1)
+
+        self.assertEqual(connect.call_args[0][0], ("93.184.216.34", 80))
+
+
+class ThumbnailCacheTestCase(DatabaseTestCase):
+    """Test the on-disk cache and its views."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+
+        class Config(TestConfig):
+            THUMBNAIL_CACHE_DIR = self.tmp.name
+
+        self.app = create_app(Config)
+        self.thumbnails = self.app.extensions['thumbnails']
+        self.client = self.app.test_client()
+
+        user = User.signup("thumbs", "thumbs@test.com", "password", None)
+        user.header_image_url = "/static/images/warbler-hero.jpg"
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def page_thumbnail_urls(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        html = self.client.get(f"/users/{self.user_id}").get_data(as_text=True)
+        return re.findall(r'src="([^"]*thumbnails[^"]*)"', html)
+
+    def page_thumbnail_urls_for(self, user):
+        with self.app.test_request_context():
+            template = self.app.jinja_env.from_string(
+                "{% for size in sizes %}{{ thumbnail_url(user, size) }} "
+                "{% endfor %}")
+            sizes = ['timeline', 'card', 'profile', 'card-header', 'header']
+            return template.render(user=user, sizes=sizes).split()
+
+    def test_rendered_on_first_request(self):
+        urls = self.page_thumbnail_urls()
+        self.assertIn(f"/users/{self.user_id}/thumbnails/profile", urls)
+
+        resp = self.client.get(f"/users/{self.user_id}/thumbnails/profile")
+        self.assertEqual(resp.status_code, 302)
+        self.assertRegex(resp.location, THUMBNAIL_RE)
+
+        thumbnail_path = THUMBNAIL_RE.search(resp.location).group()
+
+        resp = self.client.get(thumbnail_path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (400, 400))
+
+        # the page now links the cached thumbnail directly
+        self.assertIn(thumbnail_path, self.page_thumbnail_urls())
+
+    def test_warm_on_signup(self):
+        resp = self.client.post("/signup", data={
+            "username": "warm",
+            "email": "warm@test.com",
+            "password": "password",
+            "image_url": "/static/images/warbler-logo.png",
+        })
+        self.assertEqual(resp.status_code, 302)
+
+        user = User.query.filter_by(username="warm").one()
+
+        # queued, not rendered in the request
+        self.assertIn(f"/users/{user.id}/thumbnails/timeline",
+                      self.page_thumbnail_urls_for(user))
+
+        with self.app.app_context(), \
+                mock.patch.object(self.thumbnails, 'fetch',
+                                  wraps=self.thumbnails.fetch) as fetch:
+            self.assertEqual(run_batch(db.session.connection()), 1)
+
+        # once per source, not per size
+        self.assertEqual(sorted(call[0][0] for call in fetch.call_args_list),
+                         ["/static/images/warbler-hero.jpg",
+                          "/static/images/warbler-logo.png"])
+
+        for url in self.page_thumbnail_urls_for(user):
+            self.assertRegex(url, THUMBNAIL_RE)
+
+    def test_unfetchable_source_gets_default(self):
+        user = User.query.get(self.user_id)
+        user.image_url = "http://127.0.0.1/private.png"
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.user_id}/thumbnails/timeline")
+        self.assertEqual(resp.status_code, 302)
+
+        default = self.thumbnails.lookup(User.image_url.default.arg, 'timeline')
+        self.assertTrue(resp.location.endswith(f"/thumbnails/{default}.webp"))
+
+    def test_unknown_thumbnails(self):
+        self.assertEqual(self.client.get(
+            f"/users/{self.user_id}/thumbnails/huge").status_code, 404)
+        self.assertEqual(self.client.get(
+            f"/thumbnails/{'0' * 64}.webp").status_code, 404)
+        self.assertEqual(self.client.get(
+            "/thumbnails/..%2Fconfig.webp").status_code, 404)
+
+    def test_eviction(self):
+        """Is the cache kept under its size limit, oldest out first?"""
+
+        sources = ['default-pic.png', 'warbler-hero.jpg', 'warbler-logo.png',
+                   'nav-bg.png', 'signed-out-home.jpg']
+        digests = []
+
+        for i, name in enumerate(sources):
+            digest = self.thumbnails.render(f"/static/images/{name}",
+                                            'header')
+            # a distinct, increasing "last served" time for each
+            os.utime(self.thumbnails.path(digest), (i, i))
+            digests.append(digest)
+
+        sizes = [os.path.getsize(self.thumbnails.path(d)) for d in digests]
+        self.thumbnails.prune(target=sum(sizes[-2:]))
+
+        self.assertLessEqual(self.thumbnails.disk_usage(), sum(sizes[-2:]))
+        self.assertIsNone(self.thumbnails.lookup(
+            "/static/images/default-pic.png", 'header'))
+        self.assertEqual(self.thumbnails.lookup(
+            "/static/images/signed-out-home.jpg", 'header'), digests[-1])
+
+        # an evicted thumbnail is rendered again on demand
+        self.assertEqual(self.thumbnails.render(
+            "/static/images/default-pic.png", 'header'), digests[0])
@@ -5,18 +5,15 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, let testing point DATABASE_URL at this test
+# process's own database (we need to do this before we import our app,
+# since that will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from testing import DatabaseTestCase
 
 
 # Now we can import app
@@ -24,21 +21,14 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from app import app
 import pdb
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
 
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test User model functionality."""
 
     def setUp(self):
         """Add sample data."""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         u1 = User.signup("test1", "email1@email.com", "password", None)
         uid1 = 1111
@@ -120,6 +110,43 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.u1.is_followed_by(self.u2))
         self.assertFalse(self.u2.is_followed_by(self.u1))
 
+    def test_follows_add_remove(self):
+        """Are follow writes single idempotent statements?"""
+
+        self.assertTrue(Follows.add(self.uid1, self.uid2))
+        self.assertFalse(Follows.add(self.uid1, self.uid2))
+        db.session.commit()
+
+        self.assertEqual(self.u1.following, [self.u2])
+
+        self.assertTrue(Follows.remove(self.uid1, self.uid2))
+        self.assertFalse(Follows.remove(self.uid1, self.uid2))
+        db.session.commit()
+
+        self.assertEqual(Follows.query.count(), 0)
+
+        with self.assertRaises(IntegrityError):
+            Follows.add(self.uid1, 99999)
+
+    def test_follows_add_by_username(self):
+        """Does a bulk follow skip unknown names, repeats and yourself?"""
+
+        Follows.add(self.uid1, self.uid2)
+
+        added = Follows.add_by_username(
+            self.uid1, ["test1", "test2", "nobody"])
+        db.session.commit()
+
+        self.assertEqual(added, 0)
+
+        u3 = User.signup("test3", "email3@email.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual(Follows.add_by_username(self.uid1, ["test3"]), 1)
+        self.assertEqual(
+            sorted(f.user_being_followed_id for f in Follows.query),
+            sorted([self.uid2, u3.id]))
+
     ### User.signup tests ###
 
     def test_user_signup_valid(self):
@@ -5,19 +5,21 @@
 #    python -m unittest test_user_views.py
 
 
-import os
-from unittest import TestCase
+from datetime import datetime
+from unittest import mock
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Message, Follows, Likes
 from bs4 import BeautifulSoup
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from partitions import archive_partitions
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, let testing point DATABASE_URL at this test
+# process's own database (we need to do this before we import our app,
+# since that will have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from testing import DatabaseTestCase
 
 
 # Now we can import app
@@ -25,24 +27,17 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from app import app, CURR_USER_KEY
 import pdb
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(DatabaseTestCase):
     """Test User views functionality"""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -172,6 +167,79 @@ class UserViewsTestCase(TestCase):
             # test that like was removed
             self.assertEqual(len(likes), 0)
 
+    def test_remove_like_leaves_others(self):
+        """Does unliking only remove the current user's like?"""
+
+        self.setup_likes()
+
+        db.session.add(Likes(user_id=self.u2_id, message_id=3333))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            client.post("/users/remove_like/3333")
+
+        likes = Likes.query.filter(Likes.message_id == 3333).all()
+        self.assertEqual([like.user_id for like in likes], [self.u2_id])
+
+    def test_add_like_twice(self):
+        self.setup_likes()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = client.post("/users/add_like/3333")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(Likes.query.filter_by(message_id=3333).count(), 1)
+
+    def test_add_like_missing_message(self):
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = client.post("/users/add_like/999999")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_show_likes(self):
+        """Does the likes page show the requested user's likes, latest first?"""
+
+        self.setup_likes()
+
+        m1 = Message.query.filter_by(text="testuser message1").one()
+        m2 = Message.query.filter_by(text="testuser message2").one()
+
+        db.session.add_all([
+            Likes(user_id=self.u1_id, message_id=m2.id,
+                  created_at=datetime(2020, 1, 1)),
+            Likes(user_id=self.u1_id, message_id=m1.id,
+                  created_at=datetime(2021, 1, 1)),
+        ])
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = client.get(f"/users/{self.u1_id}/likes")
+            html = str(resp.data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("testuser message1", html)
+            self.assertIn("testuser message2", html)
+            self.assertNotIn("likeable message3", html)
+            self.assertLess(html.index("testuser message1"),
+                            html.index("testuser message2"))
+
+            resp = client.get(f"/users/{self.testuser_id}/likes")
+            self.assertIn("likeable message3", str(resp.data))
+            self.assertNotIn("testuser message1", str(resp.data))
+
     def test_unauthenticated_like(self):
         self.setup_likes()
 
@@ -269,4 +337,128 @@ class UserViewsTestCase(TestCase):
             resp = c.get(f"/users/{self.testuser_id}/followers", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
 
-            self.assertIn("Access unauthorized", str(resp.data))
\ No newline at end of file
+            self.assertIn("Access unauthorized", str(resp.data))
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+    def following_ids(self):
+        return sorted(f.user_being_followed_id for f
+                      in Follows.query.filter_by(user_following_id=self.testuser_id))
+
+    def test_follow_and_unfollow(self):
+        """Are follows added and removed, twice over, without errors?"""
+
+        with self.client as c:
+            self.login(c)
+
+            for i in range(2):
+                resp = c.post(f"/users/follow/{self.u1_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(self.following_ids(), [self.u1_id])
+
+            for i in range(2):
+                resp = c.post(f"/users/stop-following/{self.u1_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(self.following_ids(), [])
+
+            resp = c.post("/users/follow/99999")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_import_following(self):
+        """Does the import follow every named user in one go?"""
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/users/following/import")
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.post("/users/following/import",
+                          data={"usernames": "@abc, efg\nnobody testuser"},
+                          follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Followed 2 more users.", str(resp.data))
+
+            self.assertEqual(self.following_ids(),
+                             sorted([self.u1_id, self.u2_id]))
+
+            with mock.patch('app.FOLLOW_IMPORT_MAX', 1):
+                resp = c.post("/users/following/import",
+                              data={"usernames": "hij testing"})
+            self.assertIn("At most 1 usernames", str(resp.data))
+
+    def test_users_show_archived_messages(self):
+        """Are archived warbles still shown on the profile and message pages?"""
+
+        m = Message(text="archived warble", user_id=self.testuser_id)
+        db.session.add(m)
+        db.session.flush()
+        msg_id = m.id
+        db.session.commit()
+
+        archive_partitions(db.session.connection(), now=datetime(2040, 1, 1))
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("archived warble", str(resp.data))
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("archived warble", str(resp.data))
+
+
+    def test_following_pages_paginated(self):
+        """Do ?after= cursors page through the following list by user id?"""
+
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with mock.patch('app.FOLLOWS_PER_PAGE', 1):
+                resp = c.get(f"/users/{self.testuser_id}/following")
+                self.assertIn("@abc", str(resp.data))
+                self.assertNotIn("@efg", str(resp.data))
+
+                resp = c.get(f"/users/{self.testuser_id}/following?after={self.u1_id}")
+                self.assertNotIn("@abc", str(resp.data))
+                self.assertIn("@efg", str(resp.data))
+
+    def test_follow_badges(self):
+        """Are "Follows you" badges shown, without loading follower passwords?"""
+
+        self.setup_followers()
+
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", capture)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get(f"/users/{self.testuser_id}/following")
+        finally:
+            event.remove(Engine, "before_cursor_execute", capture)
+
+        soup = BeautifulSoup(str(resp.data), 'html.parser')
+        cards = {card.find("p").text: card for card in soup.find_all("div", {"class": "card-contents"})}
+
+        # abc follows testuser back, efg doesn't
+        self.assertIn("Follows you", cards["@abc"].text)
+        self.assertNotIn("Follows you", cards["@efg"].text)
+
+        follow_queries = [s for s in statements if "JOIN follows" in s]
+        self.assertTrue(follow_queries)
+        for statement in follow_queries:
+            self.assertNotIn("users.password", statement)
@@ -0,0 +1,227 @@
+"""Database fixtures for the test suite.
+
+Importing this module points DATABASE_URL at this test process's own
+database: `warbler-test`, or `warbler-test-gw0`, `warbler-test-gw1`, ...
+under pytest-xdist, so workers never share one:
+
+    python -m pytest -n auto
+
+Each database is created on first use, and its schema built once and
+kept for as long as the models' DDL stays the same.
+
+Tests that only go through db.session subclass DatabaseTestCase. Each
+test runs inside one database transaction, rolled back afterwards, with
+the session working in a SAVEPOINT inside it: the code under test can
+commit and roll back as usual, and nothing is ever really written, so
+there's nothing to delete between tests. Tests that need data other
+connections can see (asyncpg, a second engine) commit for real and call
+reset_tables() instead.
+"""
+
+import hashlib
+import inspect
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.schema import CreateIndex, CreateTable, DDLElement
+
+BASE_DATABASE_URL = os.environ.get(
+    'TEST_DATABASE_URL', 'postgresql:///warbler-test')
+
+
+def worker_database_url(base=BASE_DATABASE_URL, worker=None):
+    """The database URL for a pytest-xdist worker (or a plain run)."""
+
+    worker = worker or os.environ.get('PYTEST_XDIST_WORKER')
+    return f"{base}-{worker}" if worker else base
+
+
+DATABASE_URL = worker_database_url()
+
+# Before the app is imported, so it connects to this process's database.
+os.environ['DATABASE_URL'] = DATABASE_URL
+os.environ.setdefault('WARBLER_CONFIG', 'test')
+
+from models import db  # noqa: E402
+import partitions  # noqa: E402
+
+_engine = None
+
+
+def engine():
+    """This process's engine for the test database; made on first use."""
+
+    global _engine
+
+    if _engine is None:
+        create_database(DATABASE_URL)
+        _engine = create_engine(DATABASE_URL)
+        create_schema(_engine)
+
+    return _engine
+
+
+def create_database(url):
+    """CREATE DATABASE for `url`, if it doesn't exist yet."""
+
+    url = make_url(url)
+    server_url = make_url(str(url))
+    server_url.database = 'postgres'
+    server = create_engine(server_url, isolation_level='AUTOCOMMIT')
+
+    try:
+        with server.connect() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM pg_database WHERE datname = %s",
+                url.database).first()
+
+            if not exists:
+                conn.execute(f'CREATE DATABASE "{url.database}"')
+    finally:
+        server.dispose()
+
+
+def schema_fingerprint():
+    """A hash of the DDL db.create_all() would run.
+
+    after_create listeners count too: DDL statements (the triggers) by
+    their text, functions (the initial partitions) by their source.
+    """
+
+    dialect = postgresql.dialect()
+    ddl = []
+
+    for table in db.metadata.sorted_tables:
+        ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(CreateIndex(index).compile(dialect=dialect))
+                   for index in sorted(table.indexes, key=lambda i: i.name))
+
+        for listener in table.dispatch.after_create:
+            if isinstance(listener, DDLElement):
+                ddl.append(str(listener.compile(dialect=dialect)))
+            else:
+                ddl.append(inspect.getsource(listener))
+
+    return hashlib.sha256("\n".join(ddl).encode()).hexdigest()
+
+
+def create_schema(engine):
+    """Build the schema, unless it's already built from the same models.
+
+    A kept schema still gets this month's message partitions, and the
+    ones after it, as the calendar moves on.
+    """
+
+    fingerprint = schema_fingerprint()
+
+    with engine.begin() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS test_schema "
+                     "(fingerprint TEXT NOT NULL)")
+        current = conn.execute("SELECT fingerprint FROM test_schema").scalar()
+
+        if current != fingerprint:
+            db.metadata.drop_all(conn)
+            db.metadata.create_all(conn)
+            conn.execute("DELETE FROM test_schema")
+            conn.execute("INSERT INTO test_schema VALUES (%s)", fingerprint)
+
+        partitions.ensure_partitions(conn)
+
+
+def reset_tables():
+    """Empty every table, for tests that commit for real."""
+
+    tables = ", ".join(table.name for table in db.metadata.sorted_tables)
+
+    with engine().begin() as conn:
+        conn.execute(f"TRUNCATE {tables} RESTART IDENTITY CASCADE")
+
+
+class _SavepointScopedSession(orm.scoped_session):
+    """db.session for the length of one test.
+
+    Flask-SQLAlchemy removes the session after every request; here that
+    has close()'s effect (uncommitted work dropped, objects detached)
+    without leaving the test's transaction.
+    """
+
+    def remove(self):
+        if self.registry.has():
+            session = self.registry()
+            # detach first, so (as with close()) nothing is expired
+            session.expunge_all()
+            session.rollback()
+
+    def end(self):
+        if self.registry.has():
+            session = self.registry()
+            session.info['ending'] = True
+            # closing with a SAVEPOINT open deactivates the outer
+            # transaction before the test's rollback gets to it
+            session.rollback()
+            session.close()
+
+        self.registry.clear()
+
+
+def savepoint_session(connection):
+    """A scoped session on `connection` that always works in a SAVEPOINT.
+
+    When the code under test commits or rolls back, that releases or
+    rolls back the SAVEPOINT, and a new one is started.
+    """
+
+    factory = db.create_session({
+        'bind': connection,
+        'binds': {},
+        'query_cls': db.Query,
+    })
+
+    @event.listens_for(factory, 'after_transaction_end')
+    def restart_savepoint(session, transaction):
+        if (transaction.nested and not transaction._parent.nested
+                and not session.info.get('ending')):
+            session.expire_all()
+            session.begin_nested()
+
+    def make_session():
+        session = factory()
+        session.begin_nested()
+        return session
+
+    return _SavepointScopedSession(
+        make_session, scopefunc=db.session.registry.scopefunc)
+
+
+class DatabaseTestCase(TestCase):
+    """A test case whose database changes are all rolled back.
+
+    Subclasses' setUp must call super().setUp() before touching the
+    database.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # whatever earlier, committing tests left behind
+        reset_tables()
+
+    def setUp(self):
+        super().setUp()
+
+        connection = engine().connect()
+        transaction = connection.begin()
+        session = savepoint_session(connection)
+        original_session = db.session
+        db.session = session
+
+        def rollback():
+            session.end()
+            db.session = original_session
+            transaction.rollback()
+            connection.close()
+
+        self.addCleanup(rollback)
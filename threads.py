@@ -0,0 +1,113 @@
+"""Conversations: warbles replying to warbles, to any depth.
+
+Each reply's place in its conversation is a row in `replies`:
+
+    message_id   the reply
+    parent_id    the warble it answers
+    root_id      the warble that started the conversation
+    path         ids from the root down to the reply, e.g. {root, a, b}
+
+Sorted by path, a conversation comes out depth-first: every warble
+followed by its replies, oldest first (ids are time-sortable). All of a
+warble's replies, at any depth, have paths starting with its own, so
+they're one contiguous range of the (root_id, path) index: loading a
+conversation, one warble's part of it, or only its first few levels, is
+a single range read. Long ones are paged by keyset like the feeds, on
+?after=<the last reply shown>, instead of loading every descendant.
+
+messages.reply_count, the number of direct replies, is kept up by a
+trigger on `replies` (models.REPLY_COUNT_DDL), so it stays right when
+replies are deleted, directly or by cascade.
+
+Like tags and mentions, `replies` covers the live tier:
+partitions.archive_partitions drops the rows of the months it archives,
+and archived warbles can't be replied to.
+"""
+
+from models import db, Reply
+
+# A bound above every message id, for "paths starting with this one".
+MAX_ID = 2 ** 63 - 1
+
+POSITION = db.text("SELECT root_id, path FROM replies WHERE message_id = :id")
+
+ADD = db.text("""
+INSERT INTO replies (message_id, parent_id, root_id, path)
+SELECT :id, :parent_id,
+       coalesce(parent.root_id, :parent_id),
+       coalesce(parent.path, ARRAY[CAST(:parent_id AS BIGINT)]) || CAST(:id AS BIGINT)
+FROM (SELECT 1) AS one
+LEFT JOIN replies AS parent ON parent.message_id = :parent_id
+""")
+
+
+def add_reply(connection, message_id, parent_id):
+    """Record warble `message_id` as a reply to `parent_id`.
+
+    `connection` is a Connection or db.session. Doesn't commit.
+    """
+
+    connection.execute(ADD, {'id': message_id, 'parent_id': parent_id})
+
+
+def position(connection, message_id):
+    """(root id, path) of a warble.
+
+    A warble that isn't a reply is the root of its own conversation,
+    with a path of just itself.
+    """
+
+    row = connection.execute(POSITION, {'id': message_id}).first()
+
+    if row is None:
+        return message_id, [message_id]
+
+    return row.root_id, row.path
+
+
+def replies_query(root_id, path, after=None, depth=None, limit=100):
+    """The SELECT behind replies_page.
+
+    Every argument is a bound parameter, named after it (and `depth`'s
+    condition is left out when it's None), so asgi.py can compile it once
+    and bind its own.
+    """
+
+    replies = Reply.__table__
+    path_type = replies.c.path.type
+    path = db.cast(db.bindparam('path', path), path_type)
+    level = db.func.cardinality(replies.c.path) - db.func.cardinality(path)
+
+    lower = db.func.coalesce(
+        db.select([replies.c.path])
+        .where(replies.c.message_id == db.bindparam('after', after))
+        .as_scalar(),
+        path)
+    upper = path.op('||')(db.cast(db.bindparam('max_id', MAX_ID),
+                                  db.BigInteger))
+
+    query = (db.select([replies.c.message_id, level.label('depth')])
+             .where(replies.c.root_id == db.bindparam('root_id', root_id))
+             .where(replies.c.path > lower)
+             .where(replies.c.path < upper)
+             .order_by(replies.c.path)
+             .limit(db.bindparam('limit', limit)))
+
+    if depth is not None:
+        query = query.where(level <= db.bindparam('depth', depth))
+
+    return query
+
+
+def replies_page(connection, root_id, path, after=None, depth=None,
+                 limit=100):
+    """One page of the replies under the warble at `path`, depth-first.
+
+    Returns (message id, depth) pairs, depth 1 for direct replies. With
+    `depth`, replies deeper than that are left out; with `after` (a
+    reply id from the last page), the page starts after that reply.
+    """
+
+    query = replies_query(root_id, path, after, depth, limit)
+
+    return [(row.message_id, row.depth) for row in connection.execute(query)]
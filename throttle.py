@@ -0,0 +1,189 @@
+"""Token-bucket throttling for login and signup.
+
+Every POST to /login or /signup that gets past form validation costs a
+bcrypt hash (~250 ms of CPU). A credential-stuffing burst can turn that
+into a denial of service, so attempts are counted against token buckets
+first, per client IP and (for logins) per username, and refused with a
+429 before any hashing happens.
+
+A bucket holds up to `capacity` tokens and refills at `rate` tokens per
+second; each attempt takes one. Bucket state lives in a store:
+
+- MemoryBucketStore: per process, no setup. Each worker throttles alone,
+  so the effective limit is multiplied by the number of workers.
+- DatabaseBucketStore: one row per bucket in Postgres, shared by every
+  worker and host. One round trip per check, against ~250 ms of bcrypt.
+
+Pick with LOGIN_THROTTLE_STORE = 'memory' | 'database'.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from models import db, bcrypt
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBucketStore:
+    """Token buckets in a dict, for a single process.
+
+    At most `max_keys` buckets are kept; past that, the least recently
+    used are forgotten, one per new key.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token from `key`'s bucket.
+
+        Returns (allowed, tokens left).
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return allowed, tokens
+
+
+class DatabaseBucketStore:
+    """Token buckets in the rate_limit_buckets table, shared by all workers.
+
+    Each take is a single upsert, so concurrent attempts on the same
+    bucket serialize on its row. Times come from the database clock.
+    """
+
+    REFILL = ("LEAST(:capacity, b.tokens + "
+              "(extract(epoch FROM clock_timestamp()) - b.updated_at) * :rate)")
+
+    TAKE = db.text(f"""
+        INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at, allowed)
+        VALUES (:key, :capacity - 1, extract(epoch FROM clock_timestamp()), true)
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = CASE WHEN {REFILL} >= 1 THEN {REFILL} - 1 ELSE {REFILL} END,
+            allowed = {REFILL} >= 1,
+            updated_at = extract(epoch FROM clock_timestamp())
+        RETURNING allowed, tokens
+    """)
+
+    PRUNE = db.text("""
+        DELETE FROM rate_limit_buckets
+        WHERE updated_at < extract(epoch FROM clock_timestamp()) - :idle_seconds
+    """)
+
+    def take(self, key, capacity, rate):
+        with db.engine.begin() as conn:
+            allowed, tokens = conn.execute(
+                self.TAKE, key=key, capacity=capacity, rate=rate).first()
+
+        return allowed, tokens
+
+    def prune(self, idle_seconds=86400):
+        """Forget buckets untouched for `idle_seconds`; run from cron."""
+
+        with db.engine.begin() as conn:
+            return conn.execute(self.PRUNE, idle_seconds=idle_seconds).rowcount
+
+
+STORES = {
+    'memory': MemoryBucketStore,
+    'database': DatabaseBucketStore,
+}
+
+
+class LoginThrottle:
+    """Per-IP and per-username attempt limits for the auth views."""
+
+    def __init__(self, app=None):
+        self.store = None
+        self.rejected = 0
+        self.hash_seconds = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['LOGIN_THROTTLE']
+        self.store = STORES[app.config['LOGIN_THROTTLE_STORE']]()
+        self.ip_limit = app.config['LOGIN_THROTTLE_PER_IP']
+        self.username_limit = app.config['LOGIN_THROTTLE_PER_USERNAME']
+        app.extensions['login_throttle'] = self
+
+        if self.enabled:
+            # before any request (in the master, for pre-forking servers)
+            self.hash_seconds = measure_hash_seconds()
+
+    def check(self, ip, username=None):
+        """Count an attempt from `ip` (as `username`, for logins).
+
+        Returns None if it may go ahead, or the seconds until it may be
+        retried if it's over a limit.
+        """
+
+        if not self.enabled:
+            return None
+
+        limits = [(f"ip:{ip}", self.ip_limit)]
+        if username is not None:
+            limits.append((f"user:{username.lower()}", self.username_limit))
+
+        for key, (capacity, rate) in limits:
+            allowed, tokens = self.store.take(key, capacity, rate)
+
+            if not allowed:
+                with self._lock:
+                    self.rejected += 1
+
+                logger.warning(
+                    "Throttled auth attempt for %s (%d rejected, ~%.1f "
+                    "CPU-seconds of bcrypt saved)",
+                    key, self.rejected, self.saved_cpu_seconds())
+
+                return (1 - tokens) / rate
+
+        return None
+
+    def saved_cpu_seconds(self):
+        """Estimated CPU time not spent hashing for rejected attempts."""
+
+        return self.rejected * (self.hash_seconds or 0)
+
+    def stats(self):
+        return {
+            'rejected': self.rejected,
+            'hash_seconds': self.hash_seconds,
+            'saved_cpu_seconds': self.saved_cpu_seconds(),
+        }
+
+
+def measure_hash_seconds():
+    """CPU time of one bcrypt hash at the app's work factor."""
+
+    start = time.process_time()
+    bcrypt.generate_password_hash("calibration")
+    return time.process_time() - start
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,514 @@
+"""Fixed-size avatar and header thumbnails, cached on disk.
+
+`image_url` and `header_image_url` can point at any full-size image, so
+instead of making every browser fetch and downscale the originals, the
+templates ask for one of a few SIZES via thumbnail_url(user, size). The
+first time a (source, size) pair is seen it's rendered to WebP and kept
+in THUMBNAIL_CACHE_DIR under the hash of its bytes:
+
+    <cache dir>/thumbs/<sha256>.webp      the thumbnails
+    <cache dir>/index/<key>               (source, size) -> sha256
+
+Thumbnail URLs are content-addressed, so they're served with a year-long
+immutable Cache-Control. A (source, size) pair not rendered yet links to
+/users/<id>/thumbnails/<size> instead, which renders it and redirects to
+the immutable URL. Signup and profile edits queue a warm_thumbnails job
+(see jobs.py) that renders a user's thumbnails up front, fetching each
+source image once for all its sizes, so that detour is rare. The cache
+is per host: the job warms the host whose job worker ran it.
+
+Sources are fetched only from public addresses, and the connection goes
+to the address that was checked, so a name can't resolve somewhere else
+in between. A source that can't be made into a thumbnail gets the
+default image's instead.
+
+The cache is shared by every worker on the host and kept under
+THUMBNAIL_CACHE_MAX_BYTES by deleting the least recently served
+thumbnails; one that's been evicted is rendered again on demand.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from flask import abort, current_app, redirect, send_file, url_for
+from jinja2 import contextfunction
+from sqlalchemy.orm import load_only
+from werkzeug.security import safe_join
+
+from jobs import handler
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+# name: (source column, width, height, crop to fill?)
+# Sized at 2x the CSS box they're shown in, for high-DPI screens.
+SIZES = {
+    'timeline': ('image_url', 96, 96, True),
+    'card': ('image_url', 140, 140, True),
+    'profile': ('image_url', 400, 400, True),
+    'card-header': ('header_image_url', 600, 200, False),
+    'header': ('header_image_url', 1600, 720, False),
+}
+
+WEBP_QUALITY = 80
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Don't fetch again for this long after a source fails to load.
+FAILURE_TTL = 300
+
+# Bound on the in-process (source, size) -> digest memo.
+MAX_MEMO_ENTRIES = 100000
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ThumbnailError(Exception):
+    """A source image couldn't be fetched or decoded."""
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def public_address(host, port):
+    """The address to connect to for `host`, if all it resolves to is
+    public; ThumbnailError if not.
+
+    Sources are user-supplied, so without this a profile could point the
+    server at its own internal network.
+    """
+
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as exc:
+        raise ThumbnailError(f"can't resolve {host}: {exc}")
+
+    for *_, sockaddr in addresses:
+        if not ipaddress.ip_address(sockaddr[0]).is_global:
+            raise ThumbnailError(f"{host} isn't a public address")
+
+    return addresses[0][4][0]
+
+
+def check_public_url(url):
+    """Refuse anything but http(s) URLs on public addresses.
+
+    Returns the address the URL's host was checked at.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise ThumbnailError(f"not an http(s) URL: {url!r}")
+
+    return public_address(parts.hostname,
+                          parts.port or DEFAULT_PORTS[parts.scheme])
+
+
+def _pinned(connection_class):
+    """`connection_class`, connecting only to the address its host was
+    checked at (TLS still checks the certificate against the host)."""
+
+    def connect(host, **kwargs):
+        conn = connection_class(host, **kwargs)
+        address = public_address(conn.host, conn.port)
+
+        def create_connection(host_port, *args):
+            return socket.create_connection((address, host_port[1]), *args)
+
+        conn._create_connection = create_connection
+        return conn
+
+    return connect
+
+
+class _PinnedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_pinned(http.client.HTTPConnection), req)
+
+
+class _PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_pinned(http.client.HTTPSConnection), req,
+                            context=self._context)
+
+
+class _HTTPOnlyRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urllib.parse.urlsplit(newurl).scheme not in DEFAULT_PORTS:
+            raise ThumbnailError(f"redirected to {newurl!r}")
+
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# no proxies: the connection has to go where the address check said
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _PinnedHTTPHandler,
+    _PinnedHTTPSHandler, _HTTPOnlyRedirects)
+
+
+def render_thumbnail(data, width, height, crop):
+    """Scale image bytes down to a WebP thumbnail; returns the WebP bytes."""
+
+    # only workers that render thumbnails pay for importing Pillow
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        # lets JPEG decode straight at a reduced scale
+        image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ThumbnailError(f"can't decode image: {exc}")
+
+    return out.getvalue()
+
+
+class ThumbnailCache:
+    """Renders, stores, evicts and serves thumbnails for one app."""
+
+    def __init__(self, app=None):
+        self._digests = {}
+        self._failures = {}
+        self._cached_bytes = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['THUMBNAIL_CACHE_DIR']
+        self.max_bytes = app.config['THUMBNAIL_CACHE_MAX_BYTES']
+        self.max_source_bytes = app.config['THUMBNAIL_MAX_SOURCE_BYTES']
+        self.fetch_timeout = app.config['THUMBNAIL_FETCH_TIMEOUT']
+        self.static_folder = app.static_folder
+        self.static_url_path = app.static_url_path + '/'
+
+        self.thumb_dir = os.path.join(self.directory, 'thumbs')
+        self.index_dir = os.path.join(self.directory, 'index')
+        os.makedirs(self.thumb_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        app.extensions['thumbnails'] = self
+        app.jinja_env.globals['thumbnail_url'] = self.thumbnail_url
+
+        app.add_url_rule('/thumbnails/<digest>.webp', 'thumbnail',
+                         self.serve)
+        app.add_url_rule('/users/<int:user_id>/thumbnails/<size>',
+                         'user_thumbnail', self.serve_for_user)
+
+    # Lookup
+
+    def source(self, user, size):
+        """The source URL `size` of `user` is made from."""
+
+        column = SIZES[size][0]
+        return getattr(user, column) or getattr(User, column).default.arg
+
+    @staticmethod
+    def key(source, size):
+        return hashlib.sha256(f"{size}\0{source}".encode()).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.thumb_dir, f"{digest}.webp")
+
+    def lookup(self, source, size):
+        """Digest of the cached thumbnail, or None if it needs rendering."""
+
+        key = self.key(source, size)
+        digest = self._digests.get(key)
+
+        if digest is None:
+            try:
+                with open(os.path.join(self.index_dir, key)) as f:
+                    digest = f.read()
+            except FileNotFoundError:
+                return None
+
+        # another worker may have evicted it
+        if not os.path.exists(self.path(digest)):
+            self._digests.pop(key, None)
+            return None
+
+        self._remember(key, digest)
+        return digest
+
+    def _remember(self, key, digest):
+        if len(self._digests) >= MAX_MEMO_ENTRIES:
+            self._digests.clear()
+
+        self._digests[key] = digest
+
+    @contextfunction
+    def thumbnail_url(self, context, user, size):
+        """URL of `user`'s `size` thumbnail, for the templates.
+
+        Uses whichever url_for the template was rendered with, so it also
+        works in templates rendered by asgi.py.
+        """
+
+        build_url = context.resolve('url_for')
+        digest = self.lookup(self.source(user, size), size)
+
+        if digest is None:
+            return build_url('user_thumbnail', user_id=user.id, size=size)
+
+        return build_url('thumbnail', digest=digest)
+
+    # Rendering
+
+    def fetch(self, source):
+        """The bytes of a source image, from the static folder or the web."""
+
+        if source.startswith(self.static_url_path):
+            path = safe_join(self.static_folder,
+                             source[len(self.static_url_path):])
+            if path is None:
+                raise ThumbnailError(f"bad static path: {source!r}")
+
+            try:
+                with open(path, 'rb') as f:
+                    return f.read(self.max_source_bytes + 1)
+            except OSError as exc:
+                raise ThumbnailError(f"can't read {source!r}: {exc}")
+
+        if urllib.parse.urlsplit(source).scheme not in DEFAULT_PORTS:
+            raise ThumbnailError(f"not an http(s) URL: {source!r}")
+
+        # the address is checked as the connection is made
+        try:
+            with _opener.open(source, timeout=self.fetch_timeout) as resp:
+                data = resp.read(self.max_source_bytes + 1)
+        except (OSError, ValueError) as exc:
+            raise ThumbnailError(f"can't fetch {source!r}: {exc}")
+
+        if len(data) > self.max_source_bytes:
+            raise ThumbnailError(f"{source!r} is over the size limit")
+
+        return data
+
+    def render(self, source, size, data=None):
+        """Render and store `size` of `source`; returns its digest.
+
+        `data` is the source's bytes, if they've been fetched already.
+        """
+
+        key = self.key(source, size)
+        failed_at = self._failures.get(key)
+
+        if failed_at is not None and time.monotonic() - failed_at < FAILURE_TTL:
+            raise ThumbnailError(f"{source!r} failed recently")
+
+        _, width, height, crop = SIZES[size]
+
+        try:
+            if data is None:
+                data = self.fetch(source)
+            webp = render_thumbnail(data, width, height, crop)
+        except ThumbnailError:
+            self._failures[key] = time.monotonic()
+            raise
+
+        digest = hashlib.sha256(webp).hexdigest()
+        path = self.path(digest)
+
+        if not os.path.exists(path):
+            self._write(path, webp)
+            self._added(len(webp))
+
+        self._write(os.path.join(self.index_dir, key), digest.encode())
+        self._remember(key, digest)
+        self._failures.pop(key, None)
+
+        return digest
+
+    def warm(self, user):
+        """Render all of `user`'s thumbnails not cached yet.
+
+        Each source is fetched once, for all the sizes made from it.
+        """
+
+        missing = {}
+        for size in SIZES:
+            source = self.source(user, size)
+
+            if self.lookup(source, size) is None:
+                missing.setdefault(source, []).append(size)
+
+        for source, sizes in missing.items():
+            try:
+                data = self.fetch(source)
+            except ThumbnailError as exc:
+                logger.info("No thumbnails of %r for user %s: %s",
+                            source, user.id, exc)
+                continue
+
+            for size in sizes:
+                try:
+                    self.render(source, size, data)
+                except ThumbnailError as exc:
+                    logger.info("No %s thumbnail for user %s: %s",
+                                size, user.id, exc)
+
+    @staticmethod
+    def _write(path, data):
+        """Write atomically, so other workers never see half a file."""
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    # Eviction
+
+    def _added(self, nbytes):
+        with self._lock:
+            if self._cached_bytes is None:
+                self._cached_bytes = self.disk_usage()
+            else:
+                self._cached_bytes += nbytes
+
+            over = self._cached_bytes > self.max_bytes
+
+        if over:
+            self.prune()
+
+    def disk_usage(self):
+        with os.scandir(self.thumb_dir) as entries:
+            return sum(entry.stat().st_size for entry in entries
+                       if entry.name.endswith('.webp'))
+
+    def prune(self, target=None):
+        """Delete least recently served thumbnails until under `target`.
+
+        Defaults to 90% of THUMBNAIL_CACHE_MAX_BYTES, so a full cache
+        isn't pruned again on every new thumbnail. Returns bytes freed.
+        """
+
+        if target is None:
+            target = self.max_bytes * 0.9
+
+        with os.scandir(self.thumb_dir) as entries:
+            files = [(entry.stat(), entry.path) for entry in entries
+                     if entry.name.endswith('.webp')]
+
+        total = sum(stat.st_size for stat, path in files)
+        freed = 0
+
+        for stat, path in sorted(files, key=lambda item: item[0].st_mtime):
+            if total - freed <= target:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+
+            freed += stat.st_size
+
+        with self._lock:
+            self._cached_bytes = total - freed
+
+        self._digests.clear()
+        return freed
+
+    # Views
+
+    def serve(self, digest):
+        """A cached thumbnail; its URL never changes meaning."""
+
+        if not DIGEST_RE.match(digest):
+            abort(404)
+
+        path = self.path(digest)
+
+        try:
+            # mtime is the recency eviction goes by
+            os.utime(path)
+        except FileNotFoundError:
+            abort(404)
+
+        resp = send_file(path, mimetype='image/webp', conditional=True)
+        resp.headers['Cache-Control'] = IMMUTABLE
+
+        return resp
+
+    def serve_for_user(self, user_id, size):
+        """Render a thumbnail that isn't cached yet, then redirect to it.
+
+        If the source can't be made into a thumbnail, redirect to the
+        default image's (never to the source: it's whatever URL the user
+        put in their profile).
+        """
+
+        if size not in SIZES:
+            abort(404)
+
+        user = User.query.options(
+            load_only(SIZES[size][0])).get_or_404(user_id)
+        source = self.source(user, size)
+        digest = self.lookup(source, size)
+
+        if digest is None:
+            try:
+                digest = self.render(source, size)
+            except ThumbnailError as exc:
+                logger.info("No %s thumbnail for user %s: %s",
+                            size, user_id, exc)
+                return self.serve_default(size)
+
+        return redirect(url_for('thumbnail', digest=digest))
+
+    def serve_default(self, size):
+        """Redirect to the default image's `size` thumbnail."""
+
+        default = getattr(User, SIZES[size][0]).default.arg
+        digest = self.lookup(default, size)
+
+        if digest is None:
+            try:
+                digest = self.render(default, size)
+            except ThumbnailError:
+                return redirect(default)
+
+        return redirect(url_for('thumbnail', digest=digest))
+
+
+@handler('warm_thumbnails')
+def warm_thumbnails(connection, payloads):
+    """Render the thumbnails of the payloads' users ({"user_id": n}).
+
+    Runs in a job worker, which needs an app context (see jobs.py).
+    """
+
+    users = User.__table__
+    cache = current_app.extensions['thumbnails']
+    user_ids = [payload['user_id'] for payload in payloads]
+
+    for user in connection.execute(
+            db.select([users.c.id, users.c.image_url,
+                       users.c.header_image_url])
+            .where(users.c.id.in_(user_ids))):
+        cache.warm(user)